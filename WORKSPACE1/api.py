@@ -1,8 +1,18 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context
+import argparse
+import json
+import os
+import threading
+import time
 import torch
-from transformers import BertTokenizer
-from model import MultiDimensionalSentimentModel
-from predict import predict_sentiment
+from config import Config
+import metrics
+from inference_only import BACKENDS, load_model
+from micro_batcher import MicroBatcher
+from predict import POOLING_METHODS, predict_sentiment_batch, supports_early_exit
+from prediction_cache import PredictionCache, model_fingerprint
+from tokenization import get_token_id_cache, load_tokenizer
+from utils import get_peak_rss_mb
 
 # 在全局范围初始化 Flask app
 app = Flask(__name__)
@@ -10,6 +20,17 @@ app = Flask(__name__)
 # 创建一个全局变量来存储模型和tokenizer
 global_model = None
 global_tokenizer = None
+global_batcher = None
+global_cache = None
+global_startup_stats = None
+global_exit_threshold = None
+global_long_text_pooling = None
+_batcher_lock = threading.Lock()
+
+MODEL_PATH = 'WORKSPACE1/best_model.pt'
+ONNX_MODEL_PATH = 'WORKSPACE1/best_model.onnx'
+QUANTIZED_MODEL_PATH = 'WORKSPACE1/best_model_int8.pt'
+EARLY_EXIT_MODEL_PATH = 'WORKSPACE1/best_model_early_exit.pt'  # early_exit.py 的默认输出
 
 # 添加HTML模板
 API_DOC = """
@@ -43,7 +64,8 @@ API_DOC = """
         <h2>预测接口</h2>
         <p><strong>端点：</strong> /predict</p>
         <p><strong>方法：</strong> POST</p>
-        <p><strong>描述：</strong> 对输入的中文文本进行情感分析</p>
+        <p><strong>描述：</strong> 对输入的中文文本进行情感分析；超过 512 个 token 的长文本（如视频转写）
+        按重叠的滑动窗口推理后聚合，不会截断</p>
         
         <h3>请求格式：</h3>
         <pre>
@@ -57,7 +79,8 @@ API_DOC = """
 {
     "sentiment": "情感类别",
     "probabilities": [类别1概率, 类别2概率, ...],
-    "confidence": 置信度
+    "confidence": 置信度,
+    "exit_layer": 实际计算的编码层数（开启提前退出时可能小于总层数）
 }
         </pre>
         
@@ -69,6 +92,53 @@ curl -X POST -H "Content-Type: application/json" \
      http://localhost:5000/predict
         </pre>
     </div>
+
+    <div class="endpoint">
+        <h2>批量预测接口</h2>
+        <p><strong>端点：</strong> /predict_batch</p>
+        <p><strong>方法：</strong> POST</p>
+        <p><strong>描述：</strong> 批量情感分析，按内部批次推理，每完成一批就以 NDJSON 逐行流式返回结果</p>
+
+        <h3>请求格式（二选一）：</h3>
+        <p>JSON 数组（Content-Type: application/json）：</p>
+        <pre>
+["文本1", {"id": "r2", "text": "文本2"}]
+        </pre>
+        <p>NDJSON（Content-Type: application/x-ndjson），每行一条：</p>
+        <pre>
+{"id": "r1", "text": "文本1"}
+"文本2"
+        </pre>
+
+        <h3>响应格式（application/x-ndjson，每行一条，顺序与输入一致）：</h3>
+        <pre>
+{"index": 0, "sentiment": "情感类别", "probabilities": [...], "confidence": 置信度, "exit_layer": 层数}
+{"index": 1, "id": "r2", "sentiment": "情感类别", "probabilities": [...], "confidence": 置信度, "exit_layer": 层数}
+{"index": 2, "error": "错误信息"}
+        </pre>
+
+        <h3>示例：</h3>
+        <pre>
+curl -X POST -H "Content-Type: application/x-ndjson" \
+     --data-binary @reviews.ndjson \
+     http://localhost:5000/predict_batch?batch_size=64
+        </pre>
+    </div>
+
+    <div class="endpoint">
+        <h2>统计接口</h2>
+        <p><strong>端点：</strong> /stats</p>
+        <p><strong>方法：</strong> GET</p>
+        <p><strong>描述：</strong> 返回微批处理的批大小分布、排队等待时间，以及预测缓存和分词缓存的命中/未命中/淘汰计数</p>
+    </div>
+
+    <div class="endpoint">
+        <h2>监控指标接口</h2>
+        <p><strong>端点：</strong> /metrics</p>
+        <p><strong>方法：</strong> GET</p>
+        <p><strong>描述：</strong> Prometheus 文本格式指标：tokenize/forward/postprocess/serialize 各阶段耗时直方图、
+        批大小分布、队列长度、在途请求数以及启动时模型加载耗时</p>
+    </div>
 </body>
 </html>
 """
@@ -78,19 +148,106 @@ def home():
     """API文档首页"""
     return render_template_string(API_DOC)
 
-def init_model():
-    """初始化模型和tokenizer的函数"""
-    global global_model, global_tokenizer
+def init_model(backend=None, quantized=None, warmup=True, exit_threshold=None, model_path=None,
+               long_text_pooling=None):
+    """初始化模型和tokenizer的函数，并记录启动各阶段耗时
+
+    model_path 可指定其他检查点（如 distill.py 生成的学生模型），默认按后端选择，
+    设置了提前退出阈值时优先使用 early_exit.py 生成的带退出头检查点；
+    long_text_pooling 为长文本窗口的聚合方式，'none' 表示截断
+    """
+    global global_model, global_tokenizer, global_cache, global_startup_stats, global_exit_threshold
+    global global_long_text_pooling
+    init_start = time.perf_counter()
+    timings = {}
+    backend = backend or Config.INFERENCE_BACKEND
+    quantized = Config.INFERENCE_QUANTIZED if quantized is None else quantized
+    global_exit_threshold = Config.EARLY_EXIT_THRESHOLD if exit_threshold is None else exit_threshold
+    if model_path is None:
+        if backend == 'onnx':
+            model_path = ONNX_MODEL_PATH
+        elif quantized:
+            model_path = QUANTIZED_MODEL_PATH
+        elif global_exit_threshold is not None and os.path.exists(EARLY_EXIT_MODEL_PATH):
+            model_path = EARLY_EXIT_MODEL_PATH
+        else:
+            model_path = MODEL_PATH
     if global_model is None:
-        global_model = MultiDimensionalSentimentModel()
-        global_model.load_state_dict(torch.load('WORKSPACE1/best_model.pt', map_location=torch.device('cpu')))
+        # 合并分类头的结构输出不变，只在 torch 后端的 fp32 模型上启用
+        fuse_heads = Config.INFERENCE_FUSE_HEADS and backend == 'torch' and not quantized
+        global_model = load_model(model_path, backend=backend, quantized=quantized, timings=timings,
+                                  fuse_heads=fuse_heads)
         global_model.to(torch.device('cpu'))
         global_model.eval()
+
+    if global_exit_threshold is not None and not supports_early_exit(global_model):
+        print(f"模型 {model_path} 没有提前退出头，忽略提前退出阈值"
+              f"（先运行 early_exit.py 生成 {EARLY_EXIT_MODEL_PATH}，或用 --model-path 指定带退出头的检查点）")
+        global_exit_threshold = None
+
+    pooling = Config.LONG_TEXT_POOLING if long_text_pooling is None else long_text_pooling
+    global_long_text_pooling = None if pooling == 'none' else pooling
     
     if global_tokenizer is None:
-        global_tokenizer = BertTokenizer.from_pretrained('bert-base-chinese')
+        start = time.perf_counter()
+        global_tokenizer = load_tokenizer('bert-base-chinese', cache_size=Config.TOKEN_CACHE_MAX_ENTRIES)
+        timings['tokenizer'] = time.perf_counter() - start
+
+    if warmup and timings:
+        # 首次推理会把内存映射的权重读入页缓存，计入启动耗时
+        start = time.perf_counter()
+        predict_sentiment_batch(['预热'], global_model, global_tokenizer, torch.device('cpu'),
+                                exit_threshold=global_exit_threshold)
+        timings['first_prediction'] = time.perf_counter() - start
+
+    if global_cache is None and Config.PREDICTION_CACHE_ENABLED:
+        # 缓存键包含模型指纹、提前退出阈值和长文本聚合方式，更换后旧结果自动失效
+        global_cache = PredictionCache(
+            f"{model_fingerprint(model_path)}:exit={global_exit_threshold}"
+            f":pool={global_long_text_pooling}:stride={Config.LONG_TEXT_STRIDE}"
+            f":windows={Config.LONG_TEXT_MAX_WINDOWS}",
+            max_entries=Config.PREDICTION_CACHE_MAX_ENTRIES,
+            max_bytes=Config.PREDICTION_CACHE_MAX_BYTES,
+            ttl=Config.PREDICTION_CACHE_TTL,
+            disk_dir=Config.PREDICTION_CACHE_DISK_DIR
+        )
+
+    if timings:
+        timings['total'] = time.perf_counter() - init_start
+        global_startup_stats = {
+            'timings': timings,
+            'peak_rss_mb': get_peak_rss_mb()
+        }
+        print("启动耗时: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items()))
+        print(f"启动峰值内存: {global_startup_stats['peak_rss_mb']:.0f} MB")
+        metrics.record_startup(timings)
+
+def run_model_batch(texts):
+    """批量推理并记录批大小和各阶段耗时（微批处理线程、批量接口和异步服务共用）"""
+    timings = {}
+    results = predict_sentiment_batch(
+        texts, global_model, global_tokenizer, torch.device('cpu'),
+        timings=timings, exit_threshold=global_exit_threshold,
+        pooling=global_long_text_pooling, stride=Config.LONG_TEXT_STRIDE,
+        max_windows=Config.LONG_TEXT_MAX_WINDOWS
+    )
+    metrics.observe_batch(len(texts), timings)
+    return results
+
+def get_batcher():
+    """按需创建微批处理器（在实际处理请求的进程中创建后台线程）"""
+    global global_batcher
+    with _batcher_lock:
+        if global_batcher is None:
+            global_batcher = MicroBatcher(
+                run_model_batch,
+                max_batch_size=Config.MICRO_BATCH_MAX_SIZE,
+                max_wait_ms=Config.MICRO_BATCH_MAX_WAIT_MS
+            ).start()
+    return global_batcher
 
 @app.route('/predict', methods=['POST'])
+@metrics.IN_FLIGHT.track_inprogress()
 def predict():
     # 确保模型已经加载
     if global_model is None or global_tokenizer is None:
@@ -100,21 +257,165 @@ def predict():
     if not text:
         return jsonify({'error': 'Text is required for prediction'}), 400
 
-    sentiment, probabilities, confidence = predict_sentiment(text, global_model, global_tokenizer, torch.device('cpu'))
+    result = global_cache.get(text) if global_cache else None
+    if result is None:
+        # 并发请求在微批处理器中合并成一个批次推理
+        result = get_batcher().predict(text)
+        if global_cache:
+            global_cache.put(text, result)
+    sentiment, probabilities, confidence, exit_layer = result
+
+    with metrics.STAGE_LATENCY.labels('serialize').time():
+        return jsonify({
+            'sentiment': sentiment,
+            'probabilities': probabilities,
+            'confidence': confidence,
+            'exit_layer': exit_layer
+        })
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+def _cached_predict_batch(texts):
+    """批量预测，只对缓存未命中的文本推理"""
+    if not global_cache:
+        return run_model_batch(texts)
+
+    results = [global_cache.get(text) for text in texts]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        predictions = run_model_batch([texts[i] for i in missing])
+        for i, prediction in zip(missing, predictions):
+            results[i] = prediction
+            global_cache.put(texts[i], prediction)
+    return results
+
+def _iter_bulk_items():
+    """逐条读取批量请求体，支持 JSON 数组和 NDJSON（NDJSON 按行流式读取）"""
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if line:
+                yield line
+    else:
+        items = request.get_json(force=True)
+        if not isinstance(items, list):
+            raise ValueError('请求体必须是 JSON 数组或 NDJSON')
+        yield from items
+
+def _parse_bulk_item(item):
+    """解析单条输入，返回 (id, text)"""
+    if isinstance(item, bytes):
+        item = json.loads(item)
+    if isinstance(item, str):
+        return None, item
+    if isinstance(item, dict):
+        return item.get('id'), item.get('text')
+    raise ValueError('每条输入必须是字符串或包含 text 字段的对象')
 
-    # 将 Tensor 转换为普通 Python 数据类型
-    if isinstance(probabilities, torch.Tensor):
-        probabilities = probabilities.tolist()
-    if isinstance(confidence, torch.Tensor):
-        confidence = float(confidence)
+def _predict_bulk_chunk(chunk):
+    """对一批 (index, id, text) 推理并生成 NDJSON 行"""
+    if not chunk:
+        return
+    results = _cached_predict_batch([text for _, _, text in chunk])
+    start = time.perf_counter()
+    lines = []
+    for (index, item_id, _), (sentiment, probabilities, confidence, exit_layer) in zip(chunk, results):
+        line = {'index': index}
+        if item_id is not None:
+            line['id'] = item_id
+        line.update({
+            'sentiment': sentiment,
+            'probabilities': probabilities,
+            'confidence': confidence,
+            'exit_layer': exit_layer
+        })
+        lines.append(json.dumps(line, ensure_ascii=False) + '\n')
+    metrics.STAGE_LATENCY.labels('serialize').observe(time.perf_counter() - start)
+    yield from lines
 
+def _stream_bulk_predictions(items, batch_size):
+    # 流式响应在视图函数返回后才开始生成，在途计数覆盖整个生成过程
+    with metrics.IN_FLIGHT.track_inprogress():
+        yield from _generate_bulk_predictions(items, batch_size)
+
+def _generate_bulk_predictions(items, batch_size):
+    chunk = []
+    for index, item in enumerate(items):
+        try:
+            item_id, text = _parse_bulk_item(item)
+            if not text or not isinstance(text, str):
+                raise ValueError('Text is required for prediction')
+        except ValueError as e:
+            # 单条输入有误时先输出已攒的批次以保持顺序，再返回该行错误
+            yield from _predict_bulk_chunk(chunk)
+            chunk = []
+            yield json.dumps({'index': index, 'error': str(e)}, ensure_ascii=False) + '\n'
+            continue
+
+        chunk.append((index, item_id, text))
+        if len(chunk) >= batch_size:
+            yield from _predict_bulk_chunk(chunk)
+            chunk = []
+
+    yield from _predict_bulk_chunk(chunk)
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """批量预测，按内部批次推理并以 NDJSON 流式返回"""
+    if global_model is None or global_tokenizer is None:
+        init_model()
+
+    batch_size = request.args.get('batch_size', Config.BULK_BATCH_SIZE, type=int)
+    if batch_size <= 0:
+        return jsonify({'error': 'batch_size must be positive'}), 400
+
+    items = _iter_bulk_items()
+    if request.mimetype not in NDJSON_MIMETYPES:
+        # JSON 数组需要先整体解析，格式错误可以直接返回 400
+        try:
+            items = list(items)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    return Response(
+        stream_with_context(_stream_bulk_predictions(items, batch_size)),
+        mimetype='application/x-ndjson'
+    )
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """微批处理统计信息"""
+    token_cache = get_token_id_cache(global_tokenizer) if global_tokenizer is not None else None
     return jsonify({
-        'sentiment': sentiment,
-        'probabilities': probabilities,
-        'confidence': confidence
+        'micro_batching': get_batcher().stats(),
+        'prediction_cache': global_cache.stats() if global_cache else None,
+        'token_cache': token_cache.stats() if token_cache else None,
+        'startup': global_startup_stats
     })
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文本格式的指标"""
+    if global_batcher is not None:
+        # 队列长度在抓取时读取，不在请求路径上额外维护
+        metrics.QUEUE_DEPTH.set(global_batcher.queue_depth())
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='情感分析 API 服务')
+    parser.add_argument('--backend', type=str, default=Config.INFERENCE_BACKEND, choices=BACKENDS, help='推理后端')
+    parser.add_argument('--quantized', action='store_true', default=Config.INFERENCE_QUANTIZED,
+                        help='使用 quantize.py 生成的 INT8 量化模型')
+    parser.add_argument('--exit-threshold', type=float, default=Config.EARLY_EXIT_THRESHOLD,
+                        help='提前退出的置信度阈值；未指定 --model-path 时使用 early_exit.py 生成的带退出头检查点')
+    parser.add_argument('--model-path', type=str, default=None,
+                        help='模型检查点路径（如蒸馏得到的学生模型），默认按后端选择')
+    parser.add_argument('--long-text-pooling', type=str, default=Config.LONG_TEXT_POOLING or 'none',
+                        choices=POOLING_METHODS + ('none',), help='长文本滑动窗口的聚合方式，none 表示截断')
+    args = parser.parse_args()
+
     # 在启动服务器前初始化模型
-    init_model()
+    init_model(backend=args.backend, quantized=args.quantized, exit_threshold=args.exit_threshold,
+               model_path=args.model_path, long_text_pooling=args.long_text_pooling)
     app.run(host='0.0.0.0', port=5000)
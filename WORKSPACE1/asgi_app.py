@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import functools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+import api
+import metrics
+from config import Config
+from inference_only import BACKENDS
+from predict import POOLING_METHODS
+
+class DeadlineExceeded(Exception):
+    pass
+
+class _QueuedRequest:
+    __slots__ = ('text', 'future', 'deadline')
+
+    def __init__(self, text, future, deadline):
+        self.text = text
+        self.future = future
+        self.deadline = deadline
+
+class AdmissionController:
+    """有界准入队列 + 专用模型线程
+
+    队列满时立即拒绝（503 + Retry-After），过期请求在推理前丢弃，
+    保证被接纳的请求延迟可预期，过载时不会无限堆积。
+    最多 model_workers 个批次同时在模型线程中推理，线程都忙时请求在队列中累积成更大的批次。
+    """
+
+    def __init__(self, max_queue_size, max_batch_size, model_workers=1):
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.max_batch_size = max_batch_size
+        self.model_workers = model_workers
+        self.executor = ThreadPoolExecutor(max_workers=model_workers, thread_name_prefix='model')
+        self._dispatch_task = None
+        self._slots = None  # 空闲模型线程数，在事件循环中创建
+        self.in_flight_batches = 0
+
+        # 统计信息
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.completed = 0
+        self.avg_batch_seconds = None  # 批次耗时的指数滑动平均
+
+    def start(self):
+        self._slots = asyncio.Semaphore(self.model_workers)
+        self._dispatch_task = asyncio.get_running_loop().create_task(self._dispatch_loop())
+
+    async def stop(self):
+        if self._dispatch_task is not None:
+            self._dispatch_task.cancel()
+        self.executor.shutdown(wait=False)
+
+    def retry_after(self):
+        """按当前队列长度、平均批次耗时和模型线程数估算队列排空所需秒数"""
+        batch_seconds = self.avg_batch_seconds or 1.0
+        batches = math.ceil(self.queue.qsize() / self.max_batch_size)
+        return max(1, math.ceil(batches * batch_seconds / self.model_workers))
+
+    def submit(self, text, timeout):
+        """尝试把请求放入队列，队列已满时抛出 asyncio.QueueFull"""
+        loop = asyncio.get_running_loop()
+        request = _QueuedRequest(text, loop.create_future(), loop.time() + timeout)
+        try:
+            self.queue.put_nowait(request)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise
+        self.admitted += 1
+        return request.future
+
+    async def _dispatch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # 等到有空闲的模型线程再取批次：模型都忙时请求在队列中累积，下一批一次性取出
+            await self._slots.acquire()
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            now = loop.time()
+            live = []
+            for request in batch:
+                if request.future.done():
+                    # 客户端已超时放弃
+                    continue
+                if request.deadline <= now:
+                    self.expired += 1
+                    request.future.set_exception(DeadlineExceeded())
+                    continue
+                live.append(request)
+            if not live:
+                self._slots.release()
+                continue
+
+            # 不等待推理完成，结果由回调分发，下一批可以在另一个模型线程中同时推理
+            texts = list(dict.fromkeys(request.text for request in live))
+            self.in_flight_batches += 1
+            future = loop.run_in_executor(self.executor, api.run_model_batch, texts)
+            future.add_done_callback(functools.partial(self._deliver, live, texts, loop.time()))
+
+    def _deliver(self, live, texts, start, future):
+        """批次推理完成后在事件循环中调用：释放模型线程并把结果交给各请求"""
+        self._slots.release()
+        self.in_flight_batches -= 1
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            for request in live:
+                if not request.future.done():
+                    request.future.set_exception(error)
+            return
+        elapsed = asyncio.get_running_loop().time() - start
+        self.avg_batch_seconds = elapsed if self.avg_batch_seconds is None else \
+            0.8 * self.avg_batch_seconds + 0.2 * elapsed
+
+        result_map = dict(zip(texts, future.result()))
+        for request in live:
+            if not request.future.done():
+                request.future.set_result(result_map[request.text])
+                self.completed += 1
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue_size': self.queue.maxsize,
+            'model_workers': self.model_workers,
+            'in_flight_batches': self.in_flight_batches,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'expired': self.expired,
+            'completed': self.completed,
+            'avg_batch_ms': 1000 * self.avg_batch_seconds if self.avg_batch_seconds else None,
+        }
+
+admission = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global admission
+    if api.global_model is None:
+        # 加载模型较慢，放到线程中执行
+        await asyncio.get_running_loop().run_in_executor(None, api.init_model)
+    admission = AdmissionController(
+        max_queue_size=Config.ASYNC_MAX_QUEUE_SIZE,
+        max_batch_size=Config.MICRO_BATCH_MAX_SIZE,
+        model_workers=Config.ASYNC_MODEL_WORKERS
+    )
+    admission.start()
+    try:
+        yield
+    finally:
+        await admission.stop()
+
+app = FastAPI(title='情感分析 API（异步模式）', lifespan=lifespan)
+
+@app.post('/predict')
+async def predict(request: Request):
+    with metrics.IN_FLIGHT.track_inprogress():
+        return await _predict(request)
+
+async def _predict(request):
+    start = time.perf_counter()
+    try:
+        payload = await request.json()
+    except ValueError:
+        return JSONResponse({'error': 'Request body must be JSON'}, status_code=400)
+    text = payload.get('text') if isinstance(payload, dict) else None
+    if not text:
+        return JSONResponse({'error': 'Text is required for prediction'}, status_code=400)
+
+    # 客户端可以通过请求头缩短截止时间，但不能超过服务端上限
+    timeout = Config.ASYNC_REQUEST_TIMEOUT
+    header_timeout = request.headers.get('X-Request-Timeout')
+    if header_timeout:
+        try:
+            timeout = min(timeout, float(header_timeout))
+        except ValueError:
+            return JSONResponse({'error': 'X-Request-Timeout must be a number of seconds'}, status_code=400)
+
+    result = api.global_cache.get(text) if api.global_cache else None
+    if result is None:
+        try:
+            future = admission.submit(text, timeout)
+        except asyncio.QueueFull:
+            return JSONResponse(
+                {'error': 'Server overloaded, please retry later'},
+                status_code=503,
+                headers={'Retry-After': str(admission.retry_after())}
+            )
+        try:
+            result = await asyncio.wait_for(future, timeout - (time.perf_counter() - start))
+        except (asyncio.TimeoutError, DeadlineExceeded):
+            return JSONResponse({'error': 'Request deadline exceeded'}, status_code=504)
+        if api.global_cache:
+            api.global_cache.put(text, result)
+
+    sentiment, probabilities, confidence, exit_layer = result
+    with metrics.STAGE_LATENCY.labels('serialize').time():
+        return JSONResponse({
+            'sentiment': sentiment,
+            'probabilities': probabilities,
+            'confidence': confidence,
+            'exit_layer': exit_layer
+        })
+
+@app.get('/stats')
+async def stats():
+    return {
+        'admission': admission.stats(),
+        'prediction_cache': api.global_cache.stats() if api.global_cache else None,
+        'startup': api.global_startup_stats
+    }
+
+@app.get('/metrics')
+async def prometheus_metrics():
+    if admission is not None:
+        metrics.QUEUE_DEPTH.set(admission.queue.qsize())
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='情感分析 API 服务（异步模式）')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='监听地址')
+    parser.add_argument('--port', type=int, default=5000, help='监听端口')
+    parser.add_argument('--backend', type=str, default=Config.INFERENCE_BACKEND, choices=BACKENDS, help='推理后端')
+    parser.add_argument('--quantized', action='store_true', default=Config.INFERENCE_QUANTIZED,
+                        help='使用 INT8 量化模型')
+    parser.add_argument('--exit-threshold', type=float, default=Config.EARLY_EXIT_THRESHOLD,
+                        help='提前退出的置信度阈值；未指定 --model-path 时使用 early_exit.py 生成的带退出头检查点')
+    parser.add_argument('--model-path', type=str, default=None,
+                        help='模型检查点路径（如蒸馏得到的学生模型），默认按后端选择')
+    parser.add_argument('--long-text-pooling', type=str, default=Config.LONG_TEXT_POOLING or 'none',
+                        choices=POOLING_METHODS + ('none',), help='长文本滑动窗口的聚合方式，none 表示截断')
+    args = parser.parse_args()
+
+    api.init_model(backend=args.backend, quantized=args.quantized, exit_threshold=args.exit_threshold,
+                   model_path=args.model_path, long_text_pooling=args.long_text_pooling)
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,130 @@
+import torch
+from torch.utils.data import DataLoader, DistributedSampler, Sampler, Subset
+from feature_cache import CachedFeatureDataset, collate_cached_features
+
+class DynamicPaddingCollator:
+    """把样本拼成批次并只填充到批内最长序列（pad_to 指定时填充到固定长度）
+
+    样本的 input_ids 可以不填充（PretokenizedDataset），也可以已填充并带 attention_mask
+    （ChineseSentimentDataset），后者会先按 attention_mask 去掉多余的填充
+    """
+
+    def __init__(self, pad_token_id=0, pad_to=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to = pad_to
+
+    def __call__(self, batch):
+        lengths = [
+            int(item['attention_mask'].sum()) if 'attention_mask' in item else item['input_ids'].size(0)
+            for item in batch
+        ]
+        length = self.pad_to or max(lengths)
+        input_ids = torch.full((len(batch), length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), length), dtype=torch.long)
+        for row, (item, item_length) in enumerate(zip(batch, lengths)):
+            input_ids[row, :item_length] = item['input_ids'][:item_length]
+            attention_mask[row, :item_length] = 1
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'labels': torch.stack([item['labels'] for item in batch])
+        }
+
+class LengthGroupedSampler(Sampler):
+    """按长度分组的采样器：打乱后每 batch_size * group_batches 条为一组，组内按长度排序切成批次，
+    再打乱批次顺序；同一批次内长度相近，批次之间和 epoch 之间仍然随机
+
+    shuffle=False 时按长度全局排序（评估用，结果与顺序无关）
+
+    num_replicas > 1 时（数据并行）各进程用相同的种子生成同一个批次序列，rank 轮流取其中的批次；
+    训练时用开头的批次补齐，使每个进程的批次数相同（DDP 每步都要 all-reduce），
+    评估时不补齐，各进程评估不重复的分片
+    """
+
+    def __init__(self, lengths, batch_size, group_batches=50, shuffle=True, seed=42, num_replicas=1, rank=0):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.group_size = batch_size * group_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.num_replicas == 1:
+            return len(self.lengths)
+        # 与 __iter__ 相同的批次结构：满批次、（训练时）补齐的批次、最后一个不满的批次
+        num_full, partial = divmod(len(self.lengths), self.batch_size)
+        sizes = [self.batch_size] * num_full
+        if self.shuffle:
+            padding = -(num_full + bool(partial)) % self.num_replicas
+            sizes += [self.batch_size if num_full else partial] * padding
+        if partial:
+            sizes.append(partial)
+        return sum(sizes[self.rank::self.num_replicas])
+
+    def __iter__(self):
+        if not self.shuffle:
+            order = torch.argsort(self.lengths, descending=True, stable=True)
+            for batch in order.split(self.batch_size)[self.rank::self.num_replicas]:
+                yield from batch.tolist()
+            return
+
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        # 未调用 set_epoch 时每次遍历自动换一个顺序
+        self.epoch += 1
+        indices = torch.randperm(len(self.lengths), generator=generator)
+        batches = []
+        for start in range(0, len(indices), self.group_size):
+            group = indices[start:start + self.group_size]
+            group = group[torch.argsort(self.lengths[group], descending=True, stable=True)]
+            batches.extend(group.split(self.batch_size))
+        # 最后一个不满的批次保持在末尾，其余批次打乱，DataLoader 按 batch_size 切分时批次边界不变
+        full_batches = [batch for batch in batches if len(batch) == self.batch_size]
+        partial = [batch for batch in batches if len(batch) < self.batch_size]
+        order = [full_batches[i] for i in torch.randperm(len(full_batches), generator=generator).tolist()]
+        if self.num_replicas > 1:
+            padding = -len(batches) % self.num_replicas
+            order += [(order or partial)[i % len(order or partial)] for i in range(padding)]
+        order += partial
+        for batch in order[self.rank::self.num_replicas]:
+            yield from batch.tolist()
+
+def dataset_lengths(dataset):
+    """各样本的 token 数；数据集没有记录长度时返回 None，Subset（如交叉验证的一折）取原数据集对应样本的长度"""
+    if isinstance(dataset, Subset):
+        lengths = dataset_lengths(dataset.dataset)
+        return None if lengths is None else torch.as_tensor(lengths)[torch.as_tensor(dataset.indices)]
+    return getattr(dataset, 'lengths', None)
+
+def make_data_loader(dataset, batch_size, shuffle=True, pad_token_id=0, num_workers=0, seed=42,
+                     group_batches=50, num_replicas=1, rank=0):
+    """训练和评估共用的 DataLoader：动态填充，有长度信息时按长度分组采样
+
+    num_replicas > 1 时只返回第 rank 个进程的分片（数据并行）
+    """
+    collate_fn = (
+        collate_cached_features if isinstance(dataset, CachedFeatureDataset)
+        else DynamicPaddingCollator(pad_token_id)
+    )
+    lengths = dataset_lengths(dataset)
+    sampler = None
+    if lengths is not None:
+        sampler = LengthGroupedSampler(lengths, batch_size, group_batches, shuffle, seed, num_replicas, rank)
+        shuffle = False
+    elif num_replicas > 1:
+        sampler = DistributedSampler(dataset, num_replicas, rank, shuffle=shuffle, seed=seed)
+        shuffle = False
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        sampler=sampler,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0
+    )
@@ -0,0 +1,1263 @@
+import argparse
+import copy
+import functools
+import gc
+import json
+import math
+import multiprocessing as mp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
+from transformers import BertTokenizer
+from config import Config
+from data_processor import DataProcessor
+from feature_cache import (
+    CachedFeatureDataset, collate_cached_features, forward_batch, load_or_build_feature_cache
+)
+from model import (
+    PRECISIONS, ChineseSentimentDataset, FusedDimensionHeads, MultiDimensionalSentimentModel, SentimentTrainer,
+    SharedBackboneEnsemble, build_dimension_head, freeze_lower_layers, freeze_unused_modules
+)
+from hyperparameter_tuning import PRUNERS, TrialModelFactory, run_hyperparameter_search
+from cross_validation import kfold_indices, run_cross_validation, run_fold
+from inference_only import load_model
+from predict import (
+    POOLING_METHODS, forward_in_buckets, forward_long_texts, pool_windows, predict_sentiment_batch,
+    split_into_windows, supports_early_exit
+)
+from batching import DynamicPaddingCollator, LengthGroupedSampler, make_data_loader
+import distributed
+from pretokenized import PretokenizedDataset, build_token_shards, load_or_build_token_shards
+from tokenization import TokenIdCache, encode_batch, load_tokenizer
+from training_profiler import TrainingProfiler
+from utils import get_peak_rss_mb, get_rss_mb
+
+def load_texts(data_path, num_samples=None, seed=42):
+    """从 ChnSentiCorp 数据中抽取原始评论文本"""
+    df = pd.read_csv(data_path)
+    texts = df['review'].dropna().astype(str)
+    if num_samples and num_samples < len(texts):
+        texts = texts.sample(n=num_samples, random_state=seed)
+    return texts.tolist()
+
+def load_benchmark_model(model_path):
+    """加载待测模型；检查点不存在时使用未微调的权重（只影响预测数值，不影响速度）"""
+    if model_path and os.path.exists(model_path):
+        model = load_model(model_path)
+    else:
+        print(f"未找到模型文件 {model_path}，使用未微调的权重测速")
+        model = MultiDimensionalSentimentModel()
+    model.eval()
+    return model
+
+def forward_pad_to_max_length(texts, model, tokenizer, device, batch_size=32, max_length=512):
+    """旧的推理路径：每条文本都填充到 max_length"""
+    model.eval()
+    outputs = []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            encoding = tokenizer(
+                texts[start:start + batch_size],
+                add_special_tokens=True,
+                max_length=max_length,
+                padding='max_length',
+                truncation=True,
+                return_tensors='pt'
+            )
+            outputs.append(model(encoding['input_ids'].to(device), encoding['attention_mask'].to(device)))
+    return torch.cat(outputs, dim=0)
+
+def count_bucketed_positions(lengths, batch_size):
+    """计算分桶填充后实际参与计算的位置数"""
+    lengths = sorted(lengths)
+    return sum(
+        max(lengths[start:start + batch_size]) * len(lengths[start:start + batch_size])
+        for start in range(0, len(lengths), batch_size)
+    )
+
+def benchmark_padding(args):
+    """对比填充到512与按长度分桶两种推理路径的吞吐量"""
+    device = torch.device('cpu')
+    tokenizer = load_tokenizer('bert-base-chinese')
+    model = load_benchmark_model(args.model_path).to(device)
+    texts = load_texts(args.data_path, args.num_samples)
+
+    lengths = [
+        len(ids) for ids in
+        tokenizer(texts, add_special_tokens=True, max_length=args.max_length, truncation=True)['input_ids']
+    ]
+    real_tokens = sum(lengths)
+    positions = {
+        'pad_to_max_length': args.max_length * len(texts),
+        'length_bucketed': count_bucketed_positions(lengths, args.batch_size),
+    }
+    print(f"样本数: {len(texts)}  平均长度: {real_tokens / len(texts):.1f} tokens")
+
+    paths = [
+        ('pad_to_max_length', forward_pad_to_max_length),
+        ('length_bucketed', forward_in_buckets),
+    ]
+    timings = {}
+    outputs = {}
+    for name, forward_fn in paths:
+        # 预热一个批次
+        forward_fn(texts[:args.batch_size], model, tokenizer, device, args.batch_size, args.max_length)
+        start = time.perf_counter()
+        outputs[name] = forward_fn(texts, model, tokenizer, device, args.batch_size, args.max_length)
+        timings[name] = time.perf_counter() - start
+
+    print(f"\n{'路径':<20}{'耗时(s)':>10}{'tokens/s':>12}{'texts/s':>10}{'有效位置占比':>14}")
+    for name, _ in paths:
+        elapsed = timings[name]
+        print(f"{name:<20}{elapsed:>10.2f}{real_tokens / elapsed:>12.1f}"
+              f"{len(texts) / elapsed:>10.1f}{real_tokens / positions[name]:>14.1%}")
+
+    max_diff = (outputs['pad_to_max_length'] - outputs['length_bucketed']).abs().max().item()
+    print(f"\n加速比: {timings['pad_to_max_length'] / timings['length_bucketed']:.2f}x")
+    print(f"两种路径输出最大差异: {max_diff:.2e}")
+
+def measure_latency(model, tokenizer, texts, batch_size, iterations, device=torch.device('cpu')):
+    """测量固定批大小下的单批延迟（秒）"""
+    # 循环取样，保证每个批次都恰好有 batch_size 条文本
+    batches = [
+        [texts[(i * batch_size + j) % len(texts)] for j in range(batch_size)]
+        for i in range(iterations)
+    ]
+    forward_in_buckets(batches[0], model, tokenizer, device, batch_size)  # 预热
+    latencies = []
+    for batch in batches:
+        start = time.perf_counter()
+        forward_in_buckets(batch, model, tokenizer, device, batch_size)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def print_latency_table(results, batch_sizes):
+    """打印各后端在不同批大小下的延迟/吞吐对比"""
+    print(f"\n{'后端':<12}{'batch':>6}{'平均延迟(ms)':>14}{'p95(ms)':>10}{'texts/s':>10}")
+    for name, latencies_by_size in results.items():
+        for batch_size in batch_sizes:
+            latencies = sorted(latencies_by_size[batch_size])
+            mean = sum(latencies) / len(latencies)
+            p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+            print(f"{name:<12}{batch_size:>6}{1000 * mean:>14.1f}{1000 * p95:>10.1f}{batch_size / mean:>10.1f}")
+
+def benchmark_onnx(args):
+    """ONNX Runtime 后端与 PyTorch 的输出一致性及延迟/吞吐对比"""
+    from onnx_backend import OnnxSentimentModel, export_onnx
+
+    tokenizer = load_tokenizer('bert-base-chinese')
+    torch_model = load_benchmark_model(args.model_path)
+    if not os.path.exists(args.onnx_path):
+        export_onnx(torch_model, args.onnx_path)
+    onnx_model = OnnxSentimentModel(args.onnx_path)
+    texts = load_texts(args.data_path, max(args.num_samples, max(args.batch_sizes)))
+    device = torch.device('cpu')
+
+    # 一致性检查
+    parity_texts = texts[:args.num_samples]
+    expected = forward_in_buckets(parity_texts, torch_model, tokenizer, device, batch_size=8)
+    actual = forward_in_buckets(parity_texts, onnx_model, tokenizer, device, batch_size=8)
+    max_diff = (expected - actual).abs().max().item()
+    agreement = (expected.argmax(dim=1) == actual.argmax(dim=1)).float().mean().item()
+    passed = max_diff <= args.tolerance and agreement == 1.0
+    print(f"一致性检查 ({len(parity_texts)} 条 ChnSentiCorp 样本): "
+          f"最大差异 {max_diff:.2e}, 预测一致率 {agreement:.2%} -> {'通过' if passed else '失败'}")
+
+    results = {}
+    for name, model in [('torch', torch_model), ('onnxruntime', onnx_model)]:
+        results[name] = {
+            batch_size: measure_latency(model, tokenizer, texts, batch_size, args.iterations)
+            for batch_size in args.batch_sizes
+        }
+    print_latency_table(results, args.batch_sizes)
+
+    if not passed:
+        sys.exit(1)
+
+def _process_memory_mb(pid):
+    """读取 /proc/<pid>/smaps_rollup 中的 Rss 与 Pss（MB），Pss 会把共享页按共享进程数均摊"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                values[key] = int(rest.split()[0]) / 1024
+    return values['Rss'], values['Pss']
+
+def _process_private_mb(pid):
+    """进程独占的内存（MB）：smaps_rollup 中 Private_Clean + Private_Dirty，不含与其他进程共享的页"""
+    total = 0
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('Private_Clean', 'Private_Dirty'):
+                total += int(rest.split()[0])
+    return total / 1024
+
+def _child_pids(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+def _post_json(url, payload):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    with urllib.request.urlopen(request, timeout=600) as response:
+        return json.loads(response.read())
+
+def _wait_for_server(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5):
+                return
+        except OSError:
+            time.sleep(1)
+    raise TimeoutError(f"服务在 {timeout} 秒内未启动: {url}")
+
+def benchmark_prefork(args):
+    """测量预派生服务在不同工作进程数下的总内存，验证权重在进程间共享"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve_prefork.py')
+    texts = load_texts(args.data_path, 256)
+    base_url = f'http://127.0.0.1:{args.port}'
+
+    rows = []
+    for workers in args.workers:
+        process = subprocess.Popen(
+            [sys.executable, script, '--host', '127.0.0.1', '--port', str(args.port),
+             '--workers', str(workers), '--threads-per-worker', str(args.threads_per_worker)],
+            stdout=subprocess.DEVNULL
+        )
+        try:
+            _wait_for_server(base_url + '/', args.startup_timeout)
+            # 并发发送请求，确保每个工作进程都真正执行过推理
+            with ThreadPoolExecutor(max_workers=workers * 2) as pool:
+                list(pool.map(
+                    lambda text: _post_json(base_url + '/predict', {'text': text}),
+                    texts[:workers * args.requests_per_worker]
+                ))
+
+            memory = [_process_memory_mb(pid) for pid in [process.pid] + _child_pids(process.pid)]
+            rows.append((workers, sum(rss for rss, _ in memory), sum(pss for _, pss in memory)))
+        finally:
+            process.terminate()
+            process.wait()
+
+    base_workers, _, base_pss = rows[0]
+    print(f"\n{'工作进程数':<10}{'RSS合计(MB)':>14}{'PSS合计(MB)':>14}{'每个额外进程PSS(MB)':>22}{'独立进程预估(MB)':>20}")
+    for workers, rss, pss in rows:
+        extra = (pss - base_pss) / (workers - base_workers) if workers != base_workers else float('nan')
+        # 不共享权重时，每个工作进程都要完整占用一份内存
+        independent = base_pss / base_workers * workers
+        print(f"{workers:<10}{rss:>14.0f}{pss:>14.0f}{extra:>22.0f}{independent:>20.0f}")
+    print("\nRSS 合计会把共享页重复计算；PSS 合计才是实际占用的物理内存")
+
+def _startup_variant(variant, model_path, result_queue):
+    """在独立进程中测量一种加载方式从零到完成首次预测的耗时和峰值内存"""
+    start = time.perf_counter()
+    timings = {}
+    if variant == 'legacy':
+        # 旧路径：先从预训练权重构建模型，再用微调权重整体覆盖
+        stage_start = time.perf_counter()
+        model = MultiDimensionalSentimentModel()
+        timings['from_pretrained'] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
+        model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu'), weights_only=True))
+        timings['load_state_dict'] = time.perf_counter() - stage_start
+    else:
+        model = load_model(model_path, timings=timings)
+    model.eval()
+
+    stage_start = time.perf_counter()
+    tokenizer = load_tokenizer('bert-base-chinese')
+    timings['tokenizer'] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    predict_sentiment_batch(['预热'], model, tokenizer, torch.device('cpu'))
+    timings['first_prediction'] = time.perf_counter() - stage_start
+
+    result_queue.put({
+        'timings': timings,
+        'time_to_first_prediction': time.perf_counter() - start,
+        'peak_rss_mb': get_peak_rss_mb()
+    })
+
+def benchmark_startup(args):
+    """对比旧加载路径与按配置构建 + 内存映射加载的冷启动耗时和峰值内存"""
+    # 先完整读一遍检查点，让两种方式都从热的页缓存开始
+    with open(args.model_path, 'rb') as f:
+        while f.read(64 * 1024 * 1024):
+            pass
+
+    ctx = mp.get_context('spawn')
+    results = {}
+    for variant in ['legacy', 'fast']:
+        result_queue = ctx.Queue()
+        process = ctx.Process(target=_startup_variant, args=(variant, args.model_path, result_queue))
+        process.start()
+        results[variant] = result_queue.get()
+        process.join()
+
+    for variant, result in results.items():
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result['timings'].items())
+        print(f"{variant:<8} 首次预测耗时 {result['time_to_first_prediction']:.2f}s  "
+              f"峰值内存 {result['peak_rss_mb']:.0f} MB  ({stages})")
+    print(f"\n启动加速: {results['legacy']['time_to_first_prediction'] / results['fast']['time_to_first_prediction']:.2f}x  "
+          f"峰值内存降低: {1 - results['fast']['peak_rss_mb'] / results['legacy']['peak_rss_mb']:.1%}")
+
+def benchmark_early_exit(args):
+    """在 ChnSentiCorp 测试集上比较不同提前退出阈值下的准确率与平均计算层数"""
+    model = load_model(args.early_exit_model_path)
+    model.eval()
+    if not supports_early_exit(model):
+        sys.exit(f"{args.early_exit_model_path} 没有提前退出头，请先运行 early_exit.py 训练")
+    tokenizer = load_tokenizer('bert-base-chinese')
+    device = torch.device('cpu')
+
+    _, test_df = DataProcessor().process_data(args.data_path, balance_data=False)
+    if args.num_samples and args.num_samples < len(test_df):
+        test_df = test_df.sample(n=args.num_samples, random_state=42)
+    texts = test_df['cleaned_text'].tolist()
+    labels = torch.tensor(test_df['label'].astype(int).tolist())
+    num_layers = model.bert.config.num_hidden_layers
+    print(f"测试样本数: {len(texts)}  退出层: {model.exit_layers}  总层数: {num_layers}")
+
+    forward_in_buckets(texts[:args.batch_size], model, tokenizer, device, args.batch_size)  # 预热
+    print(f"\n{'阈值':<10}{'准确率':>10}{'平均层数':>10}{'计算量占比':>12}{'texts/s':>10}  各层退出比例")
+    for threshold in [None] + sorted(args.thresholds):
+        start = time.perf_counter()
+        outputs, exit_layers = forward_in_buckets(
+            texts, model, tokenizer, device, args.batch_size,
+            exit_threshold=threshold, return_exit_layers=True
+        )
+        elapsed = time.perf_counter() - start
+        accuracy = (outputs.argmax(dim=1) == labels).float().mean().item()
+        average_layers = exit_layers.float().mean().item()
+        distribution = ", ".join(
+            f"{layer}:{(exit_layers == layer).float().mean().item():.0%}"
+            for layer in model.exit_layers + [num_layers]
+        )
+        name = 'full' if threshold is None else f"{threshold:g}"
+        print(f"{name:<10}{accuracy:>10.2%}{average_layers:>10.2f}{average_layers / num_layers:>12.1%}"
+              f"{len(texts) / elapsed:>10.1f}  {distribution}")
+
+def _time_per_call(fn, features, iterations):
+    with torch.no_grad():
+        fn(features)  # 预热
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn(features)
+    return (time.perf_counter() - start) / iterations
+
+def benchmark_fused_heads(args):
+    """逐个分类头循环 vs 合并分类头：数值一致性与延迟"""
+    torch.manual_seed(0)
+    passed = True
+
+    print(f"{'维度数':<8}{'batch':>6}{'循环(ms)':>12}{'合并(ms)':>12}{'加速比':>10}{'最大差异':>12}")
+    for num_dimensions in args.num_dimensions:
+        heads = nn.ModuleList([build_dimension_head(args.hidden_size) for _ in range(num_dimensions)]).eval()
+        fused = FusedDimensionHeads.from_heads(heads).eval()
+
+        def loop(features, heads=heads):
+            return torch.cat([head(features) for head in heads], dim=1)
+
+        for batch_size in args.batch_sizes:
+            features = torch.randn(batch_size, args.hidden_size)
+            with torch.no_grad():
+                max_diff = (loop(features) - fused(features)).abs().max().item()
+            passed &= max_diff <= args.tolerance
+            loop_time = _time_per_call(loop, features, args.iterations)
+            fused_time = _time_per_call(fused, features, args.iterations)
+            print(f"{num_dimensions:<8}{batch_size:>6}{1000 * loop_time:>12.3f}{1000 * fused_time:>12.3f}"
+                  f"{loop_time / fused_time:>10.2f}{max_diff:>12.2e}")
+
+    # 完整模型：原结构与 fuse_heads() 之后的输出一致性和端到端延迟
+    tokenizer = load_tokenizer('bert-base-chinese')
+    model = load_benchmark_model(args.model_path)
+    fused_model = copy.deepcopy(model).fuse_heads().eval()
+    texts = load_texts(args.data_path, args.num_samples)
+    device = torch.device('cpu')
+    expected = forward_in_buckets(texts, model, tokenizer, device, batch_size=8)
+    actual = forward_in_buckets(texts, fused_model, tokenizer, device, batch_size=8)
+    max_diff = (expected - actual).abs().max().item()
+    agreement = (expected.argmax(dim=1) == actual.argmax(dim=1)).float().mean().item()
+    passed &= max_diff <= args.tolerance and agreement == 1.0
+    print(f"\n完整模型一致性 ({len(texts)} 条 ChnSentiCorp 样本): "
+          f"最大差异 {max_diff:.2e}, 预测一致率 {agreement:.2%} -> {'通过' if passed else '失败'}")
+
+    results = {
+        name: {
+            batch_size: measure_latency(m, tokenizer, texts, batch_size, args.iterations // 10 or 1)
+            for batch_size in args.batch_sizes
+        }
+        for name, m in [('loop_heads', model), ('fused_heads', fused_model)]
+    }
+    print_latency_table(results, args.batch_sizes)
+
+    if not passed:
+        sys.exit(1)
+
+class _FullCopyEnsemble(nn.Module):
+    """旧 EnsembleModel 的计算方式：每个成员都是完整模型，依次对同一输入前向"""
+
+    def __init__(self, models):
+        super().__init__()
+        self.models = nn.ModuleList(models)
+
+    def forward(self, input_ids, attention_mask):
+        outputs = torch.stack([model(input_ids, attention_mask) for model in self.models])
+        return torch.logsumexp(outputs, dim=0) - math.log(len(self.models))
+
+def benchmark_ensemble(args):
+    """N 个完整模型的集成 vs 共享底层的集成：参数量与延迟"""
+    tokenizer = load_tokenizer('bert-base-chinese')
+    model = load_benchmark_model(args.model_path)
+    texts = load_texts(args.data_path, max(args.batch_sizes) * 4)
+
+    shared = SharedBackboneEnsemble.from_model(model, args.num_members, args.num_shared_layers).eval()
+    shared_serial = copy.deepcopy(shared)
+    shared_serial.parallel = False
+    variants = [
+        ('full_copies', _FullCopyEnsemble([copy.deepcopy(model) for _ in range(args.num_members)]).eval()),
+        ('shared_serial', shared_serial),
+        ('shared_parallel', shared),
+    ]
+
+    num_layers = model.bert.config.num_hidden_layers
+    print(f"成员数: {args.num_members}  共享层数: {args.num_shared_layers}/{num_layers}")
+    for name, ensemble in variants:
+        params = sum(p.numel() for p in ensemble.parameters())
+        print(f"{name:<16} 参数量 {params / 1e6:>8.1f}M")
+
+    results = {
+        name: {
+            batch_size: measure_latency(ensemble, tokenizer, texts, batch_size, args.iterations)
+            for batch_size in args.batch_sizes
+        }
+        for name, ensemble in variants
+    }
+    print_latency_table(results, args.batch_sizes)
+
+def _train_one_epoch(model, loader, optimizer, device, stats=None):
+    """训练一个 epoch 并返回耗时；stats 传入字典时累加真实 token 数和参与计算的位置数"""
+    model.train()
+    criterion = nn.CrossEntropyLoss()
+    start = time.perf_counter()
+    for batch in loader:
+        if stats is not None:
+            stats['tokens'] = stats.get('tokens', 0) + int(batch['attention_mask'].sum())
+            stats['positions'] = stats.get('positions', 0) + batch['attention_mask'].numel()
+        batch = {k: v.to(device) for k, v in batch.items()}
+        optimizer.zero_grad()
+        loss = criterion(forward_batch(model, batch, Config.NUM_FROZEN_LAYERS), batch['labels'])
+        loss.backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+def benchmark_feature_cache(args):
+    """冻结层缓存：生成耗时、磁盘占用，以及完整前向 vs 从缓存开始的每 epoch 训练耗时"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = load_tokenizer(Config.MODEL_NAME)
+    df = pd.read_csv(args.data_path).dropna(subset=['review'])
+    df = df.sample(n=min(args.num_samples, len(df)), random_state=42)
+    texts = df['review'].astype(str).tolist()
+    labels = df['label'].astype(int).tolist()
+
+    model = load_benchmark_model(args.model_path)
+    freeze_lower_layers(model, Config.NUM_FROZEN_LAYERS).to(device)
+    initial_state = copy.deepcopy(model.state_dict())
+
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix='feature_cache_')
+    try:
+        start = time.perf_counter()
+        cache = load_or_build_feature_cache(
+            model, tokenizer, texts, cache_dir, args.model_path, Config.NUM_FROZEN_LAYERS,
+            args.max_length, args.batch_size, args.dtype, device
+        )
+        build_seconds = time.perf_counter() - start
+        cache_mb = sum(
+            os.path.getsize(os.path.join(cache.path, name)) for name in os.listdir(cache.path)
+        ) / 1024 / 1024
+
+        # 两种方式都按批内最长序列填充，差异只来自是否重算冻结层
+        def collate_tokens(batch):
+            batch_texts, batch_labels = zip(*batch)
+            encoding = tokenizer(list(batch_texts), max_length=args.max_length, padding='longest',
+                                 truncation=True, return_tensors='pt')
+            return {
+                'input_ids': encoding['input_ids'],
+                'attention_mask': encoding['attention_mask'],
+                'labels': torch.tensor(batch_labels, dtype=torch.long)
+            }
+
+        loaders = [
+            ('full_forward', DataLoader(list(zip(texts, labels)), batch_size=args.batch_size, shuffle=True,
+                                        collate_fn=collate_tokens)),
+            ('cached', DataLoader(CachedFeatureDataset(cache, labels), batch_size=args.batch_size, shuffle=True,
+                                  collate_fn=collate_cached_features)),
+        ]
+        epoch_seconds = {}
+        for name, loader in loaders:
+            model.load_state_dict(initial_state)
+            optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=Config.LEARNING_RATE)
+            epoch_seconds[name] = [_train_one_epoch(model, loader, optimizer, device) for _ in range(args.epochs)]
+    finally:
+        if not args.cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    num_layers = model.bert.config.num_hidden_layers
+    print(f"样本数: {len(texts)}  冻结层数: {Config.NUM_FROZEN_LAYERS}/{num_layers}  设备: {device}")
+    print(f"缓存生成耗时: {build_seconds:.1f}s  磁盘占用: {cache_mb:.1f}MB ({args.dtype})")
+    print(f"{'方式':<14}{'每 epoch 耗时(s)':>18}")
+    for name, seconds in epoch_seconds.items():
+        print(f"{name:<14}{sum(seconds) / len(seconds):>18.2f}")
+    full = sum(epoch_seconds['full_forward']) / args.epochs
+    cached = sum(epoch_seconds['cached']) / args.epochs
+    print(f"每 epoch 加速: {full / cached:.2f}x")
+    if full > cached:
+        print(f"缓存生成耗时约在 {build_seconds / (full - cached):.1f} 个 epoch 后收回")
+
+def build_long_documents(texts, tokenizer, num_tokens, num_docs):
+    """把评论依次拼接成约 num_tokens 个 token 的长文档"""
+    documents = []
+    pieces, length = [], 0
+    for text in texts * (num_tokens * num_docs // max(1, len(texts)) + 1):
+        pieces.append(text)
+        length += len(tokenizer.tokenize(text))
+        if length >= num_tokens:
+            documents.append(''.join(pieces))
+            pieces, length = [], 0
+            if len(documents) == num_docs:
+                break
+    return documents
+
+def forward_windows_sequential(texts, model, tokenizer, device, max_length, stride, pooling):
+    """逐个窗口单独调用模型，作为批量窗口推理的对照"""
+    outputs = []
+    with torch.no_grad():
+        for text in texts:
+            token_ids = tokenizer(text, add_special_tokens=False, verbose=False)['input_ids']
+            windows = split_into_windows(token_ids, max_length - 2, stride)
+            window_outputs = []
+            for window in windows:
+                input_ids = torch.tensor([[tokenizer.cls_token_id] + window + [tokenizer.sep_token_id]], device=device)
+                window_outputs.append(model(input_ids, torch.ones_like(input_ids)))
+            outputs.append(pool_windows(
+                torch.cat(window_outputs), torch.zeros(len(windows), dtype=torch.long, device=device), 1,
+                pooling, torch.tensor([len(window) for window in windows])
+            ))
+    return torch.cat(outputs)
+
+def benchmark_long_text(args):
+    """长文本滑动窗口：逐窗口调用 vs 所有窗口批量前向，耗时随文档长度的变化"""
+    tokenizer = load_tokenizer('bert-base-chinese')
+    model = load_benchmark_model(args.model_path)
+    device = torch.device('cpu')
+    texts = load_texts(args.data_path, 2000)
+
+    print(f"窗口长度: {args.max_length}  重叠: {args.stride}  聚合: {args.pooling}  每组文档数: {args.num_docs}")
+    print(f"{'文档token数':>12}{'窗口数/篇':>10}{'逐窗口(s/篇)':>14}{'批量(s/篇)':>12}{'加速比':>8}{'最大差异':>12}")
+    for num_tokens in args.doc_tokens:
+        documents = build_long_documents(texts, tokenizer, num_tokens, args.num_docs)
+
+        start = time.perf_counter()
+        sequential = forward_windows_sequential(documents, model, tokenizer, device, args.max_length, args.stride,
+                                                args.pooling)
+        sequential_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched, _, num_windows = forward_long_texts(documents, model, tokenizer, device, args.batch_size,
+                                                     args.max_length, args.stride, args.pooling)
+        batched_seconds = time.perf_counter() - start
+
+        max_diff = (sequential - batched).abs().max().item()
+        print(f"{num_tokens:>12}{num_windows.float().mean().item():>10.1f}"
+              f"{sequential_seconds / len(documents):>14.3f}{batched_seconds / len(documents):>12.3f}"
+              f"{sequential_seconds / batched_seconds:>8.2f}x{max_diff:>12.2e}")
+
+def _time_tokenizer(fn, texts, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn(texts)
+    return (time.perf_counter() - start) / repeats, result
+
+def benchmark_tokenizer(args):
+    """分词：BertTokenizer 逐条 vs 快速分词器批量编码（含 token id 缓存），并逐 token 核对结果"""
+    slow = BertTokenizer.from_pretrained('bert-base-chinese')
+    fast = load_tokenizer('bert-base-chinese')
+    cached = copy.copy(fast)
+    cached.token_id_cache = TokenIdCache(args.cache_size)
+    texts = load_texts(args.data_path, args.num_samples)
+
+    # 逐 token 核对：截断模式和长文本（不加特殊 token、不截断）模式
+    expected = [slow(text, max_length=args.max_length, truncation=True)['input_ids'] for text in texts]
+    expected_raw = [slow(text, add_special_tokens=False, verbose=False)['input_ids'] for text in texts]
+    mismatches = 0
+    for tokenizer in (fast, cached):
+        for _ in range(2):  # 缓存版第二遍全部命中
+            mismatches += sum(a != b for a, b in zip(expected, encode_batch(tokenizer, texts, args.max_length)))
+            mismatches += sum(a != b for a, b in zip(
+                expected_raw, encode_batch(tokenizer, texts, add_special_tokens=False)
+            ))
+    print(f"样本数: {len(texts)}  逐 token 不一致的条数: {mismatches}")
+
+    variants = [
+        ('slow_per_text', lambda batch: [
+            slow(text, max_length=args.max_length, truncation=True)['input_ids'] for text in batch
+        ]),
+        ('fast_per_text', lambda batch: [encode_batch(fast, [text], args.max_length)[0] for text in batch]),
+        ('fast_batch', lambda batch: encode_batch(fast, batch, args.max_length)),
+        ('fast_cached', lambda batch: encode_batch(cached, batch, args.max_length)),
+    ]
+    print(f"{'方式':<16}{'总耗时(ms)':>12}{'每条(us)':>12}{'加速比':>8}")
+    baseline = None
+    for name, fn in variants:
+        seconds, _ = _time_tokenizer(fn, texts, args.repeats)
+        baseline = baseline or seconds
+        print(f"{name:<16}{seconds * 1000:>12.1f}{seconds / len(texts) * 1e6:>12.1f}{baseline / seconds:>7.1f}x")
+    print(f"token id 缓存: {cached.token_id_cache.stats()}")
+    if mismatches:
+        sys.exit(1)
+
+class _PerItemTokenizedDataset(Dataset):
+    """每次取样本时单独分词并填充到 max_length，作为离线分词分片的对照"""
+
+    def __init__(self, texts, labels, tokenizer, max_length=512):
+        self.texts = texts
+        self.labels = labels
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, idx):
+        encoding = self.tokenizer(self.texts[idx], max_length=self.max_length, padding='max_length',
+                                  truncation=True, return_tensors='pt')
+        return {
+            'input_ids': encoding['input_ids'].flatten(),
+            'attention_mask': encoding['attention_mask'].flatten(),
+            'labels': torch.tensor(self.labels[idx], dtype=torch.long)
+        }
+
+def _iterate_epoch(loader):
+    """遍历一个 epoch 的数据（不做前向），返回 (耗时, 各 worker 的独占内存之和 MB, Pss 之和 MB)"""
+    start = time.perf_counter()
+    for _ in loader:
+        pass
+    seconds = time.perf_counter() - start
+    # persistent_workers=True，遍历结束后 worker 仍在，可以读取其内存
+    pids = _child_pids(os.getpid())
+    return (seconds, sum(_process_private_mb(pid) for pid in pids),
+            sum(_process_memory_mb(pid)[1] for pid in pids))
+
+def benchmark_pretokenized(args):
+    """训练数据加载：逐条分词 / 内存中预分词 / 内存映射分词分片 的每 epoch 耗时与 worker 内存"""
+    tokenizer = load_tokenizer('bert-base-chinese')
+    texts = load_texts(args.data_path)
+    # 重复 ChnSentiCorp 评论，模拟 main.py 使用的 10 万条 nCoV 训练集规模
+    texts = (texts * (args.num_samples // len(texts) + 1))[:args.num_samples]
+    labels = [i % 3 for i in range(len(texts))]
+    collate_fn = DynamicPaddingCollator(tokenizer.pad_token_id, pad_to=args.max_length)
+
+    shards_dir = args.shards_dir or tempfile.mkdtemp(prefix='token_shards_')
+    try:
+        start = time.perf_counter()
+        shard_dataset = load_or_build_token_shards(tokenizer, texts, labels, shards_dir, args.max_length)
+        build_seconds = time.perf_counter() - start
+        shard_mb = sum(
+            os.path.getsize(os.path.join(shard_dataset.path, name)) for name in os.listdir(shard_dataset.path)
+        ) / 1024 / 1024
+        print(f"样本数: {len(texts)}  worker 数: {args.num_workers}  批大小: {args.batch_size}")
+        print(f"分片生成耗时: {build_seconds:.1f}s  磁盘占用: {shard_mb:.1f}MB")
+
+        variants = [
+            ('tokenize_per_item', lambda: _PerItemTokenizedDataset(texts, labels, tokenizer, args.max_length), None),
+            ('in_memory', lambda: ChineseSentimentDataset(texts, labels, tokenizer, args.max_length), None),
+            ('mmap_shards', lambda: shard_dataset, collate_fn),
+        ]
+        print(f"\n{'方式':<20}{'准备(s)':>10}{'每 epoch(s)':>14}{'worker 独占(MB)':>16}{'worker Pss(MB)':>16}")
+        for name, make_dataset, variant_collate_fn in variants:
+            start = time.perf_counter()
+            dataset = make_dataset()
+            setup_seconds = time.perf_counter() - start
+            loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, collate_fn=variant_collate_fn,
+                                num_workers=args.num_workers, persistent_workers=True)
+            epochs = [_iterate_epoch(loader) for _ in range(args.epochs)]
+            # 第一个 epoch 包含 worker 启动，取最后一个 epoch
+            seconds, private, pss = epochs[-1]
+            print(f"{name:<20}{setup_seconds:>10.1f}{seconds:>14.2f}{private:>16.0f}{pss:>16.0f}")
+            del loader, dataset
+            gc.collect()
+    finally:
+        if not args.shards_dir:
+            shutil.rmtree(shards_dir, ignore_errors=True)
+
+def benchmark_dynamic_padding(args):
+    """训练：填充到 max_length vs 动态填充 vs 动态填充 + 按长度分组采样，每 epoch 耗时和 tokens/s"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = load_tokenizer('bert-base-chinese')
+    df = pd.read_csv(args.data_path).dropna(subset=['review'])
+    df = df.sample(n=min(args.num_samples, len(df)), random_state=42)
+    dataset = ChineseSentimentDataset(
+        df['review'].astype(str).tolist(), df['label'].astype(int).tolist(), tokenizer, args.max_length
+    )
+
+    model = load_benchmark_model(args.model_path)
+    freeze_lower_layers(model, Config.NUM_FROZEN_LAYERS).to(device)
+    initial_state = copy.deepcopy(model.state_dict())
+
+    collator = DynamicPaddingCollator(tokenizer.pad_token_id)
+    loaders = [
+        ('pad_to_max_length', DataLoader(dataset, batch_size=args.batch_size, shuffle=True)),
+        ('dynamic_padding', DataLoader(dataset, batch_size=args.batch_size, shuffle=True, collate_fn=collator)),
+        ('length_grouped', DataLoader(
+            dataset, batch_size=args.batch_size, collate_fn=collator,
+            sampler=LengthGroupedSampler(dataset.lengths, args.batch_size, args.group_batches)
+        )),
+    ]
+    print(f"样本数: {len(dataset)}  平均长度: {sum(dataset.lengths) / len(dataset):.1f}  "
+          f"批大小: {args.batch_size}  设备: {device}")
+    print(f"{'方式':<20}{'每 epoch(s)':>12}{'tokens/s':>12}{'有效位置占比':>14}{'加速比':>8}")
+    baseline = None
+    for name, loader in loaders:
+        model.load_state_dict(initial_state)
+        optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=Config.LEARNING_RATE)
+        stats = {}
+        seconds = sum(_train_one_epoch(model, loader, optimizer, device, stats) for _ in range(args.epochs))
+        seconds /= args.epochs
+        baseline = baseline or seconds
+        print(f"{name:<20}{seconds:>12.2f}{stats['tokens'] / args.epochs / seconds:>12.0f}"
+              f"{stats['tokens'] / stats['positions']:>14.1%}{baseline / seconds:>7.2f}x")
+
+class _PeakMemoryMonitor:
+    """测量一段代码的峰值内存增量（MB）：CUDA 上读取显存峰值，CPU 上用后台线程每隔 interval 秒采样 RSS"""
+
+    def __init__(self, device, interval=0.005):
+        self.device = device
+        self.interval = interval
+        self.peak_mb = 0.0
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self._base = torch.cuda.memory_allocated() / 1024 / 1024
+            return self
+        gc.collect()
+        self._base = get_rss_mb()
+        self._peak = self._base
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, get_rss_mb())
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+            self.peak_mb = torch.cuda.max_memory_allocated() / 1024 / 1024 - self._base
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak_mb = max(self._peak, get_rss_mb()) - self._base
+        return False
+
+def benchmark_trainer(args):
+    """训练引擎：原 fp32 训练循环 vs SentimentTrainer（fp32 / bf16 / bf16 + 梯度累积）的吞吐和峰值内存"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = load_tokenizer('bert-base-chinese')
+    df = pd.read_csv(args.data_path).dropna(subset=['review'])
+    df = df.sample(n=min(args.num_samples, len(df)), random_state=42)
+    dataset = ChineseSentimentDataset(
+        df['review'].astype(str).tolist(), df['label'].astype(int).tolist(), tokenizer, args.max_length
+    )
+
+    model = load_benchmark_model(args.model_path)
+    freeze_lower_layers(model, Config.NUM_FROZEN_LAYERS).to(device)
+    initial_state = copy.deepcopy(model.state_dict())
+    low_precision = 'fp16' if device.type == 'cuda' and not torch.cuda.is_bf16_supported() else 'bf16'
+    micro_batch_size = max(1, args.batch_size // args.accumulation_steps)
+    variants = [
+        ('原训练循环 fp32', None, args.batch_size, 1),
+        ('SentimentTrainer fp32', 'fp32', args.batch_size, 1),
+        (f'SentimentTrainer {low_precision}', low_precision, args.batch_size, 1),
+        (f'{low_precision} + 梯度累积x{args.accumulation_steps}', low_precision, micro_batch_size,
+         args.accumulation_steps),
+    ]
+
+    print(f"样本数: {len(dataset)}  等效批大小: {args.batch_size}  设备: {device}")
+    print(f"{'方式':<28}{'samples/s':>12}{'峰值内存增量(MB)':>18}{'加速比':>8}")
+    baseline = None
+    for name, precision, batch_size, accumulation_steps in variants:
+        model.load_state_dict(initial_state)
+        optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=Config.LEARNING_RATE)
+        loader = make_data_loader(dataset, batch_size, shuffle=True, pad_token_id=tokenizer.pad_token_id)
+        # 预热一个批次，排除首次分配和算子初始化
+        warmup = next(iter(DataLoader(dataset, batch_size=2, collate_fn=DynamicPaddingCollator(tokenizer.pad_token_id))))
+        warmup = {k: v.to(device) for k, v in warmup.items()}
+        with torch.no_grad():
+            forward_batch(model, warmup)
+
+        with _PeakMemoryMonitor(device) as memory:
+            if precision is None:
+                seconds = sum(_train_one_epoch(model, loader, optimizer, device) for _ in range(args.epochs))
+            else:
+                trainer = SentimentTrainer(model, optimizer, device, precision=precision,
+                                           accumulation_steps=accumulation_steps)
+                start = time.perf_counter()
+                for _ in range(args.epochs):
+                    trainer.train_epoch(loader, progress=False)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                seconds = time.perf_counter() - start
+        throughput = len(dataset) * args.epochs / seconds
+        baseline = baseline or throughput
+        print(f"{name:<28}{throughput:>12.1f}{memory.peak_mb:>18.0f}{throughput / baseline:>7.2f}x")
+
+def _seconds_to_reach(study, target, start_time):
+    """研究的最佳验证损失第一次不高于 target 时距离开始的秒数，未达到时返回 None"""
+    finished = sorted(
+        (trial for trial in study.trials if trial.value is not None and trial.datetime_complete is not None
+         and trial.state.name == 'COMPLETE'),
+        key=lambda trial: trial.datetime_complete
+    )
+    best = float('inf')
+    for trial in finished:
+        best = min(best, trial.value)
+        if best <= target:
+            return trial.datetime_complete.timestamp() - start_time
+    return None
+
+def benchmark_hpo(args):
+    """超参数搜索：逐个试验不剪枝 vs 按 epoch 剪枝 vs 剪枝 + 多进程并行，总耗时和达到相同最佳验证损失的耗时"""
+    import optuna
+
+    tokenizer = load_tokenizer('bert-base-chinese')
+    df = pd.read_csv(args.data_path).dropna(subset=['review'])
+    df = df.sample(n=min(args.num_samples, len(df)), random_state=42)
+    split = int(len(df) * 0.8)
+    train_dataset, valid_dataset = (
+        ChineseSentimentDataset(part['review'].astype(str).tolist(), part['label'].astype(int).tolist(),
+                                tokenizer, args.max_length)
+        for part in (df.iloc[:split], df.iloc[split:])
+    )
+    # 工作进程用 spawn 启动，模型工厂需要能被 pickle
+    model_factory = functools.partial(load_benchmark_model, args.model_path)
+
+    variants = [
+        ('逐个试验，不剪枝', 'none', 1),
+        (f'{args.pruner} 剪枝', args.pruner, 1),
+        (f'{args.pruner} 剪枝 + {args.n_jobs} 进程', args.pruner, args.n_jobs),
+    ]
+    storage_dir = tempfile.mkdtemp(prefix='hpo-benchmark-')
+    results = []
+    try:
+        for i, (name, pruner, n_jobs) in enumerate(variants):
+            storage = f'sqlite:///{os.path.join(storage_dir, f"study_{i}.db")}'
+            start = time.time()
+            run_hyperparameter_search(
+                train_dataset, valid_dataset, n_trials=args.n_trials, n_jobs=n_jobs, storage=storage,
+                study_name='benchmark', pruner=pruner, max_epochs=args.epochs, model_factory=model_factory
+            )
+            elapsed = time.time() - start
+            study = optuna.load_study(study_name='benchmark', storage=storage)
+            pruned = sum(trial.state.name == 'PRUNED' for trial in study.trials)
+            results.append((name, study, start, elapsed, pruned))
+    finally:
+        shutil.rmtree(storage_dir, ignore_errors=True)
+
+    # 以不剪枝搜索的最佳验证损失为目标，允许 tolerance 的相对误差
+    target = results[0][1].best_value * (1 + args.tolerance)
+    print(f"\n样本数: {len(df)}  试验数: {args.n_trials}  每个试验最多 {args.epochs} 个 epoch  "
+          f"目标验证损失: {target:.4f}")
+    print(f"{'方式':<24}{'总耗时(s)':>12}{'剪枝试验':>10}{'最佳损失':>10}{'达到目标(s)':>14}")
+    for name, study, start, elapsed, pruned in results:
+        reached = _seconds_to_reach(study, target, start)
+        reached = f'{reached:.1f}' if reached is not None else '未达到'
+        print(f"{name:<24}{elapsed:>12.1f}{pruned:>10}{study.best_value:>10.4f}{reached:>14}")
+
+def _time_factory_in_worker(factory, result_queue):
+    """在 spawn 启动的进程中测量从共享内存构建模型和重置权重的耗时"""
+    times = []
+    for _ in range(2):
+        start = time.perf_counter()
+        freeze_lower_layers(factory(), Config.NUM_FROZEN_LAYERS)
+        times.append(time.perf_counter() - start)
+    result_queue.put(times)
+
+def benchmark_trial_setup(args):
+    """超参数搜索每个试验的建模开销：每个试验重新加载预训练模型 vs TrialModelFactory 重置初始权重"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rows = []
+
+    # 现有做法：每个试验从磁盘加载预训练模型，试验结束后释放
+    times = []
+    for _ in range(args.trials):
+        start = time.perf_counter()
+        model = MultiDimensionalSentimentModel(pretrained_model_name=args.pretrained_model, num_dimensions=3)
+        freeze_lower_layers(model, Config.NUM_FROZEN_LAYERS).to(device)
+        del model
+        gc.collect()
+        times.append(time.perf_counter() - start)
+    rows.append(('每个试验重新加载', 0.0, times))
+
+    start = time.perf_counter()
+    factory = TrialModelFactory(pretrained_model_name=args.pretrained_model)
+    load_seconds = time.perf_counter() - start
+    times = []
+    for _ in range(args.trials):
+        start = time.perf_counter()
+        freeze_lower_layers(factory(), Config.NUM_FROZEN_LAYERS).to(device)
+        times.append(time.perf_counter() - start)
+    rows.append(('TrialModelFactory', load_seconds, times))
+
+    # 并行搜索的工作进程：初始权重通过共享内存传入
+    factory._model = None
+    gc.collect()
+    start = time.perf_counter()
+    factory.share_memory()
+    share_seconds = time.perf_counter() - start
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    process = ctx.Process(target=_time_factory_in_worker, args=(factory, result_queue))
+    process.start()
+    worker_times = result_queue.get()
+    process.join()
+    rows.append(('工作进程（共享内存）', share_seconds, worker_times))
+
+    print(f"模型: {args.pretrained_model}  试验数: {args.trials}  设备: {device}")
+    print(f"{'方式':<24}{'一次性开销(s)':>14}{'第一个试验(s)':>14}{'之后每个试验(s)':>16}")
+    for name, once, times in rows:
+        later = sum(times[1:]) / max(len(times) - 1, 1)
+        print(f"{name:<24}{once:>14.2f}{times[0]:>14.3f}{later:>16.3f}")
+
+def _ddp_benchmark_worker(rank, world_size, model_path, dataset, batch_size, precision, epochs, result_queue):
+    """数据并行基准测试的一个进程：训练自己的分片，rank 0 汇报全体的 samples/s"""
+    model = load_benchmark_model(model_path)
+    freeze_unused_modules(freeze_lower_layers(model, Config.NUM_FROZEN_LAYERS))
+    if world_size > 1:
+        model = distributed.wrap_model(model)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=Config.LEARNING_RATE)
+    trainer = SentimentTrainer(model, optimizer, torch.device('cpu'), precision=precision)
+    loader = make_data_loader(dataset, batch_size, shuffle=True, num_replicas=world_size, rank=rank)
+
+    # 各进程对齐起点后开始计时
+    distributed.barrier()
+    start = time.perf_counter()
+    for _ in range(epochs):
+        trainer.train_epoch(loader, progress=False)
+    distributed.barrier()
+    seconds = time.perf_counter() - start
+    # 补齐的批次也参与了计算，按实际处理的样本数统计
+    samples, = distributed.all_reduce_sum([len(loader.sampler) * epochs])
+    if rank == 0:
+        result_queue.put((samples / seconds, seconds))
+
+def benchmark_ddp(args):
+    """多进程 CPU 数据并行（gloo）：1/2/4/8 个进程的训练吞吐，每个进程的批次大小固定"""
+    tokenizer = load_tokenizer('bert-base-chinese')
+    df = pd.read_csv(args.data_path).dropna(subset=['review'])
+    df = df.sample(n=min(args.num_samples, len(df)), random_state=42)
+    dataset = ChineseSentimentDataset(
+        df['review'].astype(str).tolist(), df['label'].astype(int).tolist(), tokenizer, args.max_length
+    )
+    precision = args.precision
+    ctx = mp.get_context('spawn')
+    rows = []
+    for num_processes in args.num_processes:
+        result_queue = ctx.Queue()
+        distributed.launch(
+            _ddp_benchmark_worker, num_processes, args.model_path, dataset, args.batch_size, precision, args.epochs,
+            result_queue, master_port=Config.DDP_MASTER_PORT + num_processes
+        )
+        rows.append((num_processes, *result_queue.get()))
+
+    print(f"样本数: {len(dataset)}  每进程批大小: {args.batch_size}  精度: {precision}  CPU 核数: {os.cpu_count()}")
+    print(f"{'进程数':<8}{'samples/s':>12}{'耗时(s)':>10}{'加速比':>8}{'并行效率':>10}")
+    baseline = rows[0][1] / rows[0][0]
+    for num_processes, throughput, seconds in rows:
+        speedup = throughput / baseline
+        print(f"{num_processes:<8}{throughput:>12.1f}{seconds:>10.1f}{speedup:>7.2f}x{speedup / num_processes:>10.0%}")
+
+def _load_cv_sample(args):
+    df = pd.read_csv(args.data_path).dropna(subset=['review'])
+    df = df.sample(n=min(args.num_samples, len(df)), random_state=42)
+    return df['review'].astype(str).tolist(), df['label'].astype(int).tolist()
+
+def benchmark_cv(args):
+    """K 折交叉验证：逐折重新读取 CSV、分词并加载模型 vs 只分词一次的共享分片（串行 / 多进程并行）"""
+    tokenizer = load_tokenizer('bert-base-chinese')
+    model_factory = functools.partial(load_benchmark_model, args.model_path)
+    params = {
+        'epochs': args.epochs, 'batch_size': args.batch_size, 'learning_rate': Config.LEARNING_RATE,
+        'weight_decay': Config.WEIGHT_DECAY, 'precision': args.precision, 'pad_token_id': tokenizer.pad_token_id,
+    }
+    shards_dir = tempfile.mkdtemp(prefix='cv_shards_')
+    rows = []
+
+    # 原来的做法：每一折各自处理一遍数据、分词、加载预训练权重，然后依次训练
+    start = time.perf_counter()
+    setup_seconds = 0
+    texts, labels = _load_cv_sample(args)
+    for fold, (train_indices, valid_indices) in enumerate(kfold_indices(labels, args.n_splits)):
+        setup_start = time.perf_counter()
+        texts, labels = _load_cv_sample(args)
+        fold_dir = os.path.join(shards_dir, f'fold_{fold}')
+        dataset = PretokenizedDataset(build_token_shards(tokenizer, texts, labels, fold_dir, args.max_length))
+        setup_seconds += time.perf_counter() - setup_start
+        fold_factory = TrialModelFactory(model_factory)
+        run_fold(fold, dataset, train_indices, valid_indices, fold_factory, params)
+    rows.append(('逐折处理', 1, setup_seconds, time.perf_counter() - start))
+
+    # 共享分片：只分词一次，各折是同一份分片的索引子集
+    for name, max_workers in (('共享分片 串行', 1), ('共享分片 并行', args.max_workers)):
+        start = time.perf_counter()
+        texts, labels = _load_cv_sample(args)
+        dataset = load_or_build_token_shards(
+            tokenizer, texts, labels, os.path.join(shards_dir, f'shared_{max_workers}'), args.max_length
+        )
+        setup_seconds = time.perf_counter() - start
+        results = run_cross_validation(
+            dataset, n_splits=args.n_splits, epochs=args.epochs, batch_size=args.batch_size,
+            precision=args.precision, pad_token_id=tokenizer.pad_token_id, max_workers=max_workers,
+            model_factory=model_factory
+        )
+        # 实际进程数还受核数和内存预算限制
+        rows.append((name, results['workers'], setup_seconds, time.perf_counter() - start))
+    shutil.rmtree(shards_dir, ignore_errors=True)
+
+    print(f"\n样本数: {args.num_samples}  折数: {args.n_splits}  每折 epoch: {args.epochs}  CPU 核数: {os.cpu_count()}")
+    print(f"{'方式':<20}{'进程数':>8}{'读取+分词(s)':>12}{'总耗时(s)':>12}{'加速比':>8}")
+    baseline = rows[0][3]
+    for name, workers, setup_seconds, seconds in rows:
+        print(f"{name:<20}{workers:>8}{setup_seconds:>12.1f}{seconds:>12.1f}{baseline / seconds:>7.2f}x")
+
+def benchmark_profiler(args):
+    """训练步耗时分析的开销：不开启 vs 只计时 vs 计时并导出 torch.profiler trace，交替重复取中位数"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = load_tokenizer('bert-base-chinese')
+    df = pd.read_csv(args.data_path).dropna(subset=['review'])
+    df = df.sample(n=min(args.num_samples, len(df)), random_state=42)
+    dataset = ChineseSentimentDataset(
+        df['review'].astype(str).tolist(), df['label'].astype(int).tolist(), tokenizer, args.max_length
+    )
+    model = load_benchmark_model(args.model_path)
+    freeze_lower_layers(model, Config.NUM_FROZEN_LAYERS).to(device)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=Config.LEARNING_RATE)
+    loader = make_data_loader(dataset, args.batch_size, shuffle=True, pad_token_id=tokenizer.pad_token_id)
+    trace_dir = tempfile.mkdtemp(prefix='train_trace_')
+    variants = [
+        ('不开启', lambda: None),
+        ('计时', lambda: TrainingProfiler(device)),
+        ('计时 + trace', lambda: TrainingProfiler(device, trace_dir=trace_dir, trace_start=2, trace_steps=3)),
+    ]
+
+    # 先训练一个 epoch 预热
+    SentimentTrainer(model, optimizer, device, precision=args.precision).train_epoch(loader, progress=False)
+    times = {name: [] for name, _ in variants}
+    for _ in range(args.repeats):
+        for name, make_profiler in variants:
+            profiler = make_profiler()
+            trainer = SentimentTrainer(model, optimizer, device, precision=args.precision, profiler=profiler)
+            start = time.perf_counter()
+            trainer.train_epoch(loader, progress=False)
+            times[name].append(time.perf_counter() - start)
+            if profiler is not None:
+                profiler.close()
+
+    print(f"\n样本数: {len(dataset)}  批大小: {args.batch_size}  精度: {args.precision}  设备: {device}")
+    print(f"{'方式':<16}{'每 epoch(s)':>12}{'samples/s':>12}{'额外开销':>10}")
+    baseline = None
+    for name, _ in variants:
+        seconds = sorted(times[name])[len(times[name]) // 2]
+        baseline = baseline or seconds
+        print(f"{name:<16}{seconds:>12.2f}{len(dataset) / seconds:>12.1f}{seconds / baseline - 1:>10.1%}")
+    traces = [f for f in os.listdir(trace_dir) if f.endswith('.json')]
+    print(f"trace 文件: {len(traces)} 个，位于 {trace_dir}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='推理与训练性能基准测试')
+    parser.add_argument('--data_path', type=str, default='ChnSentiCorp_htl_all.csv',
+                      help='ChnSentiCorp 数据路径')
+    parser.add_argument('--model_path', type=str, default='WORKSPACE1/best_model.pt',
+                      help='模型检查点路径')
+    parser.add_argument('--num_threads', type=int, default=None,
+                      help='torch 线程数')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    padding_parser = subparsers.add_parser('padding', help='填充到512 vs 按长度分桶')
+    padding_parser.add_argument('--num_samples', type=int, default=512, help='测试样本数')
+    padding_parser.add_argument('--batch_size', type=int, default=32, help='批次大小')
+    padding_parser.add_argument('--max_length', type=int, default=512, help='最大序列长度')
+    padding_parser.set_defaults(func=benchmark_padding)
+
+    onnx_parser = subparsers.add_parser('onnx', help='ONNX Runtime vs PyTorch 一致性与延迟')
+    onnx_parser.add_argument('--onnx_path', type=str, default='WORKSPACE1/best_model.onnx',
+                           help='ONNX 模型路径，不存在时先导出')
+    onnx_parser.add_argument('--num_samples', type=int, default=64, help='一致性检查样本数')
+    onnx_parser.add_argument('--tolerance', type=float, default=1e-3, help='允许的最大输出差异')
+    onnx_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='测试的批大小')
+    onnx_parser.add_argument('--iterations', type=int, default=20, help='每个批大小的测试批次数')
+    onnx_parser.set_defaults(func=benchmark_onnx)
+
+    prefork_parser = subparsers.add_parser('prefork', help='预派生服务内存随工作进程数的增长')
+    prefork_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='测试的工作进程数')
+    prefork_parser.add_argument('--threads_per_worker', type=int, default=1, help='每个工作进程的 torch 线程数')
+    prefork_parser.add_argument('--requests_per_worker', type=int, default=8, help='每个工作进程的预热请求数')
+    prefork_parser.add_argument('--port', type=int, default=5055, help='测试服务端口')
+    prefork_parser.add_argument('--startup_timeout', type=int, default=600, help='等待服务启动的秒数')
+    prefork_parser.set_defaults(func=benchmark_prefork)
+
+    startup_parser = subparsers.add_parser('startup', help='冷启动耗时与峰值内存：旧加载路径 vs 内存映射加载')
+    startup_parser.set_defaults(func=benchmark_startup)
+
+    early_exit_parser = subparsers.add_parser('early_exit', help='提前退出：准确率 vs 平均计算层数')
+    early_exit_parser.add_argument('--early_exit_model_path', type=str, default='WORKSPACE1/best_model_early_exit.pt',
+                                   help='early_exit.py 生成的带退出头检查点')
+    early_exit_parser.add_argument('--thresholds', type=float, nargs='+', default=[0.8, 0.9, 0.95, 0.99],
+                                   help='测试的置信度阈值')
+    early_exit_parser.add_argument('--num_samples', type=int, default=None, help='只取测试集的部分样本')
+    early_exit_parser.add_argument('--batch_size', type=int, default=32, help='批次大小')
+    early_exit_parser.set_defaults(func=benchmark_early_exit)
+
+    fused_parser = subparsers.add_parser('fused_heads', help='合并维度分类头：一致性检查与延迟')
+    fused_parser.add_argument('--num_dimensions', type=int, nargs='+', default=[2, 8, 32], help='测试的维度数')
+    fused_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='测试的批大小')
+    fused_parser.add_argument('--hidden_size', type=int, default=1024, help='分类头输入维度')
+    fused_parser.add_argument('--iterations', type=int, default=200, help='分类头单独测速的调用次数')
+    fused_parser.add_argument('--num_samples', type=int, default=64, help='完整模型一致性检查样本数')
+    fused_parser.add_argument('--tolerance', type=float, default=1e-4, help='允许的最大输出差异')
+    fused_parser.set_defaults(func=benchmark_fused_heads)
+
+    ensemble_parser = subparsers.add_parser('ensemble', help='完整模型集成 vs 共享底层集成')
+    ensemble_parser.add_argument('--num_members', type=int, default=3, help='集成成员数')
+    ensemble_parser.add_argument('--num_shared_layers', type=int, default=18, help='共享的底层编码层数')
+    ensemble_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8], help='测试的批大小')
+    ensemble_parser.add_argument('--iterations', type=int, default=10, help='每个批大小的测试批次数')
+    ensemble_parser.set_defaults(func=benchmark_ensemble)
+
+    feature_cache_parser = subparsers.add_parser('feature_cache', help='冻结层缓存：每 epoch 训练耗时对比')
+    feature_cache_parser.add_argument('--num_samples', type=int, default=256, help='训练样本数')
+    feature_cache_parser.add_argument('--batch_size', type=int, default=8, help='批次大小')
+    feature_cache_parser.add_argument('--epochs', type=int, default=2, help='每种方式训练的 epoch 数')
+    feature_cache_parser.add_argument('--max_length', type=int, default=512, help='最大序列长度')
+    feature_cache_parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'],
+                                      help='缓存存储精度')
+    feature_cache_parser.add_argument('--cache_dir', type=str, default=None,
+                                      help='缓存目录，不指定时使用临时目录并在测试后删除')
+    feature_cache_parser.set_defaults(func=benchmark_feature_cache)
+
+    long_text_parser = subparsers.add_parser('long_text', help='长文本滑动窗口：逐窗口调用 vs 批量窗口推理')
+    long_text_parser.add_argument('--doc_tokens', type=int, nargs='+', default=[512, 1024, 2048, 4096],
+                                  help='测试的文档长度（token 数）')
+    long_text_parser.add_argument('--num_docs', type=int, default=8, help='每种长度的文档数')
+    long_text_parser.add_argument('--max_length', type=int, default=512, help='窗口长度（含特殊 token）')
+    long_text_parser.add_argument('--stride', type=int, default=128, help='相邻窗口重叠的 token 数')
+    long_text_parser.add_argument('--pooling', type=str, default='mean', choices=POOLING_METHODS, help='聚合方式')
+    long_text_parser.add_argument('--batch_size', type=int, default=32, help='批量推理的窗口批大小')
+    long_text_parser.set_defaults(func=benchmark_long_text)
+
+    tokenizer_parser = subparsers.add_parser('tokenizer', help='BertTokenizer 逐条分词 vs 快速分词器批量编码')
+    tokenizer_parser.add_argument('--num_samples', type=int, default=2000, help='测试样本数')
+    tokenizer_parser.add_argument('--max_length', type=int, default=512, help='最大序列长度')
+    tokenizer_parser.add_argument('--repeats', type=int, default=3, help='每种方式重复次数')
+    tokenizer_parser.add_argument('--cache_size', type=int, default=10000, help='token id 缓存条目数')
+    tokenizer_parser.set_defaults(func=benchmark_tokenizer)
+
+    pretokenized_parser = subparsers.add_parser('pretokenized', help='训练数据加载：逐条分词 vs 内存映射分词分片')
+    pretokenized_parser.add_argument('--num_samples', type=int, default=100000, help='训练样本数')
+    pretokenized_parser.add_argument('--batch_size', type=int, default=32, help='批次大小')
+    pretokenized_parser.add_argument('--num_workers', type=int, default=4, help='DataLoader 的 worker 数')
+    pretokenized_parser.add_argument('--epochs', type=int, default=2, help='每种方式遍历的 epoch 数')
+    pretokenized_parser.add_argument('--max_length', type=int, default=512, help='最大序列长度')
+    pretokenized_parser.add_argument('--shards_dir', type=str, default=None,
+                                     help='分片目录，不指定时使用临时目录并在测试后删除')
+    pretokenized_parser.set_defaults(func=benchmark_pretokenized)
+
+    dynamic_parser = subparsers.add_parser('dynamic_padding', help='训练：填充到 max_length vs 动态填充 + 按长度分组')
+    dynamic_parser.add_argument('--num_samples', type=int, default=256, help='训练样本数')
+    dynamic_parser.add_argument('--batch_size', type=int, default=8, help='批次大小')
+    dynamic_parser.add_argument('--epochs', type=int, default=1, help='每种方式训练的 epoch 数')
+    dynamic_parser.add_argument('--max_length', type=int, default=512, help='最大序列长度')
+    dynamic_parser.add_argument('--group_batches', type=int, default=50, help='按长度分组时每组包含的批次数')
+    dynamic_parser.set_defaults(func=benchmark_dynamic_padding)
+
+    trainer_parser = subparsers.add_parser('trainer', help='训练引擎：fp32 训练循环 vs 混合精度 + 梯度累积')
+    trainer_parser.add_argument('--num_samples', type=int, default=256, help='训练样本数')
+    trainer_parser.add_argument('--batch_size', type=int, default=16, help='等效批次大小')
+    trainer_parser.add_argument('--accumulation_steps', type=int, default=4, help='梯度累积步数')
+    trainer_parser.add_argument('--epochs', type=int, default=1, help='每种方式训练的 epoch 数')
+    trainer_parser.add_argument('--max_length', type=int, default=512, help='最大序列长度')
+    trainer_parser.set_defaults(func=benchmark_trainer)
+
+    hpo_parser = subparsers.add_parser('hpo', help='超参数搜索：不剪枝 vs 按 epoch 剪枝 + 多进程并行')
+    hpo_parser.add_argument('--num_samples', type=int, default=320, help='样本数（80%% 训练，20%% 验证）')
+    hpo_parser.add_argument('--n_trials', type=int, default=12, help='每种方式的试验数')
+    hpo_parser.add_argument('--epochs', type=int, default=3, help='每个试验最多训练的 epoch 数')
+    hpo_parser.add_argument('--n_jobs', type=int, default=4, help='并行搜索的进程数')
+    hpo_parser.add_argument('--pruner', type=str, default='median', choices=PRUNERS, help='剪枝方式')
+    hpo_parser.add_argument('--max_length', type=int, default=128, help='最大序列长度')
+    hpo_parser.add_argument('--tolerance', type=float, default=0.01, help='视为达到目标验证损失的相对误差')
+    hpo_parser.set_defaults(func=benchmark_hpo)
+
+    setup_parser = subparsers.add_parser('trial_setup', help='超参数搜索每个试验的建模开销：重新加载 vs 重置初始权重')
+    setup_parser.add_argument('--pretrained_model', type=str, default=Config.MODEL_NAME, help='预训练模型名称或路径')
+    setup_parser.add_argument('--trials', type=int, default=5, help='模拟的试验数')
+    setup_parser.set_defaults(func=benchmark_trial_setup)
+
+    ddp_parser = subparsers.add_parser('ddp', help='多进程 CPU 数据并行训练的扩展性')
+    ddp_parser.add_argument('--num_processes', type=int, nargs='+', default=[1, 2, 4, 8], help='测试的进程数')
+    ddp_parser.add_argument('--num_samples', type=int, default=256, help='训练样本数')
+    ddp_parser.add_argument('--batch_size', type=int, default=8, help='每个进程的批次大小')
+    ddp_parser.add_argument('--epochs', type=int, default=1, help='训练的 epoch 数')
+    ddp_parser.add_argument('--max_length', type=int, default=256, help='最大序列长度')
+    ddp_parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='训练精度')
+    ddp_parser.set_defaults(func=benchmark_ddp)
+
+    cv_parser = subparsers.add_parser('cv', help='K 折交叉验证：逐折分词 vs 共享分词分片 + 多进程并行')
+    cv_parser.add_argument('--num_samples', type=int, default=400, help='样本数')
+    cv_parser.add_argument('--n_splits', type=int, default=4, help='折数')
+    cv_parser.add_argument('--epochs', type=int, default=1, help='每折训练的 epoch 数')
+    cv_parser.add_argument('--batch_size', type=int, default=16, help='批次大小')
+    cv_parser.add_argument('--max_workers', type=int, default=2, help='并行训练的进程数')
+    cv_parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS, help='训练精度')
+    cv_parser.add_argument('--max_length', type=int, default=128, help='最大序列长度')
+    cv_parser.set_defaults(func=benchmark_cv)
+
+    profiler_parser = subparsers.add_parser('profiler', help='训练步耗时分析：不开启 vs 计时 vs 导出 trace 的开销')
+    profiler_parser.add_argument('--num_samples', type=int, default=128, help='训练样本数')
+    profiler_parser.add_argument('--batch_size', type=int, default=16, help='批次大小')
+    profiler_parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS, help='训练精度')
+    profiler_parser.add_argument('--repeats', type=int, default=3, help='每种方式交替重复的次数')
+    profiler_parser.add_argument('--max_length', type=int, default=128, help='最大序列长度')
+    profiler_parser.set_defaults(func=benchmark_profiler)
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
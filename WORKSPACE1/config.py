@@ -34,4 +34,89 @@ class Config:
     # 模型配置
     HIDDEN_DROPOUT = 0.14871350999617416
     ATTENTION_HEADS = 16
-    HIDDEN_DIM = 1024
\ No newline at end of file
+    HIDDEN_DIM = 1024
+    
+    # 在线推理微批处理
+    MICRO_BATCH_MAX_SIZE = 16  # 单批最多合并的请求数
+    MICRO_BATCH_MAX_WAIT_MS = 10  # 第一条请求最多等待的毫秒数
+    BULK_BATCH_SIZE = 64  # /predict_batch 内部推理的批次大小
+    
+    # 预测结果缓存
+    PREDICTION_CACHE_ENABLED = True
+    PREDICTION_CACHE_MAX_ENTRIES = 10000  # 内存中最多缓存的条目数
+    PREDICTION_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 内存缓存字节数上限
+    PREDICTION_CACHE_TTL = 3600  # 缓存有效期（秒）
+    PREDICTION_CACHE_DISK_DIR = None  # 设置为目录路径即启用多进程共享的磁盘缓存层
+    
+    # 分词缓存（api.py 加载分词器时启用）
+    TOKEN_CACHE_MAX_ENTRIES = 10000  # 文本 -> token id 缓存的条目数，0 表示关闭
+    
+    # 推理后端: torch 或 onnx（onnx 需先运行 onnx_backend.py 导出模型）
+    INFERENCE_BACKEND = 'torch'
+    INFERENCE_QUANTIZED = False  # 使用 quantize.py 生成的 INT8 动态量化模型
+    INFERENCE_FUSE_HEADS = True  # fp32 模型加载后把维度分类头合并为批量计算
+    
+    # 多进程预派生服务（serve_prefork.py）
+    PREFORK_WORKERS = 4  # 工作进程数
+    PREFORK_BACKLOG = 128  # 监听队列长度
+    
+    # 异步服务（asgi_app.py）
+    ASYNC_MAX_QUEUE_SIZE = 64  # 准入队列长度，队列满时直接返回 503
+    ASYNC_REQUEST_TIMEOUT = 5.0  # 单个请求的截止时间（秒），超时返回 504
+    ASYNC_MODEL_WORKERS = 1  # 执行推理的专用线程数，大于 1 时最多这么多个批次同时推理
+    
+    # 提前退出（early_exit.py 训练退出头后生效）
+    EARLY_EXIT_LAYERS = [6, 12, 18]  # 挂载提前退出头的编码层（从1开始计数）
+    EARLY_EXIT_THRESHOLD = None  # 退出头最大概率达到该值即提前退出，None 表示计算全部层
+    
+    # 知识蒸馏（distill.py）
+    DISTILL_STUDENT_INIT = 'teacher'  # 学生初始化：teacher 取教师均匀间隔的若干层（与教师同宽），random 缩小宽度后随机初始化
+    DISTILL_STUDENT_LAYERS = 4  # 学生模型编码层数
+    DISTILL_STUDENT_HIDDEN_SIZE = 384  # 学生模型隐藏层维度（需能被16整除）
+    DISTILL_STUDENT_HEADS = 12  # 学生模型注意力头数
+    DISTILL_STUDENT_INTERMEDIATE_SIZE = 1536  # 学生模型前馈层维度
+    DISTILL_TEMPERATURE = 2.0  # 软目标温度
+    DISTILL_ALPHA = 0.7  # 软目标损失权重，其余为真实标签损失
+    DISTILL_VALID_SIZE = 0.1  # 从训练集划出的验证集比例，按验证集准确率选择学生检查点
+    
+    # 共享底层编码器的集成模型（ensemble.py）
+    ENSEMBLE_NUM_MEMBERS = 3  # 集成成员数
+    ENSEMBLE_NUM_SHARED_LAYERS = 18  # 冻结共享的底层编码层数，其余各层每个成员独立一份
+    
+    # 冻结层缓存
+    NUM_FROZEN_LAYERS = 12  # 冻结的底层编码层数（含 embedding）
+    FEATURE_CACHE_DIR = 'WORKSPACE1/feature_cache'  # 冻结层输出缓存目录
+    
+    # 离线分词分片（pretokenized.py）
+    TOKEN_SHARDS_DIR = 'WORKSPACE1/token_shards'  # 分词分片目录
+    NUM_WORKERS = 2  # DataLoader 的 worker 进程数
+    
+    # 长文本推理
+    LONG_TEXT_POOLING = 'mean'  # 超过 MAX_LENGTH 的文本按滑动窗口推理后聚合：mean / max_confidence / length_weighted，None 表示截断
+    LONG_TEXT_STRIDE = 128  # 相邻窗口重叠的 token 数
+    LONG_TEXT_MAX_WINDOWS = 8  # 每条文本最多的窗口数（窗口长度 512、重叠 128 时约 3200 token），超出部分截断，避免单条超长文本长时间占用模型线程；None 表示不限
+    
+    # 训练引擎（model.SentimentTrainer）
+    TRAIN_PRECISION = 'auto'  # fp32 / bf16 / fp16 / auto：CUDA 上用混合精度，支持 bf16 的 CPU 上用 bf16 autocast
+    GRADIENT_ACCUMULATION_STEPS = 1  # 梯度累积步数
+    CHECKPOINT_EVERY_STEPS = 0  # 每隔多少个优化步保存一次训练检查点，0 表示只在 epoch 结束时保存
+    
+    # 超参数搜索（hyperparameter_tuning.py）
+    OPTUNA_STORAGE = 'sqlite:///WORKSPACE1/optuna.db'  # 研究存储，同名研究已存在时继续搜索；None 表示只保存在内存中
+    OPTUNA_STUDY_NAME = 'sentiment_hpo'  # 研究名称
+    OPTUNA_PRUNER = 'median'  # 按 epoch 剪枝：median / halving / none
+    OPTUNA_N_JOBS = 1  # 并行运行试验的进程数（需要 OPTUNA_STORAGE）
+    
+    # 多进程数据并行训练（main.py --num_processes）
+    DDP_BACKEND = 'gloo'  # CPU 训练使用 gloo 后端
+    DDP_MASTER_PORT = 29500  # 本机各进程建立进程组的端口
+    
+    # 训练步耗时分析（main.py --profile）
+    PROFILE_TRACE_DIR = None  # torch.profiler trace 导出目录，None 表示只打印汇总表
+    PROFILE_TRACE_START = 10  # 从第几个训练步开始记录 trace（跳过开头的预热步）
+    PROFILE_TRACE_STEPS = 5  # 记录 trace 的步数
+    
+    # K 折交叉验证（cross_validation.py）
+    CV_N_SPLITS = 5  # 折数
+    CV_MEMORY_BUDGET_MB = None  # 并行训练各折可用的内存，None 表示使用系统当前可用内存
+    CV_PROCESS_OVERHEAD_MB = 600  # 每个工作进程除模型和优化器状态外的内存（torch 运行时、激活值等）
\ No newline at end of file
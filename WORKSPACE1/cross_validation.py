@@ -0,0 +1,243 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import StratifiedKFold
+from torch.utils.data import Subset
+from transformers import get_linear_schedule_with_warmup
+from batching import make_data_loader
+from config import Config
+from hyperparameter_tuning import TrialModelFactory
+from model import PRECISIONS, SentimentTrainer, freeze_lower_layers
+from model_io import build_model_from_config, init_empty_weights
+from pretokenized import load_or_build_token_shards
+from tokenization import load_tokenizer
+from utils import get_available_memory_mb, get_peak_rss_mb
+
+# 工作进程的数据集和模型工厂，由 _init_worker 在进程启动时设置一次，之后各折复用
+_worker_state = {}
+
+def kfold_indices(labels, n_splits=Config.CV_N_SPLITS, seed=Config.SEED):
+    """按标签分层划分 K 折，返回 [(训练索引, 验证索引), ...]，每折各类别比例与全集一致"""
+    splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    return list(splitter.split(np.zeros(len(labels)), labels))
+
+def estimate_fold_memory_mb(model_factory, overhead_mb=Config.CV_PROCESS_OVERHEAD_MB):
+    """训练一折的工作进程大约需要的内存：一份模型权重，加上可训练参数的梯度和 AdamW 的两份状态"""
+    # 在 meta 设备上构建模型只为统计可训练参数，不分配内存
+    with init_empty_weights():
+        model = freeze_lower_layers(build_model_from_config(model_factory.config), Config.NUM_FROZEN_LAYERS)
+    weights = sum(tensor.numel() * tensor.element_size() for tensor in model_factory.initial_state.values())
+    trainable = sum(param.numel() * param.element_size() for param in model.parameters() if param.requires_grad)
+    return (weights + 3 * trainable) / 1024 / 1024 + overhead_mb
+
+def plan_workers(n_folds, cores=None, max_workers=None, memory_budget_mb=None, fold_memory_mb=0):
+    """在核数和内存预算内决定同时训练几折，返回 (进程数, 每个进程的线程数)"""
+    cores = cores or os.cpu_count() or 1
+    workers = min(n_folds, max_workers or cores, cores)
+    if memory_budget_mb is not None and fold_memory_mb > 0:
+        workers = min(workers, int(memory_budget_mb // fold_memory_mb))
+    workers = max(workers, 1)
+    return workers, max(1, cores // workers)
+
+def _evaluate(model, data_loader, device, autocast):
+    """验证一折：返回平均损失、准确率和宏平均 F1"""
+    criterion = nn.CrossEntropyLoss()
+    model.eval()
+    total_loss = 0
+    predictions, labels = [], []
+    with torch.no_grad(), autocast():
+        for batch in data_loader:
+            outputs = model(batch['input_ids'].to(device), batch['attention_mask'].to(device)).float()
+            total_loss += criterion(outputs, batch['labels'].to(device)).item()
+            predictions.extend(outputs.argmax(dim=1).cpu().tolist())
+            labels.extend(batch['labels'].tolist())
+    return {
+        'loss': total_loss / max(len(data_loader), 1),
+        'accuracy': accuracy_score(labels, predictions),
+        'macro_f1': f1_score(labels, predictions, average='macro'),
+    }
+
+def run_fold(fold, dataset, train_indices, valid_indices, model_factory, params):
+    """训练并验证一折；训练集和验证集都是 dataset 的 Subset，直接读取共享的分词分片"""
+    start = time.perf_counter()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # 模型工厂每次都重置为同一份初始权重，各折的起点相同
+    model = freeze_lower_layers(model_factory(), Config.NUM_FROZEN_LAYERS).to(device)
+    train_loader = make_data_loader(
+        Subset(dataset, train_indices), params['batch_size'], shuffle=True,
+        pad_token_id=params['pad_token_id'], seed=Config.SEED + fold
+    )
+    valid_loader = make_data_loader(
+        Subset(dataset, valid_indices), params['batch_size'], shuffle=False, pad_token_id=params['pad_token_id']
+    )
+    optimizer = torch.optim.AdamW(
+        [p for p in model.parameters() if p.requires_grad],
+        lr=params['learning_rate'],
+        weight_decay=params['weight_decay']
+    )
+    num_training_steps = len(train_loader) * params['epochs']
+    scheduler = get_linear_schedule_with_warmup(
+        optimizer,
+        num_warmup_steps=num_training_steps * Config.WARMUP_RATIO,
+        num_training_steps=num_training_steps
+    )
+    trainer = SentimentTrainer(
+        model, optimizer, device, scheduler=scheduler, precision=params['precision'],
+        max_grad_norm=Config.GRADIENT_CLIP_VALUE
+    )
+    train_losses = []
+    for epoch in range(params['epochs']):
+        train_losses.append(trainer.train_epoch(train_loader, progress=False))
+        print(f"[折 {fold + 1}] Epoch {epoch + 1}/{params['epochs']} 训练损失: {train_losses[-1]:.4f}")
+    metrics = _evaluate(model, valid_loader, device, trainer.autocast)
+    print(f"[折 {fold + 1}] 验证损失: {metrics['loss']:.4f}  准确率: {metrics['accuracy']:.4f}  "
+          f"宏平均 F1: {metrics['macro_f1']:.4f}")
+    return {
+        'fold': fold + 1,
+        'train_size': len(train_indices),
+        'valid_size': len(valid_indices),
+        'train_losses': train_losses,
+        **metrics,
+        'seconds': time.perf_counter() - start,
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+def _init_worker(dataset, model_factory, num_threads):
+    torch.set_num_threads(num_threads)
+    _worker_state['dataset'] = dataset
+    _worker_state['model_factory'] = model_factory
+
+def _run_fold_in_worker(fold, train_indices, valid_indices, params):
+    return run_fold(fold, _worker_state['dataset'], train_indices, valid_indices,
+                    _worker_state['model_factory'], params)
+
+def summarize_folds(fold_results):
+    """各指标在所有折上的均值和标准差"""
+    summary = {}
+    for key in ('loss', 'accuracy', 'macro_f1'):
+        values = np.array([result[key] for result in fold_results], dtype=np.float64)
+        summary[key] = {'mean': float(values.mean()), 'std': float(values.std())}
+    return summary
+
+def run_cross_validation(dataset, n_splits=Config.CV_N_SPLITS, epochs=Config.NUM_EPOCHS,
+                         batch_size=Config.BATCH_SIZE, learning_rate=Config.LEARNING_RATE,
+                         weight_decay=Config.WEIGHT_DECAY, precision=Config.TRAIN_PRECISION, pad_token_id=0,
+                         max_workers=None, cores=None, memory_budget_mb=Config.CV_MEMORY_BUDGET_MB,
+                         model_factory=None):
+    """K 折交叉验证：各折并行训练，返回每折的指标和所有折的汇总
+
+    dataset 需要有 labels（如 PretokenizedDataset），各折只是它的索引子集，不重新分词。
+    并行的进程数不超过 max_workers、核数 cores 和 内存预算 / 每折预计内存；各进程平分 cores 个线程。
+    工作进程用 spawn 启动，分词分片各自内存映射（共享页缓存），初始权重放在共享内存中只加载一次
+    """
+    folds = kfold_indices(dataset.labels, n_splits)
+    if not isinstance(model_factory, TrialModelFactory):
+        model_factory = TrialModelFactory(model_factory)
+    if memory_budget_mb is None:
+        memory_budget_mb = get_available_memory_mb()
+    fold_memory_mb = estimate_fold_memory_mb(model_factory)
+    workers, num_threads = plan_workers(n_splits, cores, max_workers, memory_budget_mb, fold_memory_mb)
+    params = {
+        'epochs': epochs,
+        'batch_size': batch_size,
+        'learning_rate': learning_rate,
+        'weight_decay': weight_decay,
+        'precision': precision,
+        'pad_token_id': pad_token_id,
+    }
+    budget = f"{memory_budget_mb:.0f} MB" if memory_budget_mb is not None else "不限"
+    print(f"{n_splits} 折交叉验证: {len(dataset)} 条样本，每折预计内存 {fold_memory_mb:.0f} MB，内存预算 {budget}")
+    print(f"同时训练 {workers} 折，每个进程 {num_threads} 个线程")
+
+    start = time.perf_counter()
+    if workers > 1:
+        model_factory.share_memory()
+        # spawn 启动：子进程不继承父进程的 CUDA 上下文和 OpenMP 线程池
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(dataset, model_factory, num_threads)) as executor:
+            futures = [
+                executor.submit(_run_fold_in_worker, fold, train_indices, valid_indices, params)
+                for fold, (train_indices, valid_indices) in enumerate(folds)
+            ]
+            fold_results = [future.result() for future in futures]
+    else:
+        fold_results = [
+            run_fold(fold, dataset, train_indices, valid_indices, model_factory, params)
+            for fold, (train_indices, valid_indices) in enumerate(folds)
+        ]
+    elapsed = time.perf_counter() - start
+
+    summary = summarize_folds(fold_results)
+    print(f"\n{'折':<6}{'训练':>8}{'验证':>8}{'验证损失':>10}{'准确率':>10}{'宏平均F1':>10}{'耗时(s)':>10}")
+    for result in fold_results:
+        print(f"{result['fold']:<6}{result['train_size']:>8}{result['valid_size']:>8}{result['loss']:>10.4f}"
+              f"{result['accuracy']:>10.4f}{result['macro_f1']:>10.4f}{result['seconds']:>10.1f}")
+    print(f"{'均值':<22}{summary['loss']['mean']:>10.4f}{summary['accuracy']['mean']:>10.4f}"
+          f"{summary['macro_f1']['mean']:>10.4f}")
+    print(f"{'标准差':<22}{summary['loss']['std']:>10.4f}{summary['accuracy']['std']:>10.4f}"
+          f"{summary['macro_f1']['std']:>10.4f}")
+    print(f"总耗时: {elapsed:.1f}s")
+    return {
+        'n_splits': n_splits,
+        'workers': workers,
+        'threads_per_worker': num_threads,
+        'seconds': elapsed,
+        'params': params,
+        'folds': fold_results,
+        'summary': summary,
+    }
+
+def main():
+    from data_processor import DataProcessor
+
+    parser = argparse.ArgumentParser(description='K 折交叉验证：只分词一次，多个进程并行训练各折')
+    parser.add_argument('--data-path', type=str, default='nCoV_100k_train.labled-utf8.csv', help='训练数据路径')
+    parser.add_argument('--label-column', type=str, default='情感倾向', help='标签列名')
+    parser.add_argument('--shards-dir', type=str, default=Config.TOKEN_SHARDS_DIR, help='分词分片目录')
+    parser.add_argument('--max-length', type=int, default=Config.MAX_LENGTH, help='最大序列长度')
+    parser.add_argument('--n-splits', type=int, default=Config.CV_N_SPLITS, help='折数')
+    parser.add_argument('--epochs', type=int, default=Config.NUM_EPOCHS, help='每折训练的 epoch 数')
+    parser.add_argument('--batch-size', type=int, default=Config.BATCH_SIZE, help='批次大小')
+    parser.add_argument('--lr', type=float, default=Config.LEARNING_RATE, help='学习率')
+    parser.add_argument('--weight-decay', type=float, default=Config.WEIGHT_DECAY, help='权重衰减')
+    parser.add_argument('--precision', type=str, default=Config.TRAIN_PRECISION, choices=PRECISIONS, help='训练精度')
+    parser.add_argument('--max-workers', type=int, default=None, help='最多同时训练的折数，默认不超过核数')
+    parser.add_argument('--cores', type=int, default=None, help='所有工作进程共用的 CPU 核数，默认全部')
+    parser.add_argument('--memory-budget-mb', type=float, default=Config.CV_MEMORY_BUDGET_MB,
+                        help='所有工作进程共用的内存预算（MB），默认使用系统当前可用内存')
+    parser.add_argument('--output', type=str, default=os.path.join(Config.RESULT_DIR, 'cv_results.json'),
+                        help='结果 JSON 路径')
+    args = parser.parse_args()
+
+    processor = DataProcessor(
+        sentiment_dict_path='sample_data/sentiment_dict.json',
+        stopwords_path='sample_data/stopwords.txt'
+    )
+    train_df, _ = processor.process_data(args.data_path)
+    # 整个训练集只分词一次，各折读取同一份分片
+    tokenizer = load_tokenizer(Config.MODEL_NAME)
+    dataset = load_or_build_token_shards(
+        tokenizer, train_df['cleaned_text'].tolist(), train_df[args.label_column].tolist(),
+        args.shards_dir, args.max_length
+    )
+    results = run_cross_validation(
+        dataset, n_splits=args.n_splits, epochs=args.epochs, batch_size=args.batch_size, learning_rate=args.lr,
+        weight_decay=args.weight_decay, precision=args.precision, pad_token_id=tokenizer.pad_token_id,
+        max_workers=args.max_workers, cores=args.cores, memory_budget_mb=args.memory_budget_mb
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {args.output}")
+
+if __name__ == '__main__':
+    main()
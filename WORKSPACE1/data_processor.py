@@ -5,6 +5,7 @@ import re
 import json
 from imblearn.over_sampling import SMOTE
 from collections import Counter
+from text_cleaning import clean_text
 
 class DataProcessor:
     def __init__(self, sentiment_dict_path=None, stopwords_path=None):
@@ -23,11 +24,8 @@ class DataProcessor:
     def clean_text(self, text):
         if pd.isna(text):  # 处理空值
             return ""
-        # 清理文本
-        text = str(text)  # 确保是字符串
-        text = re.sub(r'[^\u4e00-\u9fa5a-zA-Z0-9]', ' ', text)
-        text = re.sub(r'\s+', ' ', text).strip()
-        return text
+        # 清洗规则在 text_cleaning 中，预测缓存等服务端代码共用同一份
+        return clean_text(text)
     
     def process_data(self, data_path, test_size=0.2, balance_data=True):
         # 读取数据
@@ -0,0 +1,292 @@
+import argparse
+import json
+import os
+import re
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from sklearn.model_selection import train_test_split
+from torch.utils.data import Dataset, DataLoader
+from transformers import BertConfig, get_linear_schedule_with_warmup
+from tqdm import tqdm
+from config import Config
+from data_processor import DataProcessor
+from inference_only import load_model
+from model import MultiDimensionalSentimentModel
+from model_io import load_model_config, load_state_dict_file, save_checkpoint
+from predict import forward_in_buckets
+from quantize import compare_variants, load_test_split, print_comparison
+from tokenization import load_tokenizer
+
+STUDENT_INITS = ('teacher', 'random')
+
+class DistillationDataset(Dataset):
+    """文本 + 教师模型的 log_softmax 输出；无标注文本的 label 为 -1"""
+
+    def __init__(self, texts, teacher_outputs, labels):
+        self.texts = texts
+        self.teacher_outputs = teacher_outputs
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, idx):
+        return self.texts[idx], self.teacher_outputs[idx], self.labels[idx]
+
+def make_collate_fn(tokenizer, max_length):
+    """按批次动态填充到批内最长序列"""
+    def collate(batch):
+        texts, teacher_outputs, labels = zip(*batch)
+        encoding = tokenizer(
+            list(texts),
+            add_special_tokens=True,
+            max_length=max_length,
+            padding='longest',
+            truncation=True,
+            return_tensors='pt'
+        )
+        return {
+            'input_ids': encoding['input_ids'],
+            'attention_mask': encoding['attention_mask'],
+            'teacher_outputs': torch.stack(teacher_outputs),
+            'labels': torch.tensor(labels, dtype=torch.long)
+        }
+    return collate
+
+def build_student_config(teacher_config, num_layers, hidden_size, num_heads, intermediate_size):
+    """在教师结构配置的基础上缩小层数和宽度，词表与教师一致"""
+    # MultiDimensionalSentimentModel 的 cross_attention 固定为16个头
+    if hidden_size % 16 != 0 or hidden_size % num_heads != 0:
+        raise ValueError(f"hidden_size 必须能被 16 和 num_heads 整除: {hidden_size}")
+    config = BertConfig.from_dict(teacher_config.to_dict())
+    config.num_hidden_layers = num_layers
+    config.hidden_size = hidden_size
+    config.num_attention_heads = num_heads
+    config.intermediate_size = intermediate_size
+    return config
+
+def teacher_layer_indices(num_teacher_layers, num_student_layers):
+    """学生各层对应的教师层：均匀间隔并包含最后一层，如 24 层取 4 层为第 6、12、18、24 层（从 0 计为 5、11、17、23）"""
+    if not 0 < num_student_layers <= num_teacher_layers:
+        raise ValueError(f"学生层数必须在 1 到 {num_teacher_layers} 之间: {num_student_layers}")
+    step = num_teacher_layers / num_student_layers
+    return [round(step * (i + 1)) - 1 for i in range(num_student_layers)]
+
+def init_student_from_teacher(teacher, num_layers):
+    """与教师同宽的学生：复制教师的 embedding、均匀间隔的 num_layers 个编码层以及其余全部参数（分类头等）"""
+    config = BertConfig.from_dict(teacher.bert.config.to_dict())
+    layers = teacher_layer_indices(config.num_hidden_layers, num_layers)
+    config.num_hidden_layers = num_layers
+    student = MultiDimensionalSentimentModel(num_dimensions=len(teacher.dimension_heads), bert_config=config)
+    teacher_state = teacher.state_dict()
+    state = {}
+    for key in student.state_dict():
+        match = re.match(r'bert\.encoder\.layer\.(\d+)\.(.+)', key)
+        source = f'bert.encoder.layer.{layers[int(match.group(1))]}.{match.group(2)}' if match else key
+        state[key] = teacher_state[source]
+    student.load_state_dict(state)
+    print(f"学生模型由教师第 {[layer + 1 for layer in layers]} 层初始化（隐藏层维度 {config.hidden_size}）")
+    return student
+
+def describe_student(args):
+    """报告中记录学生模型的初始化方式和结构"""
+    config = load_model_config(args.output, load_state_dict_file(args.output))['bert_config']
+    return {
+        'init': f'pretrained:{args.student_pretrained}' if args.student_pretrained else args.student_init,
+        'num_layers': config.num_hidden_layers,
+        'hidden_size': config.hidden_size,
+    }
+
+def load_unlabeled_texts(paths, processor, max_texts=None):
+    """读取无标注文本：.csv 取 review/text 列，其他文件每行一条"""
+    texts = []
+    for path in paths:
+        if path.endswith('.csv'):
+            df = pd.read_csv(path)
+            column = 'review' if 'review' in df.columns else 'text'
+            texts.extend(df[column].dropna().astype(str).tolist())
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                texts.extend(line.strip() for line in f)
+    texts = [text for text in (processor.clean_text(text) for text in texts) if text]
+    return texts[:max_texts] if max_texts else texts
+
+def distillation_loss(student_outputs, teacher_outputs, labels, temperature, alpha):
+    """软目标 KL 散度（乘 T^2 保持梯度量级）与有标注样本的 NLL 加权
+
+    两个模型输出的都是 log_softmax，除以温度后重新归一化即为带温度的分布
+    """
+    soft_loss = F.kl_div(
+        F.log_softmax(student_outputs / temperature, dim=1),
+        F.log_softmax(teacher_outputs / temperature, dim=1),
+        reduction='batchmean',
+        log_target=True
+    ) * temperature ** 2
+    labeled = labels >= 0
+    if not labeled.any():
+        return soft_loss
+    hard_loss = F.nll_loss(student_outputs[labeled], labels[labeled])
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+def evaluate_accuracy(model, tokenizer, texts, labels, device, batch_size=64):
+    outputs = forward_in_buckets(texts, model, tokenizer, device, batch_size)
+    return (outputs.argmax(dim=1).cpu() == torch.tensor(labels)).float().mean().item()
+
+def distill(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f"使用设备: {device}")
+    tokenizer = load_tokenizer('bert-base-chinese')
+    processor = DataProcessor()
+
+    print("\n1. 加载数据")
+    train_df, _ = processor.process_data(args.data_path, balance_data=False)
+    # 从训练集分出验证集选择检查点，测试集只用于最终报告
+    train_df, valid_df = train_test_split(
+        train_df, test_size=args.valid_size, random_state=Config.SEED, stratify=train_df['label']
+    )
+    valid_texts = valid_df['cleaned_text'].tolist()
+    valid_labels = valid_df['label'].astype(int).tolist()
+    print(f"训练集: {len(train_df)} 条  验证集: {len(valid_df)} 条")
+    texts = train_df['cleaned_text'].tolist()
+    labels = train_df['label'].astype(int).tolist()
+    if args.unlabeled_path:
+        unlabeled = load_unlabeled_texts(args.unlabeled_path, processor, args.max_unlabeled)
+        texts += unlabeled
+        labels += [-1] * len(unlabeled)
+        print(f"无标注文本: {len(unlabeled)} 条")
+
+    print("\n2. 计算教师模型软目标")
+    teacher = load_model(args.teacher_path).to(device)
+    teacher_outputs = forward_in_buckets(texts, teacher, tokenizer, device, args.teacher_batch_size,
+                                         args.max_length).cpu()
+    print(f"教师模型验证集准确率: {evaluate_accuracy(teacher, tokenizer, valid_texts, valid_labels, device):.4f}")
+
+    print("\n3. 训练学生模型")
+    num_dimensions = len(teacher.dimension_heads)
+    if args.student_pretrained:
+        student = MultiDimensionalSentimentModel(
+            pretrained_model_name=args.student_pretrained, num_dimensions=num_dimensions
+        )
+    elif args.student_init == 'teacher':
+        student = init_student_from_teacher(teacher, args.student_layers)
+    else:
+        student = MultiDimensionalSentimentModel(
+            num_dimensions=num_dimensions,
+            bert_config=build_student_config(
+                teacher.bert.config, args.student_layers, args.student_hidden_size,
+                args.student_heads, args.student_intermediate_size
+            )
+        )
+    del teacher
+    student.to(device)
+
+    train_loader = DataLoader(
+        DistillationDataset(texts, teacher_outputs, labels),
+        batch_size=args.batch_size,
+        shuffle=True,
+        collate_fn=make_collate_fn(tokenizer, args.max_length)
+    )
+    optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr, weight_decay=Config.WEIGHT_DECAY)
+    num_training_steps = len(train_loader) * args.epochs
+    scheduler = get_linear_schedule_with_warmup(
+        optimizer,
+        num_warmup_steps=int(num_training_steps * Config.WARMUP_RATIO),
+        num_training_steps=num_training_steps
+    )
+
+    best_accuracy = -1.0
+    for epoch in range(args.epochs):
+        student.train()
+        train_loss = 0
+        progress_bar = tqdm(train_loader, desc=f'Epoch {epoch + 1}/{args.epochs}', leave=True)
+        for batch_idx, batch in enumerate(progress_bar):
+            batch = {k: v.to(device) for k, v in batch.items()}
+
+            optimizer.zero_grad()
+            outputs = student(batch['input_ids'], batch['attention_mask'])
+            loss = distillation_loss(outputs, batch['teacher_outputs'], batch['labels'],
+                                     args.temperature, args.alpha)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), max_norm=Config.GRADIENT_CLIP_VALUE)
+            optimizer.step()
+            scheduler.step()
+
+            train_loss += loss.item()
+            progress_bar.set_postfix({'avg_loss': f'{train_loss / (batch_idx + 1):.4f}'})
+
+        accuracy = evaluate_accuracy(student, tokenizer, valid_texts, valid_labels, device)
+        print(f'  训练损失: {train_loss / len(train_loader):.4f}  验证集准确率: {accuracy:.4f}')
+        if accuracy > best_accuracy:
+            best_accuracy = accuracy
+            # 保存权重和结构配置，api.py / inference_only.py 可直接加载
+            save_checkpoint(student, args.output)
+            print(f"  保存新的最佳学生模型: {args.output}")
+
+def build_report(args):
+    """在 ChnSentiCorp 测试集上对比教师与学生模型的大小、延迟和准确率（训练时没有用测试集选择检查点）"""
+    texts, labels = load_test_split(args.data_path, args.num_samples)
+    report = compare_variants(
+        [('teacher', args.teacher_path, False), ('student', args.output, False)], texts, labels,
+        args.eval_batch_size, args.latency_samples, args.num_threads
+    )
+    report['student_model'] = describe_student(args)
+    print_comparison(report, 'teacher', 'student')
+    student_model = report['student_model']
+    print(f"学生模型: 初始化 {student_model['init']}，{student_model['num_layers']} 层，"
+          f"隐藏层维度 {student_model['hidden_size']}")
+
+    with open(args.report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n蒸馏报告已保存至: {args.report_path}")
+    return report
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='把微调后的 RoBERTa-large 模型蒸馏为小型 CPU 学生模型')
+    parser.add_argument('--teacher-path', type=str, default='WORKSPACE1/best_model.pt', help='教师模型检查点')
+    parser.add_argument('--output', type=str, default='WORKSPACE1/student_model.pt', help='学生模型保存路径')
+    parser.add_argument('--data-path', type=str, default='ChnSentiCorp_htl_all.csv', help='ChnSentiCorp 数据路径')
+    parser.add_argument('--unlabeled-path', type=str, nargs='*', default=[],
+                        help='无标注文本文件（.csv 取 review/text 列，其他格式每行一条）')
+    parser.add_argument('--max-unlabeled', type=int, default=None, help='最多使用的无标注文本条数')
+    parser.add_argument('--student-init', type=str, default=Config.DISTILL_STUDENT_INIT, choices=STUDENT_INITS,
+                        help='学生初始化方式：teacher 取教师均匀间隔的 --student-layers 层（与教师同宽），'
+                             'random 按 --student-hidden-size 等缩小宽度并随机初始化')
+    parser.add_argument('--student-pretrained', type=str, default=None,
+                        help='改用小型预训练模型初始化学生（如 uer/chinese_roberta_L-4_H-512），优先于 --student-init')
+    parser.add_argument('--student-layers', type=int, default=Config.DISTILL_STUDENT_LAYERS, help='学生模型层数')
+    parser.add_argument('--student-hidden-size', type=int, default=Config.DISTILL_STUDENT_HIDDEN_SIZE,
+                        help='学生模型隐藏层维度（仅 --student-init random）')
+    parser.add_argument('--student-heads', type=int, default=Config.DISTILL_STUDENT_HEADS,
+                        help='学生模型注意力头数（仅 --student-init random）')
+    parser.add_argument('--student-intermediate-size', type=int, default=Config.DISTILL_STUDENT_INTERMEDIATE_SIZE,
+                        help='学生模型前馈层维度（仅 --student-init random）')
+    parser.add_argument('--valid-size', type=float, default=Config.DISTILL_VALID_SIZE,
+                        help='从训练集分层划出的验证集比例，用于选择学生检查点')
+    parser.add_argument('--temperature', type=float, default=Config.DISTILL_TEMPERATURE, help='软目标温度')
+    parser.add_argument('--alpha', type=float, default=Config.DISTILL_ALPHA, help='软目标损失的权重')
+    parser.add_argument('--epochs', type=int, default=5, help='训练轮数')
+    parser.add_argument('--batch-size', type=int, default=32, help='训练批次大小')
+    parser.add_argument('--teacher-batch-size', type=int, default=32, help='计算软目标时的批次大小')
+    parser.add_argument('--lr', type=float, default=1e-4, help='学习率')
+    parser.add_argument('--max-length', type=int, default=Config.MAX_LENGTH, help='最大序列长度')
+    parser.add_argument('--skip-training', action='store_true', help='只生成对比报告')
+    parser.add_argument('--report', action='store_true', help='训练后生成教师/学生对比报告')
+    parser.add_argument('--report-path', type=str, default='WORKSPACE1/distillation_report.json', help='报告保存路径')
+    parser.add_argument('--num-samples', type=int, default=None, help='报告只取测试集的部分样本')
+    parser.add_argument('--eval-batch-size', type=int, default=32, help='吞吐测试的批次大小')
+    parser.add_argument('--latency-samples', type=int, default=100, help='单条延迟测试的样本数')
+    parser.add_argument('--num-threads', type=int, default=None, help='报告中推理使用的 torch 线程数')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if not args.skip_training:
+        distill(args)
+    if args.report or args.skip_training:
+        if not os.path.exists(args.output):
+            raise FileNotFoundError(f"学生模型不存在: {args.output}")
+        build_report(args)
+
+if __name__ == '__main__':
+    main()
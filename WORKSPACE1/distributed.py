@@ -0,0 +1,63 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from config import Config
+
+def launch(fn, num_processes, *args, master_port=Config.DDP_MASTER_PORT):
+    """在本机启动 num_processes 个进程，每个进程调用 fn(rank, num_processes, *args)
+
+    各进程在调用 fn 之前加入同一个 gloo 进程组，并平分 CPU 核数作为 torch 线程数
+    """
+    mp.spawn(_run, args=(num_processes, master_port, fn, args), nprocs=num_processes, join=True)
+
+def _run(rank, num_processes, master_port, fn, args):
+    setup_process_group(rank, num_processes, master_port)
+    try:
+        fn(rank, num_processes, *args)
+    finally:
+        cleanup_process_group()
+
+def setup_process_group(rank, world_size, master_port=Config.DDP_MASTER_PORT, backend=Config.DDP_BACKEND):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = str(master_port)
+    # 每个进程只用自己那一份核，避免多个进程的 OpenMP 线程争抢同一批核
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+def cleanup_process_group():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    """单进程训练或数据并行的 rank 0：只有它打印进度、保存检查点和模型"""
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def all_reduce_sum(values):
+    """对各进程的数值列表逐项求和，单进程时原样返回"""
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+def wrap_model(model):
+    """包装为 DistributedDataParallel：创建时从 rank 0 广播参数，反向时 all-reduce 梯度"""
+    return DistributedDataParallel(model)
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
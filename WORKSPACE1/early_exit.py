@@ -0,0 +1,65 @@
+import argparse
+import torch
+from batching import make_data_loader
+from config import Config
+from data_processor import DataProcessor
+from model import MultiDimensionalSentimentModel, ChineseSentimentDataset, train_exit_heads
+from model_io import load_model_config, load_state_dict_file, save_checkpoint
+from tokenization import load_tokenizer
+
+def attach_exit_heads(model_path, exit_layers):
+    """加载微调后的检查点，并按 exit_layers 挂上新初始化的提前退出头"""
+    state_dict = load_state_dict_file(model_path)
+    config = load_model_config(model_path, state_dict)
+    model = MultiDimensionalSentimentModel(
+        num_dimensions=config['num_dimensions'], bert_config=config['bert_config'], exit_layers=exit_layers
+    )
+    # 已有的退出头会被覆盖，新增的退出头保持随机初始化
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    missing = [key for key in missing if not key.startswith('exit_heads.')]
+    unexpected = [key for key in unexpected if not key.startswith('exit_heads.')]
+    if missing or unexpected:
+        raise RuntimeError(f"检查点与模型结构不一致: missing={missing}, unexpected={unexpected}")
+    return model
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='为微调后的模型训练提前退出分类头（主干参数保持不变）')
+    parser.add_argument('--model-path', type=str, default='WORKSPACE1/best_model.pt', help='微调后的检查点路径')
+    parser.add_argument('--output', type=str, default='WORKSPACE1/best_model_early_exit.pt',
+                        help='带提前退出头的检查点保存路径；服务端设置 --exit-threshold 且未指定 --model-path 时默认加载该路径')
+    parser.add_argument('--exit-layers', type=int, nargs='+', default=Config.EARLY_EXIT_LAYERS,
+                        help='挂载提前退出头的编码层（从1开始计数）')
+    parser.add_argument('--data-path', type=str, default='ChnSentiCorp_htl_all.csv', help='ChnSentiCorp 数据路径')
+    parser.add_argument('--batch-size', type=int, default=Config.BATCH_SIZE, help='批次大小')
+    parser.add_argument('--epochs', type=int, default=1, help='训练轮数')
+    parser.add_argument('--lr', type=float, default=1e-3, help='退出头的学习率')
+    parser.add_argument('--max-length', type=int, default=Config.MAX_LENGTH, help='最大序列长度')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f"使用设备: {device}")
+
+    processor = DataProcessor()
+    train_df, _ = processor.process_data(args.data_path, balance_data=False)
+    tokenizer = load_tokenizer('bert-base-chinese')
+    train_dataset = ChineseSentimentDataset(
+        texts=train_df['cleaned_text'].values,
+        labels=train_df['label'].astype(int).values,
+        tokenizer=tokenizer,
+        max_length=args.max_length
+    )
+    train_loader = make_data_loader(train_dataset, args.batch_size, shuffle=True, pad_token_id=tokenizer.pad_token_id)
+
+    model = attach_exit_heads(args.model_path, args.exit_layers).to(device)
+    optimizer = torch.optim.AdamW(model.exit_heads.parameters(), lr=args.lr)
+    print(f"在第 {model.exit_layers} 层挂载提前退出头，训练样本数: {len(train_dataset)}")
+    train_exit_heads(model, train_loader, optimizer, args.epochs, device)
+
+    save_checkpoint(model.cpu(), args.output)
+    print(f"带提前退出头的模型已保存至: {args.output}")
+    print(f"启动服务时加上 --exit-threshold 启用提前退出；保存路径不是默认值时还需指定 --model-path {args.output}")
+
+if __name__ == '__main__':
+    main()
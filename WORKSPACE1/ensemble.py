@@ -0,0 +1,101 @@
+import argparse
+import torch
+import torch.nn.functional as F
+from batching import make_data_loader
+from config import Config
+from data_processor import DataProcessor
+from inference_only import load_model
+from model import ChineseSentimentDataset, SharedBackboneEnsemble
+from model_io import save_checkpoint
+from tokenization import load_tokenizer
+
+def train_members(ensemble, train_loader, optimizer, n_epochs, device, seed=42):
+    """在线 bagging 训练各成员
+
+    每个批次共享底层只算一次；每个成员对每条样本的损失权重服从 Poisson(1)，
+    近似各自在一份自助采样数据上训练，成员之间因此产生差异
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_members = len(ensemble.members)
+
+    for epoch in range(n_epochs):
+        ensemble.train()
+        train_loss = 0
+
+        for batch in train_loader:
+            input_ids = batch['input_ids'].to(device)
+            attention_mask = batch['attention_mask'].to(device)
+            labels = batch['labels'].to(device)
+
+            optimizer.zero_grad()
+            hidden_states, extended_mask = ensemble.encode_shared(input_ids, attention_mask)
+            outputs = ensemble.member_outputs(hidden_states, extended_mask)
+            weights = torch.poisson(torch.ones(num_members, labels.size(0)), generator=generator).to(device)
+            loss = sum(
+                (member_weights * F.nll_loss(member_output, labels, reduction='none')).sum()
+                / member_weights.sum().clamp(min=1)
+                for member_weights, member_output in zip(weights, outputs)
+            )
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(
+                [p for p in ensemble.parameters() if p.requires_grad], max_norm=Config.GRADIENT_CLIP_VALUE
+            )
+            optimizer.step()
+
+            train_loss += loss.item()
+
+        print(f'Epoch: {epoch+1}')
+        print(f'\tTrain Loss: {train_loss/len(train_loader):.3f}')
+
+    ensemble.eval()
+    return ensemble
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='由微调后的模型构建共享底层编码器的集成模型，并用在线 bagging 训练各成员')
+    parser.add_argument('--model-path', type=str, default='WORKSPACE1/best_model.pt', help='微调后的检查点路径')
+    parser.add_argument('--output', type=str, default='WORKSPACE1/best_model_ensemble.pt', help='集成模型保存路径')
+    parser.add_argument('--num-members', type=int, default=Config.ENSEMBLE_NUM_MEMBERS, help='集成成员数')
+    parser.add_argument('--num-shared-layers', type=int, default=Config.ENSEMBLE_NUM_SHARED_LAYERS,
+                        help='冻结共享的底层编码层数')
+    parser.add_argument('--data-path', type=str, default='ChnSentiCorp_htl_all.csv', help='ChnSentiCorp 数据路径')
+    parser.add_argument('--batch-size', type=int, default=Config.BATCH_SIZE, help='批次大小')
+    parser.add_argument('--epochs', type=int, default=1, help='训练轮数')
+    parser.add_argument('--lr', type=float, default=Config.LEARNING_RATE, help='学习率')
+    parser.add_argument('--max-length', type=int, default=Config.MAX_LENGTH, help='最大序列长度')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print(f"使用设备: {device}")
+
+    processor = DataProcessor()
+    train_df, _ = processor.process_data(args.data_path, balance_data=False)
+    tokenizer = load_tokenizer('bert-base-chinese')
+    train_loader = make_data_loader(
+        ChineseSentimentDataset(
+            texts=train_df['cleaned_text'].values,
+            labels=train_df['label'].astype(int).values,
+            tokenizer=tokenizer,
+            max_length=args.max_length
+        ),
+        args.batch_size,
+        shuffle=True,
+        pad_token_id=tokenizer.pad_token_id
+    )
+
+    ensemble = SharedBackboneEnsemble.from_model(
+        load_model(args.model_path), num_members=args.num_members, num_shared_layers=args.num_shared_layers
+    ).to(device)
+    trainable = [p for p in ensemble.parameters() if p.requires_grad]
+    print(f"共享 {args.num_shared_layers} 层, {args.num_members} 个成员, "
+          f"可训练参数 {sum(p.numel() for p in trainable) / 1e6:.1f}M / "
+          f"总参数 {sum(p.numel() for p in ensemble.parameters()) / 1e6:.1f}M")
+    optimizer = torch.optim.AdamW(trainable, lr=args.lr, weight_decay=Config.WEIGHT_DECAY)
+    train_members(ensemble, train_loader, optimizer, args.epochs, device)
+
+    save_checkpoint(ensemble.cpu(), args.output)
+    print(f"集成模型已保存至: {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from config import Config
+from model import extended_attention_mask, run_encoder_layer
+from tokenization import encode_batch, load_tokenizer, pad_batch
+
+CACHE_DTYPES = {'float16': np.float16, 'float32': np.float32}
+
+def dataset_hash(texts):
+    digest = hashlib.sha1()
+    for text in texts:
+        digest.update(str(text).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def tokenizer_fingerprint(tokenizer):
+    """分词器标识：类名、名称和词表内容"""
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    raw = f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:{vocab}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+def feature_cache_key(checkpoint_id, tokenizer, max_length, num_layers, dtype, texts):
+    """缓存键：检查点、分词器、max_length、冻结层数、存储精度和数据集内容任一变化都会生成新缓存"""
+    raw = json.dumps({
+        'checkpoint': checkpoint_id,
+        'tokenizer': tokenizer_fingerprint(tokenizer),
+        'max_length': max_length,
+        'num_layers': num_layers,
+        'dtype': dtype,
+        'dataset': dataset_hash(texts),
+    }, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]
+
+class FrozenFeatureCache:
+    """冻结层输出的磁盘缓存
+
+    只保存真实 token（不含 padding）：hidden.npy 为 [总token数, hidden_size]，
+    offsets.npy 记录每条样本的起止位置；mmap=True 时按需从页缓存读取，不占进程内存
+    """
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.input_ids = np.load(os.path.join(path, 'input_ids.npy'))
+        self.hidden = np.load(os.path.join(path, 'hidden.npy'), mmap_mode='r' if mmap else None)
+
+    @property
+    def num_layers(self):
+        return self.meta['num_layers']
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.hidden[self.offsets[idx]:self.offsets[idx + 1]]
+
+def build_feature_cache(model, tokenizer, texts, path, num_layers, max_length=512, batch_size=32,
+                        dtype='float16', device=torch.device('cpu'), meta=None):
+    """对数据集运行一次冻结的前 num_layers 层，把输出写入 path"""
+    all_input_ids = encode_batch(tokenizer, texts, max_length)
+    lengths = np.array([len(ids) for ids in all_input_ids], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    # 先写到临时目录，完成后整体改名，中断时不会留下不完整的缓存
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        hidden = np.lib.format.open_memmap(
+            os.path.join(tmp_path, 'hidden.npy'), mode='w+',
+            dtype=CACHE_DTYPES[dtype], shape=(int(offsets[-1]), model.bert.config.hidden_size)
+        )
+        model.eval()
+        # 按长度排序分桶，每个桶只填充到桶内最长序列
+        order = sorted(range(len(all_input_ids)), key=lambda i: lengths[i])
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                bucket = order[start:start + batch_size]
+                input_ids, attention_mask = pad_batch(tokenizer, [all_input_ids[i] for i in bucket])
+                input_ids = input_ids.to(device)
+                attention_mask = attention_mask.to(device)
+                hidden_states = model.bert.embeddings(input_ids=input_ids)
+                extended_mask = extended_attention_mask(attention_mask, hidden_states.dtype)
+                for encoder_layer in model.bert.encoder.layer[:num_layers]:
+                    hidden_states = run_encoder_layer(encoder_layer, hidden_states, extended_mask)
+                hidden_states = hidden_states.cpu().numpy()
+                for row, i in enumerate(bucket):
+                    hidden[offsets[i]:offsets[i + 1]] = hidden_states[row, :lengths[i]]
+        hidden.flush()
+        del hidden
+
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        # 后续层的前向不需要 token id，这里保存下来便于核对缓存与数据是否对应
+        np.save(os.path.join(tmp_path, 'input_ids.npy'), np.concatenate([np.asarray(ids) for ids in all_input_ids]))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(dict(meta or {}, num_layers=num_layers, max_length=max_length, dtype=dtype,
+                           num_samples=len(all_input_ids)), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError:
+        # 其他进程已经生成了同一份缓存
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            raise
+    finally:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return FrozenFeatureCache(path)
+
+def load_or_build_feature_cache(model, tokenizer, texts, cache_dir, checkpoint_id,
+                                num_layers=Config.NUM_FROZEN_LAYERS, max_length=Config.MAX_LENGTH,
+                                batch_size=32, dtype='float16', device=torch.device('cpu'), mmap=True):
+    """按缓存键查找冻结层缓存，不存在时生成"""
+    key = feature_cache_key(checkpoint_id, tokenizer, max_length, num_layers, dtype, texts)
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        print(f"使用已有的冻结层缓存: {path}")
+        return FrozenFeatureCache(path, mmap=mmap)
+    print(f"生成冻结层缓存: {path} ({len(texts)} 条, 前 {num_layers} 层, {dtype})")
+    build_feature_cache(model, tokenizer, texts, path, num_layers, max_length, batch_size, dtype, device,
+                        meta={'checkpoint': checkpoint_id})
+    return FrozenFeatureCache(path, mmap=mmap)
+
+class CachedFeatureDataset(Dataset):
+    """从冻结层缓存读取样本，配合 collate_cached_features 使用"""
+
+    def __init__(self, cache, labels):
+        if len(cache) != len(labels):
+            raise ValueError(f"缓存样本数 {len(cache)} 与标签数 {len(labels)} 不一致")
+        self.cache = cache
+        self.labels = labels
+        self.lengths = np.diff(cache.offsets)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return {
+            'hidden_states': torch.from_numpy(np.array(self.cache[idx], dtype=np.float32)),
+            'labels': torch.tensor(self.labels[idx], dtype=torch.long)
+        }
+
+def collate_cached_features(batch):
+    """填充到批内最长序列"""
+    max_len = max(item['hidden_states'].size(0) for item in batch)
+    hidden_size = batch[0]['hidden_states'].size(1)
+    hidden_states = torch.zeros(len(batch), max_len, hidden_size)
+    attention_mask = torch.zeros(len(batch), max_len, dtype=torch.long)
+    for row, item in enumerate(batch):
+        length = item['hidden_states'].size(0)
+        hidden_states[row, :length] = item['hidden_states']
+        attention_mask[row, :length] = 1
+    return {
+        'hidden_states': hidden_states,
+        'attention_mask': attention_mask,
+        'labels': torch.stack([item['labels'] for item in batch])
+    }
+
+def forward_batch(model, batch, start_layer=Config.NUM_FROZEN_LAYERS):
+    """对 DataLoader 的一个批次前向：缓存批次从冻结层之后开始，普通批次完整前向"""
+    if 'hidden_states' in batch:
+        return model.forward_from_layer(batch['hidden_states'], batch['attention_mask'], start_layer)
+    return model(batch['input_ids'], batch['attention_mask'])
+
+def main():
+    from data_processor import DataProcessor
+    from model import MultiDimensionalSentimentModel
+
+    parser = argparse.ArgumentParser(description='预先计算冻结层输出，供后续训练直接读取')
+    parser.add_argument('--data-path', type=str, default='ChnSentiCorp_htl_all.csv', help='ChnSentiCorp 数据路径')
+    parser.add_argument('--cache-dir', type=str, default=Config.FEATURE_CACHE_DIR, help='缓存目录')
+    parser.add_argument('--num-layers', type=int, default=Config.NUM_FROZEN_LAYERS, help='冻结层数')
+    parser.add_argument('--max-length', type=int, default=Config.MAX_LENGTH, help='最大序列长度')
+    parser.add_argument('--dtype', type=str, default='float16', choices=sorted(CACHE_DTYPES), help='存储精度')
+    parser.add_argument('--batch-size', type=int, default=32, help='批次大小')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = load_tokenizer(Config.MODEL_NAME)
+    model = MultiDimensionalSentimentModel(pretrained_model_name=Config.MODEL_NAME).to(device)
+    train_df, test_df = DataProcessor().process_data(args.data_path, balance_data=False)
+    for df in (train_df, test_df):
+        load_or_build_feature_cache(
+            model, tokenizer, df['cleaned_text'].tolist(), args.cache_dir, Config.MODEL_NAME,
+            args.num_layers, args.max_length, args.batch_size, args.dtype, device
+        )
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,16 @@
 import optuna
-from optuna.trial import Trial
+from optuna.trial import Trial, TrialState
 import torch
-from torch.utils.data import DataLoader
-from model import MultiDimensionalSentimentModel
+from model import MultiDimensionalSentimentModel, SentimentTrainer, freeze_lower_layers
+from batching import make_data_loader
+from model_io import build_model_from_config, init_empty_weights
 import gc
+import multiprocessing as mp
 import os
+import time
 import numpy as np
-from sklearn.model_selection import KFold
 import json
 from config import Config
-from tqdm import tqdm
-
-# 设置CUDA环境变量
-os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
 
 # 添加早停类
 class EarlyStopping:
@@ -37,7 +35,91 @@ class EarlyStopping:
 max_epochs = 3  # 定义最大训练轮数
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-def objective(trial: Trial, train_dataset, valid_dataset):
+PRUNERS = ('median', 'halving', 'none')
+
+class TrialModelFactory:
+    """试验级模型工厂：预训练权重只从磁盘读取一次，之后每个试验把模型重置为同一份初始权重
+
+    初始权重（预训练主干 + 第一次构建时随机初始化的分类头）保存在内存中，各试验的起点完全相同；
+    同一进程内复用同一个模型实例，重置时只拷贝上一个试验可训练的参数（冻结的参数不会被修改）。
+    share_memory() 把初始权重放到共享内存，
+    spawn 启动的并行搜索进程通过 pickle 拿到的是同一块内存，不会各自再读一遍预训练模型
+    """
+
+    def __init__(self, model_factory=None, pretrained_model_name='hfl/chinese-roberta-wwm-ext-large',
+                 num_dimensions=3):
+        model = model_factory() if model_factory is not None else MultiDimensionalSentimentModel(
+            pretrained_model_name=pretrained_model_name,
+            num_dimensions=num_dimensions
+        )
+        self.config = {
+            'bert_config': model.bert.config,
+            'num_dimensions': len(model.dimension_heads),
+            'exit_layers': model.exit_layers,
+            'ensemble': None,
+        }
+        # 直接持有刚加载的张量，不额外拷贝；模型实例在第一次调用时按配置重新构建
+        self.initial_state = {name: tensor.detach() for name, tensor in model.state_dict().items()}
+        self._model = None
+
+    def share_memory(self):
+        for tensor in self.initial_state.values():
+            tensor.share_memory_()
+        return self
+
+    def __getstate__(self):
+        # 传给工作进程时只带初始权重，模型实例由工作进程自己构建
+        state = self.__dict__.copy()
+        state['_model'] = None
+        return state
+
+    def __call__(self):
+        """返回重置为初始权重的模型，同一进程内每次返回同一个实例"""
+        if self._model is None:
+            # 参数先放在 meta 设备上，不做随机初始化，再直接使用初始权重的拷贝
+            with init_empty_weights():
+                model = build_model_from_config(self.config)
+            model.load_state_dict({name: tensor.clone() for name, tensor in self.initial_state.items()},
+                                  assign=True)
+            self._model = model
+        else:
+            with torch.no_grad():
+                for name, param in self._model.named_parameters():
+                    if param.requires_grad:
+                        param.copy_(self.initial_state[name])
+                for name, buffer in self._model.named_buffers():
+                    if name in self.initial_state:
+                        buffer.copy_(self.initial_state[name])
+        return self._model
+
+def create_pruner(name=Config.OPTUNA_PRUNER):
+    """按 epoch 剪枝：median 在某个 epoch 的验证损失差于已有试验同一 epoch 的中位数时停止，
+    halving 为 successive halving，每一轮只保留一半试验进入下一个 epoch"""
+    if name == 'median':
+        return optuna.pruners.MedianPruner(n_startup_trials=2, n_warmup_steps=0)
+    if name == 'halving':
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=2)
+    if name == 'none':
+        return optuna.pruners.NopPruner()
+    raise ValueError(f"不支持的剪枝方式: {name}，可选 {PRUNERS}")
+
+def create_storage(storage):
+    """SQLite 等数据库存储；多个进程同时写入 SQLite 时等待锁而不是立即报错，
+    心跳超时的试验（进程被杀掉）在恢复时标记为失败"""
+    if storage is None:
+        return None
+    if storage.startswith('sqlite:///'):
+        directory = os.path.dirname(os.path.abspath(storage[len('sqlite:///'):]))
+        os.makedirs(directory, exist_ok=True)
+    return optuna.storages.RDBStorage(
+        storage,
+        engine_kwargs={'connect_args': {'timeout': 60}} if storage.startswith('sqlite') else {},
+        heartbeat_interval=60,
+        grace_period=180
+    )
+
+def objective(trial: Trial, train_dataset, valid_dataset, max_epochs=max_epochs, model_factory=None):
+    model = None
     try:
         # 清理 GPU 缓存
         if torch.cuda.is_available():
@@ -56,63 +138,144 @@ def objective(trial: Trial, train_dataset, valid_dataset):
         print("Parameters:", params)
         
         # 创建模型
-        model = create_model(trial)
-        optimizer = create_optimizer(model, trial)
+        model = create_model(trial, model_factory)
+        optimizer = create_optimizer(model, params)
+        trainer = SentimentTrainer(
+            model, optimizer, device, precision=Config.TRAIN_PRECISION, max_grad_norm=Config.GRADIENT_CLIP_VALUE
+        )
         early_stopping = EarlyStopping(patience=3)
         
-        # 创建数据加载器
-        train_loader = DataLoader(
-            train_dataset,
-            batch_size=params['batch_size'],
-            shuffle=True
-        )
-        val_loader = DataLoader(
-            valid_dataset,
-            batch_size=params['batch_size']
-        )
+        # 创建数据加载器：动态填充到批内最长序列，训练集按长度分组采样
+        train_loader = make_data_loader(train_dataset, params['batch_size'], shuffle=True, seed=trial.number)
+        val_loader = make_data_loader(valid_dataset, params['batch_size'], shuffle=False)
         
         # 训练循环
         for epoch in range(max_epochs):
             print(f"\nEpoch {epoch + 1}/{max_epochs}")
-            train_loss = train_epoch(model, train_loader, optimizer)
-            val_loss = evaluate(model, val_loader)
+            train_loss = trainer.train_epoch(train_loader, progress=False)
+            val_loss = trainer.evaluate(val_loader)
             
             print(f"Train Loss: {train_loss:.4f}")
             print(f"Valid Loss: {val_loss:.4f}")
             
+            # 每个 epoch 上报验证损失，明显差于其他试验时提前结束
+            trial.report(val_loss, epoch)
+            if trial.should_prune():
+                print(f"Trial {trial.number + 1} pruned at epoch {epoch + 1}")
+                raise optuna.TrialPruned()
+            
             early_stopping(val_loss)
             if early_stopping.early_stop:
                 print("Early stopping triggered")
                 break
         
-        # 清理内存
-        del model, optimizer
-        torch.cuda.empty_cache()
-        gc.collect()
-        
         return val_loss
         
+    except optuna.TrialPruned:
+        raise
     except Exception as e:
         print(f"Trial failed with error: {str(e)}")
         return 1e6
+    finally:
+        # 清理内存
+        del model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        gc.collect()
+
+def _count_finished(study):
+    """已完成（含剪枝）的试验数"""
+    return len(study.get_trials(deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED)))
+
+def _optimize(study, train_dataset, valid_dataset, n_trials, max_epochs, model_factory):
+    """在当前进程中运行试验，直到研究中完成（含剪枝）的试验数达到 n_trials"""
+    # study.optimize 至少会开始一个新试验，MaxTrialsCallback 只在试验结束后才停止，已达到时直接返回
+    remaining = n_trials - _count_finished(study)
+    if remaining <= 0:
+        return
+    study.optimize(
+        lambda trial: objective(trial, train_dataset, valid_dataset, max_epochs, model_factory),
+        n_trials=remaining,
+        catch=(RuntimeError,),
+        callbacks=[optuna.study.MaxTrialsCallback(n_trials, states=(TrialState.COMPLETE, TrialState.PRUNED))]
+    )
 
-def run_hyperparameter_search(train_dataset, valid_dataset, n_trials=5):
+def _search_worker(rank, storage, study_name, pruner, train_dataset, valid_dataset, n_trials, max_epochs,
+                   model_factory, num_threads):
+    """并行搜索的工作进程：连接同一个研究，各自取试验运行"""
+    torch.set_num_threads(num_threads)
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    study = optuna.load_study(
+        study_name=study_name,
+        storage=create_storage(storage),
+        pruner=create_pruner(pruner),
+        # 各进程使用不同的随机种子，避免启动阶段提出相同的参数
+        sampler=optuna.samplers.TPESampler(seed=Config.SEED + rank)
+    )
+    _optimize(study, train_dataset, valid_dataset, n_trials, max_epochs, model_factory)
+
+def run_hyperparameter_search(train_dataset, valid_dataset, n_trials=5, n_jobs=Config.OPTUNA_N_JOBS,
+                              storage=Config.OPTUNA_STORAGE, study_name=Config.OPTUNA_STUDY_NAME,
+                              pruner=Config.OPTUNA_PRUNER, max_epochs=max_epochs, model_factory=None):
+    """运行超参数搜索，返回最佳参数
+
+    研究保存在 storage（SQLite）中：同名研究已存在时继续搜索，已完成或剪枝的试验计入 n_trials；
+    n_jobs > 1 时启动多个进程并行运行试验，每个进程使用 CPU 核数 / n_jobs 个线程。
+    model_factory 不是 TrialModelFactory 时包装为 TrialModelFactory，预训练模型只加载一次
+    """
     print("开始超参数搜索...")
     print(f"计划进行 {n_trials} 次试验")
+    if n_jobs > 1 and storage is None:
+        raise ValueError("并行搜索需要指定 storage，各进程通过同一个数据库协调试验")
     
-    study = optuna.create_study(direction='minimize')
     try:
-        study.optimize(
-            lambda trial: objective(trial, train_dataset, valid_dataset),
-            n_trials=n_trials,
-            catch=(RuntimeError,)
+        study = optuna.create_study(
+            study_name=study_name,
+            storage=create_storage(storage),
+            direction='minimize',
+            pruner=create_pruner(pruner),
+            sampler=optuna.samplers.TPESampler(seed=Config.SEED),
+            load_if_exists=True
         )
+        finished = _count_finished(study)
+        if finished:
+            print(f"继续已有的研究 {study_name}: 已完成 {finished} 次试验")
+        
+        if finished >= n_trials:
+            print("已达到计划的试验次数，不再运行新试验")
+        else:
+            if not isinstance(model_factory, TrialModelFactory):
+                start = time.perf_counter()
+                model_factory = TrialModelFactory(model_factory)
+                print(f"加载初始权重: {time.perf_counter() - start:.1f}s（之后每个试验只重置权重）")
         
+            if n_jobs > 1:
+                model_factory.share_memory()
+                num_threads = max(1, torch.get_num_threads() // n_jobs)
+                # spawn 启动：子进程不继承父进程的 CUDA 上下文和 OpenMP 线程池
+                ctx = mp.get_context('spawn')
+                processes = [
+                    ctx.Process(target=_search_worker, args=(
+                        rank, storage, study_name, pruner, train_dataset, valid_dataset, n_trials, max_epochs,
+                        model_factory, num_threads
+                    ))
+                    for rank in range(n_jobs)
+                ]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+            else:
+                _optimize(study, train_dataset, valid_dataset, n_trials, max_epochs, model_factory)
+        
+        pruned = len(study.get_trials(deepcopy=False, states=(TrialState.PRUNED,)))
         print("\n搜索完成!<(￣︶￣)↗[GO!]")
+        print(f"试验数: {len(study.trials)}，其中剪枝 {pruned} 次")
         print("Best parameters:", study.best_params)
         print("Best validation loss:", study.best_value)
         
         # 保存最佳参数
+        os.makedirs(Config.RESULT_DIR, exist_ok=True)
         params_path = os.path.join(Config.RESULT_DIR, 'best_params.json')
         with open(params_path, 'w') as f:
             json.dump(study.best_params, f)
@@ -122,60 +285,23 @@ def run_hyperparameter_search(train_dataset, valid_dataset, n_trials=5):
         print(f"Hyperparameter search failed: {str(e)}")
         return None
 
-def create_model(trial):
-    """创建模型"""
-    model = MultiDimensionalSentimentModel(
-        pretrained_model_name='hfl/chinese-roberta-wwm-ext-large',
-        num_dimensions=3
-    )
+def create_model(trial, model_factory=None):
+    """创建模型；model_factory 为无参函数（如 TrialModelFactory）时用它构建模型"""
+    if model_factory is not None:
+        model = model_factory()
+    else:
+        model = MultiDimensionalSentimentModel(
+            pretrained_model_name='hfl/chinese-roberta-wwm-ext-large',
+            num_dimensions=3
+        )
+    # 与 create_model_and_tokenizer 一致冻结底层，使用冻结层缓存时这些层不参与计算
+    freeze_lower_layers(model, Config.NUM_FROZEN_LAYERS)
     return model.to(device)
 
-def create_optimizer(model, trial):
-    """创建优化器"""
+def create_optimizer(model, params):
+    """创建优化器，使用 objective 中已经采样的参数"""
     return torch.optim.AdamW(
-        model.parameters(),
-        lr=trial.suggest_float('learning_rate', 1e-5, 2e-5, log=True),
-        weight_decay=trial.suggest_float('weight_decay', 0.01, 0.03)
+        [p for p in model.parameters() if p.requires_grad],
+        lr=params['learning_rate'],
+        weight_decay=params['weight_decay']
     )
-
-def train_epoch(model, train_loader, optimizer):
-    """训练一个epoch"""
-    model.train()
-    total_loss = 0
-    criterion = torch.nn.CrossEntropyLoss()
-    
-    # 添加进度条
-    progress_bar = tqdm(train_loader, desc='Training', leave=False)
-    for batch in progress_bar:
-        batch = {k: v.to(device) for k, v in batch.items()}
-        optimizer.zero_grad()
-        outputs = model(batch['input_ids'], batch['attention_mask'])
-        loss = criterion(outputs, batch['labels'])
-        loss.backward()
-        optimizer.step()
-        total_loss += loss.item()
-        
-        # 更新进度条
-        progress_bar.set_postfix({'loss': f'{loss.item():.4f}'})
-    
-    return total_loss / len(train_loader)
-
-def evaluate(model, val_loader):
-    """评估模型"""
-    model.eval()
-    total_loss = 0
-    criterion = torch.nn.CrossEntropyLoss()
-    
-    # 添加进度条
-    progress_bar = tqdm(val_loader, desc='Validation', leave=False)
-    with torch.no_grad():
-        for batch in progress_bar:
-            batch = {k: v.to(device) for k, v in batch.items()}
-            outputs = model(batch['input_ids'], batch['attention_mask'])
-            loss = criterion(outputs, batch['labels'])
-            total_loss += loss.item()
-            
-            # 更新进度条
-            progress_bar.set_postfix({'loss': f'{loss.item():.4f}'})
-    
-    return total_loss / len(val_loader)
\ No newline at end of file
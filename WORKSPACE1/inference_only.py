@@ -1,35 +1,72 @@
 import torch
-from transformers import BertTokenizer
-from model import MultiDimensionalSentimentModel
-from predict import predict_sentiment
+from model_io import build_model_fast
+from config import Config
+from predict import POOLING_METHODS, predict_sentiment_batch
+from tokenization import load_tokenizer
 import time
 import argparse
 
-def load_model(model_path):
-    model = MultiDimensionalSentimentModel()
-    model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu'), weights_only=True))
-    return model
+BACKENDS = ('torch', 'onnx')
+
+def load_model(model_path, backend='torch', quantized=False, timings=None, fuse_heads=False):
+    """加载推理模型
+
+    onnx 后端时 model_path 为导出的 .onnx 文件；
+    quantized=True 时 model_path 为 quantize.py 生成的 INT8 检查点；
+    timings 传入字典时记录各加载阶段耗时；
+    fuse_heads=True 时把维度分类头合并为批量计算（torch 后端 fp32 模型）
+    """
+    if backend == 'onnx':
+        if quantized:
+            raise ValueError("INT8 量化模式只支持 torch 后端")
+        # 按需导入，未安装 onnxruntime 时不影响 torch 后端
+        from onnx_backend import OnnxSentimentModel
+        return OnnxSentimentModel(model_path)
+    if backend != 'torch':
+        raise ValueError(f"不支持的推理后端: {backend}")
+
+    # 按结构配置构建模型并内存映射加载权重，不再先加载预训练权重
+    return build_model_fast(model_path, quantized=quantized, timings=timings, fuse_heads=fuse_heads)
 
 def main():
     parser = argparse.ArgumentParser(description='情感推理')
-    parser.add_argument('text', type=str, help='需要预测情感的文本')
-    parser.add_argument('--model-path', type=str, default='WORKSPACE1/best_model.pt', help='模型保存路径')
+    parser.add_argument('texts', type=str, nargs='+', help='需要预测情感的文本，可以传入多条')
+    parser.add_argument('--model-path', type=str, default='WORKSPACE1/best_model.pt',
+                        help='模型保存路径（onnx 后端时为 .onnx 文件）')
+    parser.add_argument('--backend', type=str, default='torch', choices=BACKENDS, help='推理后端')
+    parser.add_argument('--quantized', action='store_true',
+                        help='加载 quantize.py 生成的 INT8 检查点（--model-path 指向量化检查点）')
+    parser.add_argument('--batch-size', type=int, default=32, help='批量推理的批次大小')
+    parser.add_argument('--exit-threshold', type=float, default=None,
+                        help='提前退出的置信度阈值（需要带提前退出头的检查点）')
+    parser.add_argument('--long-text-pooling', type=str, default=Config.LONG_TEXT_POOLING or 'none',
+                        choices=POOLING_METHODS + ('none',), help='长文本滑动窗口的聚合方式，none 表示截断')
+    parser.add_argument('--stride', type=int, default=Config.LONG_TEXT_STRIDE, help='相邻窗口重叠的 token 数')
+    parser.add_argument('--max-windows', type=int, default=Config.LONG_TEXT_MAX_WINDOWS,
+                        help='每条文本最多的窗口数，超出部分截断')
     args = parser.parse_args()
 
-    tokenizer = BertTokenizer.from_pretrained('bert-base-chinese')
-    model = load_model(args.model_path)
+    tokenizer = load_tokenizer('bert-base-chinese')
+    fuse_heads = args.backend == 'torch' and not args.quantized
+    model = load_model(args.model_path, backend=args.backend, quantized=args.quantized, fuse_heads=fuse_heads)
     device = torch.device('cpu')
     model.to(device)
 
     start_time = time.time()
-    sentiment, probabilities, confidence = predict_sentiment(args.text, model, tokenizer, device)
+    results = predict_sentiment_batch(args.texts, model, tokenizer, device, batch_size=args.batch_size,
+                                      exit_threshold=args.exit_threshold,
+                                      pooling=None if args.long_text_pooling == 'none' else args.long_text_pooling,
+                                      stride=args.stride, max_windows=args.max_windows)
     end_time = time.time()
     
     inference_time = end_time - start_time
-    print('预测情感:', sentiment)
-    print('推理时间: {:.4f}秒'.format(inference_time))
-    print('详细概率输出:', probabilities)
-    print('置信度:', confidence)
+    for text, (sentiment, probabilities, confidence, exit_layer) in zip(args.texts, results):
+        print('文本:', text)
+        print('预测情感:', sentiment)
+        print('详细概率输出:', probabilities)
+        print('置信度:', confidence)
+        print('退出层:', exit_layer)
+    print('推理时间: {:.4f}秒 (共{}条)'.format(inference_time, len(args.texts)))
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,11 @@
 from data_processor import DataProcessor
 from model_evaluator import ModelEvaluator
-from torch.utils.data import DataLoader
 from transformers import get_linear_schedule_with_warmup
 import torch
-from model import MultiDimensionalSentimentModel, create_model_and_tokenizer, ChineseSentimentDataset
-from tqdm import tqdm
+from model import (
+    PRECISIONS, MultiDimensionalSentimentModel, SentimentTrainer, create_model_and_tokenizer, freeze_unused_modules
+)
+import math
 import time
 import datetime
 import argparse
@@ -13,7 +14,14 @@ from config import Config
 import os
 import json
 from transformers import BertTokenizer
-from hyperparameter_tuning import run_hyperparameter_search
+from hyperparameter_tuning import PRUNERS, run_hyperparameter_search
+from model_io import save_checkpoint
+from batching import make_data_loader
+from pretokenized import load_or_build_token_shards
+from feature_cache import CachedFeatureDataset, load_or_build_feature_cache
+from distributed import is_main_process, launch, unwrap_model, wrap_model
+from tokenization import load_tokenizer
+from training_profiler import TrainingProfiler
 
 def format_time(elapsed):
     '''将秒数转换为 hh:mm:ss 格式'''
@@ -36,6 +44,42 @@ def parse_args():
                       help='模型保存路径')
     parser.add_argument('--log_dir', type=str, default=Config.LOG_DIR,
                       help='日志目录')
+    parser.add_argument('--token_shards_dir', type=str, default=Config.TOKEN_SHARDS_DIR,
+                      help='离线分词分片目录（pretokenized.py 生成，不存在时自动生成）')
+    parser.add_argument('--num_workers', type=int, default=Config.NUM_WORKERS,
+                      help='DataLoader 的 worker 进程数')
+    parser.add_argument('--feature_cache_dir', type=str, default=None,
+                      help='冻结层输出缓存目录，指定后训练直接从缓存的第12层输出开始')
+    parser.add_argument('--feature_cache_dtype', type=str, default='float16', choices=['float16', 'float32'],
+                      help='冻结层缓存的存储精度')
+    parser.add_argument('--n_trials', type=int, default=5,
+                      help='超参数搜索的试验次数，0 表示不搜索，直接使用 --lr 和 --weight_decay')
+    parser.add_argument('--n_jobs', type=int, default=Config.OPTUNA_N_JOBS,
+                      help='并行运行试验的进程数')
+    parser.add_argument('--study_name', type=str, default=Config.OPTUNA_STUDY_NAME,
+                      help='超参数搜索的研究名称，同名研究已存在时继续搜索')
+    parser.add_argument('--storage', type=str, default=Config.OPTUNA_STORAGE,
+                      help='研究存储（如 sqlite:///optuna.db）')
+    parser.add_argument('--pruner', type=str, default=Config.OPTUNA_PRUNER, choices=PRUNERS,
+                      help='按 epoch 剪枝的方式')
+    parser.add_argument('--precision', type=str, default=Config.TRAIN_PRECISION, choices=PRECISIONS,
+                      help='训练精度：auto 在 CUDA 上用混合精度，在支持 bf16 的 CPU 上用 bf16 autocast')
+    parser.add_argument('--accumulation_steps', type=int, default=Config.GRADIENT_ACCUMULATION_STEPS,
+                      help='梯度累积步数，等效批次大小为 batch_size * accumulation_steps')
+    parser.add_argument('--checkpoint_every', type=int, default=Config.CHECKPOINT_EVERY_STEPS,
+                      help='每隔多少个优化步保存一次训练检查点，0 表示只在每个 epoch 结束时保存')
+    parser.add_argument('--resume', action='store_true',
+                      help='从 model_path 下的训练检查点继续训练')
+    parser.add_argument('--num_processes', type=int, default=1,
+                      help='数据并行的进程数（gloo 后端），每个进程训练一份数据分片并 all-reduce 梯度')
+    parser.add_argument('--profile', action='store_true',
+                      help='记录每个训练步的数据加载、拷贝、前向、反向和优化器耗时，每个 epoch 结束时打印汇总')
+    parser.add_argument('--profile_trace_dir', type=str, default=Config.PROFILE_TRACE_DIR,
+                      help='配合 --profile 使用：把部分训练步的 torch.profiler trace 导出到该目录')
+    parser.add_argument('--profile_trace_start', type=int, default=Config.PROFILE_TRACE_START,
+                      help='从第几个训练步开始记录 trace')
+    parser.add_argument('--profile_trace_steps', type=int, default=Config.PROFILE_TRACE_STEPS,
+                      help='记录 trace 的训练步数')
     return parser.parse_args()
 
 def setup_logging(log_dir):
@@ -60,16 +104,8 @@ def main():
     logging.info("开始训练...")
     print("=== 开始模型训练 ===")
     start_time = time.time()
-    
-    # 使用找到的最佳超参数
-    best_params = run_hyperparameter_search(
-        train_dataset=train_dataset,
-        valid_dataset=test_dataset,
-        n_trials=5
-    )
-    print("\n最佳超参数:")
-    for param, value in best_params.items():
-        print(f"{param}: {value}")
+    if args.num_processes > 1 and args.feature_cache_dir:
+        raise ValueError("数据并行训练暂不支持冻结层缓存（--feature_cache_dir）")
     
     print("\n1. 数据处理")
     # 初始化数据处理器
@@ -81,44 +117,101 @@ def main():
     # 处理数据
     train_df, test_df = processor.process_data('nCoV_100k_train.labled-utf8.csv')
     
-    print("\n2. 模型初始化")
+    print("\n2. 创建数据集")
+    # 创建数据集：读取内存映射的分词分片，每个 epoch 不再重新分词，worker 之间共享页缓存；
+    # 数据并行时分片在启动训练进程前生成一次，各进程只读取
+    tokenizer = load_tokenizer('hfl/chinese-roberta-wwm-ext-large')
+    train_dataset = load_or_build_token_shards(
+        tokenizer, train_df['cleaned_text'].tolist(), train_df['情感倾向'].tolist(), args.token_shards_dir
+    )
+    test_dataset = load_or_build_token_shards(
+        tokenizer, test_df['cleaned_text'].tolist(), test_df['情感倾向'].tolist(), args.token_shards_dir
+    )
+    print(f"训练集大小: {len(train_dataset)}")
+    print(f"测试集大小: {len(test_dataset)}")
+    
+    # 超参数搜索需要上面创建的数据集，搜索失败或不搜索时使用命令行参数；
+    # 恢复训练时学习率等由检查点中的优化器和调度器状态恢复，不再搜索
+    checkpoint_path = os.path.join(args.model_path, 'training_state.pt')
+    resume = args.resume and os.path.exists(checkpoint_path)
+    best_params = {'learning_rate': args.lr, 'weight_decay': args.weight_decay}
+    if args.n_trials > 0 and not resume:
+        search_params = run_hyperparameter_search(
+            train_dataset=train_dataset,
+            valid_dataset=test_dataset,
+            n_trials=args.n_trials,
+            n_jobs=args.n_jobs,
+            storage=args.storage,
+            study_name=args.study_name,
+            pruner=args.pruner
+        )
+        if search_params:
+            best_params.update(search_params)
+    print("\n使用的超参数:")
+    for param, value in best_params.items():
+        print(f"{param}: {value}")
+    
+    worker_args = (args, train_df, test_df, train_dataset, test_dataset, best_params, resume)
+    if args.num_processes > 1:
+        print(f"\n启动 {args.num_processes} 个数据并行训练进程")
+        launch(train_worker, args.num_processes, *worker_args)
+    else:
+        train_worker(0, 1, *worker_args)
+    
+    # 打印总训练时间
+    total_time = format_time(time.time() - start_time)
+    print(f"\n训练完成！总耗时: {total_time}")
+    print("最终模型已保存为 'final_model.pt'")
+    print("最佳模型已保存为 'best_model.pt'")
+
+def train_worker(rank, world_size, args, train_df, test_df, train_dataset, test_dataset, best_params, resume):
+    """训练一个模型；world_size > 1 时为数据并行的第 rank 个进程，只有 rank 0 打印、保存和评估"""
+    log = print if is_main_process() else (lambda *a, **k: None)
+    
+    log("\n3. 模型初始化")
     # 创建模型和tokenizer
     model, tokenizer = create_model_and_tokenizer(num_dimensions=3)
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"使用设备: {device}")
+    log(f"使用设备: {device}")
     model = model.to(device)
     
-    print("\n3. 创建数据集和加载器")
-    # 创建数据集
-    train_dataset = ChineseSentimentDataset(
-        texts=train_df['cleaned_text'].values,
-        labels=train_df['情感倾向'].values,
-        tokenizer=tokenizer
+    log("\n4. 创建数据加载器")
+    # 创建数据加载器：每个批次只填充到批内最长序列，训练集按长度分组后随机打乱批次；
+    # 数据并行时每个进程只加载自己的分片
+    train_loader = make_data_loader(
+        train_dataset, args.batch_size, shuffle=True, pad_token_id=tokenizer.pad_token_id,
+        num_workers=args.num_workers, num_replicas=world_size, rank=rank
     )
-    
-    test_dataset = ChineseSentimentDataset(
-        texts=test_df['cleaned_text'].values,
-        labels=test_df['情感倾向'].values,
-        tokenizer=tokenizer
+    test_loader = make_data_loader(
+        test_dataset, args.batch_size, shuffle=False, pad_token_id=tokenizer.pad_token_id,
+        num_workers=args.num_workers, num_replicas=world_size, rank=rank
     )
     
-    # 创建数据加载器
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True
-    )
+    # 冻结层输出只依赖输入，预先计算一次，之后每个 epoch 的训练和验证都只跑未冻结的层；
+    # 训练结束后的最终评估（ModelEvaluator）仍使用 test_loader 完整前向
+    train_batches, valid_batches = train_loader, test_loader
+    if args.feature_cache_dir:
+        print("\n冻结层缓存")
+        caches = [
+            load_or_build_feature_cache(
+                model, tokenizer, df['cleaned_text'].tolist(), args.feature_cache_dir, Config.MODEL_NAME,
+                Config.NUM_FROZEN_LAYERS, dtype=args.feature_cache_dtype, device=device
+            )
+            for df in (train_df, test_df)
+        ]
+        train_batches = make_data_loader(
+            CachedFeatureDataset(caches[0], train_df['情感倾向'].values), args.batch_size, shuffle=True
+        )
+        valid_batches = make_data_loader(
+            CachedFeatureDataset(caches[1], test_df['情感倾向'].values), args.batch_size, shuffle=False
+        )
     
-    test_loader = DataLoader(
-        test_dataset,
-        batch_size=args.batch_size,
-        shuffle=False
-    )
+    log(f"训练批次数: {len(train_batches)}")
+    log(f"测试批次数: {len(valid_batches)}")
     
-    print(f"训练集大小: {len(train_dataset)}")
-    print(f"测试集大小: {len(test_dataset)}")
-    print(f"训练批次数: {len(train_loader)}")
-    print(f"测试批次数: {len(test_loader)}")
+    if world_size > 1:
+        # 前向中用不到的模块不参与梯度同步；DDP 创建时把 rank 0 的参数广播给其他进程
+        model = wrap_model(freeze_unused_modules(model))
     
     # 使用最佳参数创建优化器
     optimizer = torch.optim.AdamW(
@@ -127,80 +220,80 @@ def main():
         weight_decay=best_params['weight_decay']
     )
     
-    # 创建学习率调度器
-    num_training_steps = len(train_loader) * args.epochs
+    # 创建学习率调度器：按优化步计数，梯度累积时每 accumulation_steps 个批次更新一次
+    num_training_steps = math.ceil(len(train_batches) / args.accumulation_steps) * args.epochs
     scheduler = get_linear_schedule_with_warmup(
         optimizer,
-        num_warmup_steps=num_training_steps * 0.1,
+        num_warmup_steps=num_training_steps * Config.WARMUP_RATIO,
         num_training_steps=num_training_steps
     )
     
-    print("\n4. 开始训练")
-    criterion = torch.nn.CrossEntropyLoss()
-    total_train_loss = 0
-    best_valid_loss = float('inf')
+    checkpoint_path = os.path.join(args.model_path, 'training_state.pt')
+    profiler = None
+    if args.profile:
+        # 数据并行时只由 rank 0 导出 trace
+        profiler = TrainingProfiler(
+            device, trace_dir=args.profile_trace_dir if is_main_process() else None,
+            trace_start=args.profile_trace_start, trace_steps=args.profile_trace_steps
+        )
+    trainer = SentimentTrainer(
+        model, optimizer, device,
+        scheduler=scheduler,
+        precision=args.precision,
+        accumulation_steps=args.accumulation_steps,
+        max_grad_norm=Config.GRADIENT_CLIP_VALUE,
+        checkpoint_path=checkpoint_path,
+        checkpoint_every=args.checkpoint_every,
+        profiler=profiler
+    )
+    if resume:
+        trainer.load_state(checkpoint_path)
     
-    for epoch in range(args.epochs):
-        print(f'\nEpoch {epoch+1}/{args.epochs}')
+    log("\n5. 开始训练")
+    log(f"训练精度: {trainer.precision}  梯度累积: {args.accumulation_steps}  进程数: {world_size}  "
+        f"等效批次大小: {args.batch_size * args.accumulation_steps * world_size}")
+    for epoch in range(trainer.epoch, args.epochs):
+        log(f'\nEpoch {epoch+1}/{args.epochs}')
         epoch_start_time = time.time()
         
         # 训练阶段
-        model.train()
-        train_loss = 0
-        
-        # 创建进度条
-        progress_bar = tqdm(train_loader, desc='Training', leave=True)
-        for batch_idx, batch in enumerate(progress_bar):
-            # 将数据移到设备上
-            batch = {k: v.to(device) for k, v in batch.items()}
-            
-            optimizer.zero_grad()
-            outputs = model(batch['input_ids'], batch['attention_mask'])
-            loss = criterion(outputs, batch['labels'])
-            loss.backward()
-            
-            optimizer.step()
-            scheduler.step()
-            
-            train_loss += loss.item()
-            
-            # 更新进度条
-            progress_bar.set_postfix({
-                'loss': f'{loss.item():.4f}',
-                'avg_loss': f'{train_loss/(batch_idx+1):.4f}'
-            })
-        
-        avg_train_loss = train_loss / len(train_loader)
-        
-        # 验证阶段
-        model.eval()
-        valid_loss = 0
-        print("\n验证中...")
+        avg_train_loss = trainer.train_epoch(train_batches)
         
-        with torch.no_grad():
-            for batch in tqdm(test_loader, desc='Validation'):
-                batch = {k: v.to(device) for k, v in batch.items()}
-                outputs = model(batch['input_ids'], batch['attention_mask'])
-                loss = criterion(outputs, batch['labels'])
-                valid_loss += loss.item()
-        
-        avg_valid_loss = valid_loss / len(test_loader)
+        # 验证阶段：数据并行时各进程验证自己的分片，损失汇总后所有进程一致
+        log("\n验证中...")
+        avg_valid_loss = trainer.evaluate(valid_batches, progress=True)
         
         # 打印每个epoch的统计信息
         epoch_time = format_time(time.time() - epoch_start_time)
-        print(f'\nEpoch 统计:')
-        print(f'  训练损失: {avg_train_loss:.4f}')
-        print(f'  验证损失: {avg_valid_loss:.4f}')
-        print(f'  耗时: {epoch_time}')
+        log(f'\nEpoch 统计:')
+        log(f'  训练损失: {avg_train_loss:.4f}')
+        log(f'  验证损失: {avg_valid_loss:.4f}')
+        log(f'  耗时: {epoch_time}')
+        
+        # 保存最佳模型；最佳验证损失随训练检查点保存，--resume 后只有更好的 epoch 才会覆盖
+        if avg_valid_loss < trainer.best_valid_loss:
+            trainer.best_valid_loss = avg_valid_loss
+            if is_main_process():
+                model_path = os.path.join(Config.MODEL_SAVE_PATH, 'best_model.pt')
+                save_checkpoint(unwrap_model(model), model_path)
+                print("  保存新的最佳模型")
         
-        # 保存最佳模型
-        if avg_valid_loss < best_valid_loss:
-            best_valid_loss = avg_valid_loss
-            model_path = os.path.join(Config.MODEL_SAVE_PATH, 'best_model.pt')
-            torch.save(model.state_dict(), model_path)
-            print("  保存新的最佳模型")
-    
-    print("\n5. 模型评估")
+        # epoch 结束时保存训练检查点，--resume 从下一个 epoch 继续
+        trainer.save_state(checkpoint_path)
+    if profiler is not None:
+        profiler.close()
+    
+    if not is_main_process():
+        return
+    
+    print("\n6. 模型评估")
+    model = unwrap_model(model)
+    if world_size > 1:
+        # rank 0 在完整测试集上评估
+        test_loader = make_data_loader(
+            test_dataset, args.batch_size, shuffle=False, pad_token_id=tokenizer.pad_token_id,
+            num_workers=args.num_workers
+        )
     evaluator = ModelEvaluator(model, tokenizer, device)
     metrics = evaluator.evaluate(test_loader)
     
@@ -208,13 +301,7 @@ def main():
     print(metrics['classification_report'])
     
     # 保存最终模型
-    torch.save(model.state_dict(), 'final_model.pt')
-    
-    # 打印总训练时间
-    total_time = format_time(time.time() - start_time)
-    print(f"\n训练完成！总耗时: {total_time}")
-    print("最终模型已保存为 'final_model.pt'")
-    print("最佳模型已保存为 'best_model.pt'")
+    save_checkpoint(model, 'final_model.pt')
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
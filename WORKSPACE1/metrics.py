@@ -0,0 +1,55 @@
+import os
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess
+)
+
+# 推理各阶段：tokenize / forward / postprocess 在模型线程内计时，serialize 为生成 JSON 响应
+STAGE_LATENCY = Histogram(
+    'sentiment_stage_latency_seconds',
+    '推理各阶段耗时（秒）',
+    ['stage'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+BATCH_SIZE = Histogram(
+    'sentiment_batch_size',
+    '每次模型前向处理的文本条数',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+QUEUE_DEPTH = Gauge(
+    'sentiment_queue_depth',
+    '等待推理的请求数',
+    multiprocess_mode='livesum'
+)
+IN_FLIGHT = Gauge(
+    'sentiment_in_flight_requests',
+    '正在处理中的 HTTP 请求数',
+    multiprocess_mode='livesum'
+)
+MODEL_LOAD_SECONDS = Gauge(
+    'sentiment_model_load_seconds',
+    '启动时加载模型各阶段耗时（秒）',
+    ['stage'],
+    multiprocess_mode='max'
+)
+
+def observe_batch(batch_size, timings):
+    """记录一次批量推理：批大小和 predict_sentiment_batch 返回的各阶段耗时"""
+    BATCH_SIZE.observe(batch_size)
+    for stage, seconds in timings.items():
+        STAGE_LATENCY.labels(stage).observe(seconds)
+
+def record_startup(timings):
+    for stage, seconds in timings.items():
+        MODEL_LOAD_SECONDS.labels(stage).set(seconds)
+
+def render():
+    """返回 (Prometheus 文本格式指标, Content-Type)
+
+    多进程部署（serve_prefork.py）时设置环境变量 PROMETHEUS_MULTIPROC_DIR，
+    各工作进程的指标写入该目录，任一进程响应 /metrics 都会汇总所有进程的数据
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
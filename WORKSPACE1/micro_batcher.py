@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+
+class _PendingRequest:
+    __slots__ = ('text', 'future', 'enqueue_time')
+
+    def __init__(self, text):
+        self.text = text
+        self.future = Future()
+        self.enqueue_time = time.perf_counter()
+
+
+class MicroBatcher:
+    """把时间窗口内到达的单条请求合并成一个批次推理，再把结果拆回给各个调用方"""
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=10):
+        # predict_fn 接收文本列表，返回等长的结果列表
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._worker = None
+        self._stopped = threading.Event()
+
+        # 统计信息
+        self.batch_size_counts = Counter()
+        self.total_requests = 0
+        self.total_batches = 0
+        self.total_unique_texts = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def start(self):
+        """启动后台批处理线程"""
+        if self._worker is None or not self._worker.is_alive():
+            self._stopped.clear()
+            self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self, timeout=None):
+        """停止后台线程，队列中尚未处理的请求会先处理完"""
+        self._stopped.set()
+        self._queue.put(None)
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def submit(self, text):
+        """提交一条文本，返回 Future"""
+        if self._stopped.is_set():
+            raise RuntimeError('MicroBatcher 已停止')
+        request = _PendingRequest(text)
+        self._queue.put(request)
+        return request.future
+
+    def predict(self, text, timeout=None):
+        """提交一条文本并阻塞等待结果"""
+        return self.submit(text).result(timeout)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _collect_batch(self):
+        """阻塞等待第一条请求，然后在窗口期内继续收集直到批次满或超时"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        # 窗口从第一条请求入队开始计算，保证单条请求的额外等待不超过 max_wait
+        deadline = first.enqueue_time + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # 收到停止信号，先处理当前批次
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            self._process_batch(batch)
+
+    def _process_batch(self, batch):
+        start = time.perf_counter()
+
+        # 批内去重：相同文本只推理一次
+        unique_texts = list(dict.fromkeys(request.text for request in batch))
+        self._record_batch(batch, len(unique_texts), start)
+
+        try:
+            results = self.predict_fn(unique_texts)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        result_map = dict(zip(unique_texts, results))
+        for request in batch:
+            request.future.set_result(result_map[request.text])
+
+    def _record_batch(self, batch, num_unique, start):
+        waits = [start - request.enqueue_time for request in batch]
+        with self._stats_lock:
+            self.batch_size_counts[len(batch)] += 1
+            self.total_requests += len(batch)
+            self.total_batches += 1
+            self.total_unique_texts += num_unique
+            self.total_queue_wait += sum(waits)
+            self.max_queue_wait = max(self.max_queue_wait, max(waits))
+
+    def stats(self):
+        """返回批大小与排队等待时间的统计"""
+        with self._stats_lock:
+            total_requests = self.total_requests
+            total_batches = self.total_batches
+            return {
+                'total_requests': total_requests,
+                'total_batches': total_batches,
+                'avg_batch_size': total_requests / total_batches if total_batches else 0.0,
+                'batch_size_distribution': {
+                    str(size): count for size, count in sorted(self.batch_size_counts.items())
+                },
+                'deduplicated_requests': total_requests - self.total_unique_texts,
+                'avg_queue_wait_ms': 1000 * self.total_queue_wait / total_requests if total_requests else 0.0,
+                'max_queue_wait_ms': 1000 * self.max_queue_wait,
+                'queue_depth': self.queue_depth(),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': 1000 * self.max_wait,
+            }
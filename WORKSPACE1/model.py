@@ -1,39 +1,140 @@
+import contextlib
+import copy
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn as nn
-from transformers import BertModel, BertTokenizer
+from transformers import BertModel
 from torch.utils.data import Dataset, DataLoader
 import jieba
 import numpy as np
 from sklearn.model_selection import train_test_split
 import torch.nn.functional as F
+from tqdm import tqdm
+from distributed import all_reduce_sum, is_main_process, unwrap_model
+from tokenization import encode_batch, load_tokenizer, pad_batch
+
+def build_feature_layer(hidden_size):
+    """[CLS] 表示之后的特征提取层"""
+    return nn.Sequential(
+        nn.Linear(hidden_size, hidden_size),
+        nn.LayerNorm(hidden_size),
+        nn.GELU(),
+        nn.Dropout(0.1)
+    )
+
+def build_dimension_head(hidden_size):
+    """单个维度的分类头"""
+    return nn.Sequential(
+        nn.Linear(hidden_size, 512),
+        nn.LayerNorm(512),
+        nn.GELU(),
+        nn.Dropout(0.1),
+        nn.Linear(512, 128),
+        nn.LayerNorm(128),
+        nn.GELU(),
+        nn.Linear(128, 1)
+    )
+
+class FusedDimensionHeads(nn.Module):
+    """把 num_dimensions 个结构相同的维度分类头合并为批量矩阵运算，只用于推理
+
+    第一层所有维度共享输入，合并成一个 Linear；后两层用 baddbmm 一次算完所有维度，
+    每层只需一次 kernel 调用，不再随维度数增加 Python 循环和小算子的开销
+    """
+
+    def __init__(self, num_dimensions, hidden_size, eps=1e-5):
+        super().__init__()
+        self.num_dimensions = num_dimensions
+        self.eps = eps
+        self.fc1 = nn.Linear(hidden_size, num_dimensions * 512)
+        self.ln1_weight = nn.Parameter(torch.ones(num_dimensions, 1, 512))
+        self.ln1_bias = nn.Parameter(torch.zeros(num_dimensions, 1, 512))
+        self.fc2_weight = nn.Parameter(torch.empty(num_dimensions, 512, 128))
+        self.fc2_bias = nn.Parameter(torch.zeros(num_dimensions, 1, 128))
+        self.ln2_weight = nn.Parameter(torch.ones(num_dimensions, 1, 128))
+        self.ln2_bias = nn.Parameter(torch.zeros(num_dimensions, 1, 128))
+        self.fc3_weight = nn.Parameter(torch.empty(num_dimensions, 128, 1))
+        self.fc3_bias = nn.Parameter(torch.zeros(num_dimensions, 1, 1))
+
+    def __len__(self):
+        return self.num_dimensions
+
+    @classmethod
+    @torch.no_grad()
+    def from_heads(cls, heads):
+        """从 build_dimension_head 构建的分类头列表无损转换"""
+        fc1, ln1, fc2, ln2, fc3 = (
+            [head[index] for head in heads] for index in (0, 1, 4, 5, 7)
+        )
+        fused = cls(len(heads), fc1[0].in_features, eps=ln1[0].eps).to(fc1[0].weight.device)
+        fused.fc1.weight.copy_(torch.cat([layer.weight for layer in fc1]))
+        fused.fc1.bias.copy_(torch.cat([layer.bias for layer in fc1]))
+        fused.ln1_weight.copy_(torch.stack([layer.weight for layer in ln1]).unsqueeze(1))
+        fused.ln1_bias.copy_(torch.stack([layer.bias for layer in ln1]).unsqueeze(1))
+        fused.fc2_weight.copy_(torch.stack([layer.weight.t() for layer in fc2]))
+        fused.fc2_bias.copy_(torch.stack([layer.bias for layer in fc2]).unsqueeze(1))
+        fused.ln2_weight.copy_(torch.stack([layer.weight for layer in ln2]).unsqueeze(1))
+        fused.ln2_bias.copy_(torch.stack([layer.bias for layer in ln2]).unsqueeze(1))
+        fused.fc3_weight.copy_(torch.stack([layer.weight.t() for layer in fc3]))
+        fused.fc3_bias.copy_(torch.stack([layer.bias for layer in fc3]).unsqueeze(1))
+        return fused
+
+    def forward(self, features):
+        batch_size = features.size(0)
+        # [batch_size, num_dimensions * 512] -> [num_dimensions, batch_size, 512]
+        x = self.fc1(features).view(batch_size, self.num_dimensions, 512).transpose(0, 1)
+        x = F.gelu(F.layer_norm(x, (512,), eps=self.eps) * self.ln1_weight + self.ln1_bias)
+        x = torch.baddbmm(self.fc2_bias, x, self.fc2_weight)  # [num_dimensions, batch_size, 128]
+        x = F.gelu(F.layer_norm(x, (128,), eps=self.eps) * self.ln2_weight + self.ln2_bias)
+        x = torch.baddbmm(self.fc3_bias, x, self.fc3_weight)  # [num_dimensions, batch_size, 1]
+        return x.squeeze(-1).t()  # [batch_size, num_dimensions]
+
+def classify_features(dimension_heads, features):
+    """各维度分类头打分并取 log_softmax；合并后的分类头一次算完所有维度"""
+    if isinstance(dimension_heads, FusedDimensionHeads):
+        final_scores = dimension_heads(features)  # [batch_size, num_dimensions]
+    else:
+        dimension_scores = []
+        for head in dimension_heads:
+            score = head(features)  # [batch_size, 1]
+            dimension_scores.append(score)
+        
+        # 合并所有维度的分数
+        final_scores = torch.cat(dimension_scores, dim=1)  # [batch_size, num_dimensions]
+    
+    # 应用 log_softmax
+    return F.log_softmax(final_scores, dim=1)
+
+def extended_attention_mask(attention_mask, dtype):
+    """[batch_size, 1, 1, seq_len] 的加性掩码，padding 位置为极小值，逐层调用编码层时使用"""
+    return (1.0 - attention_mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+
+def run_encoder_layer(encoder_layer, hidden_states, extended_mask):
+    layer_outputs = encoder_layer(hidden_states, attention_mask=extended_mask)
+    # 旧版 transformers 的 BertLayer 返回 tuple
+    return layer_outputs[0] if isinstance(layer_outputs, tuple) else layer_outputs
 
 class MultiDimensionalSentimentModel(nn.Module):
-    def __init__(self, pretrained_model_name='hfl/chinese-roberta-wwm-ext-large', num_dimensions=2):
+    def __init__(self, pretrained_model_name='hfl/chinese-roberta-wwm-ext-large', num_dimensions=2,
+                 bert_config=None, exit_layers=None):
         super().__init__()
-        # 加载预训练模型
-        self.bert = BertModel.from_pretrained(pretrained_model_name)
+        if bert_config is not None:
+            # 只按配置构建结构，不加载预训练权重（权重随后从微调检查点载入）
+            self.bert = BertModel(bert_config)
+        else:
+            # 加载预训练模型
+            self.bert = BertModel.from_pretrained(pretrained_model_name)
         hidden_size = self.bert.config.hidden_size  # RoBERTa-large的hidden_size为1024
         
         # 特征提取层
-        self.feature_layer = nn.Sequential(
-            nn.Linear(hidden_size, hidden_size),
-            nn.LayerNorm(hidden_size),
-            nn.GELU(),
-            nn.Dropout(0.1)
-        )
+        self.feature_layer = build_feature_layer(hidden_size)
         
         # 多维度情感分析层
         self.dimension_heads = nn.ModuleList([
-            nn.Sequential(
-                nn.Linear(hidden_size, 512),
-                nn.LayerNorm(512),
-                nn.GELU(),
-                nn.Dropout(0.1),
-                nn.Linear(512, 128),
-                nn.LayerNorm(128),
-                nn.GELU(),
-                nn.Linear(128, 1)
-            ) for _ in range(num_dimensions)
+            build_dimension_head(hidden_size) for _ in range(num_dimensions)
         ])
         
         # 注意力机制层
@@ -51,18 +152,50 @@ class MultiDimensionalSentimentModel(nn.Module):
             nn.Dropout(0.1)
         )
         
+        # 提前退出分类头：挂在指定编码层（从1开始计数）之后，置信度足够时不再计算后续层
+        num_layers = self.bert.config.num_hidden_layers
+        self.exit_layers = sorted(set(exit_layers or []))
+        for layer in self.exit_layers:
+            if not 1 <= layer < num_layers:
+                raise ValueError(f"提前退出层必须在 1 到 {num_layers - 1} 之间: {layer}")
+        self.exit_heads = nn.ModuleDict({
+            str(layer): nn.Sequential(
+                nn.Dropout(0.1),
+                nn.Linear(hidden_size, num_dimensions)
+            ) for layer in self.exit_layers
+        })
+        
     def forward(self, input_ids, attention_mask):
         # 获取BERT输出
         outputs = self.bert(
             input_ids=input_ids,
             attention_mask=attention_mask,
-            output_hidden_states=True,
             return_dict=True
         )
         
         # 使用最后一层的隐藏状态
-        hidden_states = outputs.last_hidden_state  # [batch_size, seq_len, hidden_size]
-        
+        return self._classify(outputs.last_hidden_state)
+
+    def fuse_heads(self):
+        """原地转换为推理结构：维度分类头合并为批量矩阵运算，去掉前向中用不到的模块
+
+        输出与转换前一致（在浮点误差范围内）；转换后只用于推理，不再保存为检查点
+        """
+        self.dimension_heads = FusedDimensionHeads.from_heads(self.dimension_heads)
+        del self.cross_attention
+        del self.sentiment_enhancement
+        # pooler 输出在前向中没有使用
+        self.bert.pooler = None
+        return self
+
+    def forward_from_layer(self, hidden_states, attention_mask, start_layer):
+        """从第 start_layer 层的输出（如缓存的冻结层激活）继续前向，输出与 forward 相同"""
+        extended_mask = extended_attention_mask(attention_mask, hidden_states.dtype)
+        for encoder_layer in self.bert.encoder.layer[start_layer:]:
+            hidden_states = run_encoder_layer(encoder_layer, hidden_states, extended_mask)
+        return self._classify(hidden_states)
+
+    def _classify(self, hidden_states):
         # 使用 [CLS] token 的表示
         cls_output = hidden_states[:, 0, :]  # [batch_size, hidden_size]
         
@@ -70,16 +203,50 @@ class MultiDimensionalSentimentModel(nn.Module):
         features = self.feature_layer(cls_output)  # [batch_size, hidden_size]
         
         # 多维度情感分析
-        dimension_scores = []
-        for head in self.dimension_heads:
-            score = head(features)  # [batch_size, 1]
-            dimension_scores.append(score)
-        
-        # 合并所有维度的分数
-        final_scores = torch.cat(dimension_scores, dim=1)  # [batch_size, 3]
-        
-        # 应用 log_softmax
-        return F.log_softmax(final_scores, dim=1)  # [batch_size, 3]
+        return classify_features(self.dimension_heads, features)  # [batch_size, 3]
+
+    def _exit_output(self, layer, hidden_states):
+        return F.log_softmax(self.exit_heads[str(layer)](hidden_states[:, 0, :]), dim=1)
+
+    def forward_early_exit(self, input_ids, attention_mask, threshold):
+        """逐层前向，样本在某个退出头的最大概率达到 threshold 时提前退出，其余样本继续计算
+
+        返回 (log_softmax 输出, 每个样本实际计算的层数)
+        """
+        num_layers = self.bert.config.num_hidden_layers
+        batch_size = input_ids.size(0)
+        exit_layer = torch.full((batch_size,), num_layers, dtype=torch.long, device=input_ids.device)
+        active = torch.arange(batch_size, device=input_ids.device)  # 尚未退出的样本在原批次中的位置
+        outputs = None
+
+        hidden_states = self.bert.embeddings(input_ids=input_ids)
+        extended_mask = extended_attention_mask(attention_mask, hidden_states.dtype)
+        for layer, encoder_layer in enumerate(self.bert.encoder.layer, start=1):
+            hidden_states = run_encoder_layer(encoder_layer, hidden_states, extended_mask)
+            if str(layer) not in self.exit_heads:
+                continue
+
+            log_probs = self._exit_output(layer, hidden_states)
+            if outputs is None:
+                outputs = log_probs.new_empty(batch_size, log_probs.size(1))
+            done = log_probs.exp().max(dim=1).values >= threshold
+            if not done.any():
+                continue
+            outputs[active[done]] = log_probs[done]
+            exit_layer[active[done]] = layer
+            # 只保留未退出的样本继续计算后续层
+            keep = ~done
+            active = active[keep]
+            hidden_states = hidden_states[keep]
+            extended_mask = extended_mask[keep]
+            if active.numel() == 0:
+                return outputs, exit_layer
+
+        final = self._classify(hidden_states)
+        if outputs is None:
+            outputs = final.new_empty(batch_size, final.size(1))
+        outputs[active] = final
+        return outputs, exit_layer
 
 class ChineseSentimentDataset(Dataset):
     def __init__(self, texts, labels, tokenizer, max_length=512):
@@ -87,37 +254,71 @@ class ChineseSentimentDataset(Dataset):
         self.labels = labels
         self.tokenizer = tokenizer
         self.max_length = max_length
+        # 构建数据集时一次批量分词，__getitem__ 只做填充
+        self.all_input_ids = encode_batch(tokenizer, texts, max_length)
+        self.lengths = [len(input_ids) for input_ids in self.all_input_ids]
         
     def __len__(self):
         return len(self.texts)
     
     def __getitem__(self, idx):
-        text = str(self.texts[idx])
         label = self.labels[idx]
         
-        # BERT tokenization
-        encoding = self.tokenizer(
-            text,
-            add_special_tokens=True,
-            max_length=self.max_length,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
+        # 填充到 max_length
+        input_ids, attention_mask = pad_batch(self.tokenizer, [self.all_input_ids[idx]], self.max_length)
         
         return {
-            'input_ids': encoding['input_ids'].flatten(),
-            'attention_mask': encoding['attention_mask'].flatten(),
+            'input_ids': input_ids[0],
+            'attention_mask': attention_mask[0],
             'labels': torch.tensor(label, dtype=torch.long)
         }
 
 def train_model(model, train_loader, valid_loader, criterion, optimizer, 
-                n_epochs, device, scheduler=None):
-    best_valid_loss = float('inf')
-    
+                n_epochs, device, scheduler=None, batch_size=16, precision='fp32', accumulation_steps=1,
+                checkpoint_path=None, checkpoint_every=0, profiler=None):
+    """用 SentimentTrainer 训练，验证损失最低时保存 best_model.pt
+
+    train_loader / valid_loader 也可以直接传数据集，此时按 batch_size 动态填充并按长度分组采样；
+    传入 TrainingProfiler 时每个 epoch 打印训练步耗时分解
+    """
+    if isinstance(train_loader, Dataset) or isinstance(valid_loader, Dataset):
+        from batching import make_data_loader
+        if isinstance(train_loader, Dataset):
+            train_loader = make_data_loader(train_loader, batch_size, shuffle=True)
+        if isinstance(valid_loader, Dataset):
+            valid_loader = make_data_loader(valid_loader, batch_size, shuffle=False)
+    trainer = SentimentTrainer(
+        model, optimizer, device, scheduler=scheduler, criterion=criterion, precision=precision,
+        accumulation_steps=accumulation_steps, checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every,
+        profiler=profiler
+    )
     for epoch in range(n_epochs):
-        # 训练模式
-        model.train()
+        train_loss = trainer.train_epoch(train_loader, progress=False)
+        
+        # 验证
+        valid_loss = trainer.evaluate(valid_loader)
+        
+        print(f'Epoch: {epoch+1}')
+        print(f'\tTrain Loss: {train_loss:.3f}')
+        print(f'\tValid Loss: {valid_loss:.3f}')
+        
+        if valid_loss < trainer.best_valid_loss:
+            trainer.best_valid_loss = valid_loss
+            torch.save(model.state_dict(), 'best_model.pt')
+
+def train_exit_heads(model, train_loader, optimizer, n_epochs, device):
+    """冻结主干和最终分类头，只训练提前退出头
+
+    主干在 no_grad 下前向，每个退出头以真实标签计算 NLL 损失，各头损失相加
+    """
+    for param in model.parameters():
+        param.requires_grad = False
+    for param in model.exit_heads.parameters():
+        param.requires_grad = True
+
+    for epoch in range(n_epochs):
+        model.eval()  # 主干保持推理模式（关闭 dropout）
+        model.exit_heads.train()
         train_loss = 0
         
         for batch in train_loader:
@@ -125,35 +326,29 @@ def train_model(model, train_loader, valid_loader, criterion, optimizer,
             attention_mask = batch['attention_mask'].to(device)
             labels = batch['labels'].to(device)
             
-            optimizer.zero_grad()
+            with torch.no_grad():
+                hidden_states = model.bert(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    output_hidden_states=True,
+                    return_dict=True
+                ).hidden_states
             
-            outputs = model(
-                input_ids=input_ids,
-                attention_mask=attention_mask
+            optimizer.zero_grad()
+            loss = sum(
+                F.nll_loss(model._exit_output(layer, hidden_states[layer]), labels)
+                for layer in model.exit_layers
             )
-            
-            loss = criterion(outputs, labels)
             loss.backward()
-            
-            # 梯度裁剪
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            
             optimizer.step()
-            if scheduler:
-                scheduler.step()
             
             train_loss += loss.item()
         
-        # 验证
-        valid_loss = evaluate_model(model, valid_loader, criterion, device)
-        
         print(f'Epoch: {epoch+1}')
-        print(f'\tTrain Loss: {train_loss/len(train_loader):.3f}')
-        print(f'\tValid Loss: {valid_loss:.3f}')
-        
-        if valid_loss < best_valid_loss:
-            best_valid_loss = valid_loss
-            torch.save(model.state_dict(), 'best_model.pt')
+        print(f'\tExit Heads Loss: {train_loss/len(train_loader):.3f}')
+    
+    model.eval()
+    return model
 
 def evaluate_model(model, data_loader, criterion, device):
     model.eval()
@@ -175,55 +370,262 @@ def evaluate_model(model, data_loader, criterion, device):
     
     return total_loss / len(data_loader)
 
-def create_model_and_tokenizer(num_dimensions=5):
+def freeze_lower_layers(model, num_layers):
+    """冻结 embedding 和前 num_layers 个编码层"""
+    for param in model.bert.embeddings.parameters():
+        param.requires_grad = False
+    for i in range(num_layers):
+        for param in model.bert.encoder.layer[i].parameters():
+            param.requires_grad = False
+    return model
+
+def freeze_unused_modules(model):
+    """冻结 forward 中没有用到的模块（cross_attention、sentiment_enhancement、pooler、提前退出头）
+
+    这些参数本来就得不到梯度，冻结不改变训练结果；数据并行时 DDP 不必再用
+    find_unused_parameters 每步遍历计算图查找未参与计算的参数
+    """
+    unused = [model.cross_attention, model.sentiment_enhancement, model.bert.pooler, model.exit_heads]
+    for module in unused:
+        if module is None:
+            continue
+        for param in module.parameters():
+            param.requires_grad = False
+    return model
+
+def create_model_and_tokenizer(num_dimensions=5, num_frozen_layers=12):
     model_name = 'hfl/chinese-roberta-wwm-ext-large'
-    tokenizer = BertTokenizer.from_pretrained(model_name)
+    tokenizer = load_tokenizer(model_name)
     model = MultiDimensionalSentimentModel(
         pretrained_model_name=model_name,
         num_dimensions=num_dimensions
     )
     
-    # 冻结部分BERT层以节省显存
-    for param in model.bert.embeddings.parameters():
-        param.requires_grad = False
-    for i in range(12):  # 冻结前12层
-        for param in model.bert.encoder.layer[i].parameters():
-            param.requires_grad = False
+    # 冻结部分BERT层以节省显存（默认冻结前12层）
+    freeze_lower_layers(model, num_frozen_layers)
             
     return model, tokenizer
 
+PRECISIONS = ('auto', 'fp32', 'bf16', 'fp16')
+
+def resolve_precision(precision, device):
+    """把 'auto' 换成具体精度：CUDA 上用混合精度（支持 bf16 时用 bf16，否则 fp16），
+    CPU 支持 bf16 指令（AVX512-BF16/AMX）时用 bf16，否则 fp32"""
+    if precision not in PRECISIONS:
+        raise ValueError(f"不支持的精度: {precision}，可选 {PRECISIONS}")
+    if precision == 'fp16' and device.type != 'cuda':
+        raise ValueError("fp16 混合精度只支持 CUDA，CPU 请使用 bf16")
+    if precision != 'auto':
+        return precision
+    if device.type == 'cuda':
+        return 'bf16' if torch.cuda.is_bf16_supported() else 'fp16'
+    if device.type == 'cpu' and torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        return 'bf16'
+    return 'fp32'
+
 class SentimentTrainer:
-    def __init__(self):
-        self.scaler = torch.amp.GradScaler('cuda')  # 更新为新的写法
-        self.accumulation_steps = 4
-        
-    def train_step(self, batch, model, criterion):
-        # 1. 混合精度训练
-        with torch.amp.autocast('cuda'):  # 更新为新的写法
-            # 生成对抗样本
-            embeds = model.bert.embeddings(batch['input_ids'])
-            delta = torch.zeros_like(embeds).uniform_(-self.eps, self.eps)
-            delta.requires_grad = True
-            
-            # 前向传播
-            outputs = model(batch['input_ids'], batch['attention_mask'])
-            loss = criterion(outputs, batch['labels'])
-            
-            # 梯度累积
-            loss = loss / self.accumulation_steps
-            
-        # 反向传播
-        self.scaler.scale(loss).backward()
-        
-        if (self.step + 1) % self.accumulation_steps == 0:
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
-            self.optimizer.zero_grad()
-            
-        return loss.item() * self.accumulation_steps
-    
-    def quantize_model(self, model):
-        # 模型量化
+    """训练引擎：混合精度、梯度累积、梯度裁剪、学习率调度和定期保存训练检查点
+
+    bf16 在 autocast 下前向（CPU 和 CUDA 均可），fp16 只用于 CUDA 并配合 GradScaler；
+    每 accumulation_steps 个批次执行一次优化步，调度器按优化步更新；
+    checkpoint_every > 0 时每隔这么多优化步把模型、优化器、调度器等状态写入 checkpoint_path，
+    load_state 可从中断处继续训练。
+
+    model 可以是 DistributedDataParallel：累积中间的批次不同步梯度，损失在各进程间汇总，
+    检查点和进度条只在 rank 0 上输出。
+
+    profiler 为 TrainingProfiler 时记录每步各阶段耗时并在 epoch 结束时打印汇总，为 None 时不做任何计时
+    """
+
+    def __init__(self, model, optimizer, device, scheduler=None, criterion=None, precision='auto',
+                 accumulation_steps=1, max_grad_norm=1.0, checkpoint_path=None, checkpoint_every=0,
+                 forward_fn=None, profiler=None):
+        from feature_cache import forward_batch
+        self.model = model
+        self.optimizer = optimizer
+        self.device = device
+        self.scheduler = scheduler
+        self.criterion = criterion or nn.CrossEntropyLoss()
+        self.precision = resolve_precision(precision, device)
+        self.accumulation_steps = accumulation_steps
+        self.max_grad_norm = max_grad_norm
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        # 缓存批次从冻结层之后开始前向，普通批次完整前向
+        self.forward_fn = forward_fn or forward_batch
+        self.scaler = torch.amp.GradScaler('cuda') if self.precision == 'fp16' else None
+        self.profiler = profiler
+
+        self.global_step = 0  # 已执行的优化步数
+        self.epoch = 0  # 已完成的 epoch 数
+        self.batches_done = 0  # 当前 epoch 已训练的批次数，从检查点恢复时跳过这些批次
+        self.best_valid_loss = float('inf')  # 已保存的最佳模型的验证损失，随检查点保存，恢复后不会被更差的 epoch 覆盖
+        self._pending = 0  # 已累积梯度、尚未执行优化步的批次数
+
+    def autocast(self):
+        if self.precision == 'fp32':
+            return contextlib.nullcontext()
+        dtype = torch.bfloat16 if self.precision == 'bf16' else torch.float16
+        return torch.autocast(self.device.type, dtype=dtype)
+
+    def _to_device(self, batch):
+        return {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+    def _phase(self, name):
+        return self.profiler.phase(name) if self.profiler is not None else contextlib.nullcontext()
+
+    def train_step(self, batch, last_batch=False):
+        """前向并反向一个批次，累积满 accumulation_steps 个批次后执行优化步，返回该批次的损失
+
+        last_batch=True 表示 epoch 的最后一个批次，之后会用不满的累积梯度执行优化步，数据并行时需要同步梯度
+        """
+        if self.profiler is not None:
+            num_samples, num_tokens = batch['labels'].size(0), int(batch['attention_mask'].sum())
+        with self._phase('h2d'):
+            batch = self._to_device(batch)
+        sync = last_batch or self._pending + 1 == self.accumulation_steps
+        # 数据并行时只在执行优化步前的最后一个批次 all-reduce 梯度
+        no_sync = getattr(self.model, 'no_sync', None)
+        with (no_sync() if no_sync is not None and not sync else contextlib.nullcontext()):
+            with self._phase('forward'):
+                with self.autocast():
+                    outputs = self.forward_fn(self.model, batch)
+                # 损失在 fp32 下计算
+                loss = self.criterion(outputs.float(), batch['labels'])
+                scaled_loss = loss / self.accumulation_steps
+            with self._phase('backward'):
+                if self.scaler is not None:
+                    self.scaler.scale(scaled_loss).backward()
+                else:
+                    scaled_loss.backward()
+
+        self.batches_done += 1
+        self._pending += 1
+        if self._pending == self.accumulation_steps:
+            self.optimizer_step()
+        if self.profiler is not None:
+            self.profiler.step_end(num_samples, num_tokens)
+        return loss.item()
+
+    def optimizer_step(self):
+        """用已累积的梯度执行一次优化步（没有累积的梯度时什么也不做）"""
+        if self._pending == 0:
+            return
+        with self._phase('optimizer'):
+            if self.scaler is not None:
+                # 先还原梯度的真实大小再裁剪
+                self.scaler.unscale_(self.optimizer)
+            if self.max_grad_norm:
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+            if self.scaler is not None:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+            else:
+                self.optimizer.step()
+            self.optimizer.zero_grad(set_to_none=True)
+            if self.scheduler is not None:
+                self.scheduler.step()
+        self._pending = 0
+        self.global_step += 1
+
+        if self.checkpoint_path and self.checkpoint_every and self.global_step % self.checkpoint_every == 0:
+            self.save_state(self.checkpoint_path)
+
+    def train_epoch(self, data_loader, progress=True):
+        """训练一个 epoch，返回平均损失；epoch 末尾不足 accumulation_steps 的批次也会执行一次优化步"""
+        self.model.train()
+        # 按长度分组等采样器按 epoch 编号决定顺序，恢复训练时能重现中断前的批次顺序
+        sampler = getattr(data_loader, 'sampler', None)
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(self.epoch)
+
+        skip = self.batches_done
+        total_loss = 0
+        num_batches = 0
+        last_idx = len(data_loader) - 1
+        # 开启分析时由 profiler 逐个取批次，统计等待 DataLoader 的时间
+        batches = self.profiler.iterate(data_loader) if self.profiler is not None else data_loader
+        progress_bar = tqdm(batches, desc='Training', total=len(data_loader), leave=True,
+                            disable=not (progress and is_main_process()))
+        for batch_idx, batch in enumerate(progress_bar):
+            if batch_idx < skip:
+                continue
+            loss = self.train_step(batch, last_batch=batch_idx == last_idx)
+            total_loss += loss
+            num_batches += 1
+            progress_bar.set_postfix({
+                'loss': f'{loss:.4f}',
+                'avg_loss': f'{total_loss / num_batches:.4f}'
+            })
+        self.optimizer_step()
+
+        self.epoch += 1
+        self.batches_done = 0
+        if self.profiler is not None:
+            self.profiler.epoch_end(self.epoch)
+        total_loss, num_batches = all_reduce_sum([total_loss, num_batches])
+        return total_loss / max(num_batches, 1)
+
+    def evaluate(self, data_loader, progress=False):
+        """返回验证集平均损失；数据并行时各进程评估自己的分片，再汇总为全体的平均损失"""
+        # 评估不需要同步梯度，直接用原模型前向，各进程的批次数可以不同
+        model = unwrap_model(self.model)
+        model.eval()
+        total_loss = 0
+        num_batches = 0
+        with torch.no_grad(), self.autocast():
+            for batch in tqdm(data_loader, desc='Validation', disable=not (progress and is_main_process())):
+                batch = self._to_device(batch)
+                outputs = self.forward_fn(model, batch)
+                total_loss += self.criterion(outputs.float(), batch['labels']).item()
+                num_batches += 1
+        total_loss, num_batches = all_reduce_sum([total_loss, num_batches])
+        return total_loss / max(num_batches, 1)
+
+    def state_dict(self):
+        return {
+            'model': unwrap_model(self.model).state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'scaler': self.scaler.state_dict() if self.scaler is not None else None,
+            'global_step': self.global_step,
+            'epoch': self.epoch,
+            'batches_done': self.batches_done,
+            'best_valid_loss': self.best_valid_loss,
+        }
+
+    def save_state(self, path):
+        """写入训练检查点：先写临时文件再改名，中断时不会留下损坏的检查点；数据并行时只由 rank 0 写入"""
+        if not is_main_process():
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        torch.save(self.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_state(self, path):
+        """从训练检查点恢复，之后的 train_epoch 从中断的 epoch 和批次继续"""
+        state = torch.load(path, map_location=self.device, weights_only=False)
+        unwrap_model(self.model).load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        if self.scaler is not None and state['scaler'] is not None:
+            self.scaler.load_state_dict(state['scaler'])
+        self.global_step = state['global_step']
+        self.epoch = state['epoch']
+        self.batches_done = state['batches_done']
+        # 旧检查点没有记录最佳验证损失
+        self.best_valid_loss = state.get('best_valid_loss', float('inf'))
+        self._pending = 0
+        if is_main_process():
+            print(f"从训练检查点恢复: {path} (epoch {self.epoch + 1}, 第 {self.batches_done} 个批次, "
+                  f"{self.global_step} 个优化步)")
+
+    @staticmethod
+    def quantize_model(model):
+        # 模型量化（动态 INT8，作用于所有 nn.Linear）
         return torch.quantization.quantize_dynamic(
             model, {nn.Linear}, dtype=torch.qint8
         )
@@ -252,4 +654,117 @@ class EnsembleModel(nn.Module):
         # 加权平均
         weighted_outputs = (stacked_outputs.permute(1, 2, 0) * weights).sum(-1)
         
-        return weighted_outputs
\ No newline at end of file
+        return weighted_outputs
+
+_member_executors = {}
+_member_executors_lock = threading.Lock()
+
+def _get_member_executor(num_workers):
+    """按进程创建成员并行用的线程池（预派生的子进程里不能复用父进程的线程）"""
+    key = (os.getpid(), num_workers)
+    with _member_executors_lock:
+        if key not in _member_executors:
+            _member_executors[key] = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='ensemble')
+        return _member_executors[key]
+
+class EnsembleMember(nn.Module):
+    """共享底层之上的一个集成成员：独立的上层编码层、特征层和维度分类头"""
+
+    def __init__(self, upper_layers, hidden_size, num_dimensions):
+        super().__init__()
+        self.layers = nn.ModuleList(upper_layers)
+        self.feature_layer = build_feature_layer(hidden_size)
+        self.dimension_heads = nn.ModuleList([
+            build_dimension_head(hidden_size) for _ in range(num_dimensions)
+        ])
+
+    def forward(self, hidden_states, extended_mask):
+        for encoder_layer in self.layers:
+            hidden_states = run_encoder_layer(encoder_layer, hidden_states, extended_mask)
+        features = self.feature_layer(hidden_states[:, 0, :])
+        return classify_features(self.dimension_heads, features)
+
+class SharedBackboneEnsemble(nn.Module):
+    """共享底层编码器的集成模型
+
+    embedding 和前 num_shared_layers 层冻结并且每个批次只计算一次，
+    各成员只有上层编码层和分类头不同，集成的额外开销只随成员独有部分增长；
+    成员前向在线程池中并行执行（torch 算子执行时释放 GIL）
+    """
+
+    def __init__(self, pretrained_model_name='hfl/chinese-roberta-wwm-ext-large', num_members=3,
+                 num_shared_layers=18, num_dimensions=2, bert_config=None, parallel=True):
+        super().__init__()
+        if bert_config is not None:
+            bert = BertModel(bert_config, add_pooling_layer=False)
+        else:
+            bert = BertModel.from_pretrained(pretrained_model_name, add_pooling_layer=False)
+        self.config = bert.config
+        num_layers = self.config.num_hidden_layers
+        if not 0 < num_shared_layers < num_layers:
+            raise ValueError(f"共享层数必须在 1 到 {num_layers - 1} 之间: {num_shared_layers}")
+        self.num_shared_layers = num_shared_layers
+        self.parallel = parallel
+
+        self.embeddings = bert.embeddings
+        self.shared_layers = nn.ModuleList(bert.encoder.layer[:num_shared_layers])
+        upper_layers = bert.encoder.layer[num_shared_layers:]
+        self.members = nn.ModuleList([
+            EnsembleMember(copy.deepcopy(upper_layers), self.config.hidden_size, num_dimensions)
+            for _ in range(num_members)
+        ])
+
+        # 共享部分冻结
+        for param in self.embeddings.parameters():
+            param.requires_grad = False
+        for param in self.shared_layers.parameters():
+            param.requires_grad = False
+
+    @classmethod
+    def from_model(cls, model, num_members=3, num_shared_layers=18):
+        """由微调好的 MultiDimensionalSentimentModel（未合并分类头）构建集成，每个成员从同一份上层权重开始"""
+        ensemble = cls(num_members=num_members, num_shared_layers=num_shared_layers,
+                       num_dimensions=len(model.dimension_heads), bert_config=model.bert.config)
+        ensemble.embeddings.load_state_dict(model.bert.embeddings.state_dict())
+        ensemble.shared_layers.load_state_dict(model.bert.encoder.layer[:num_shared_layers].state_dict())
+        for member in ensemble.members:
+            member.layers.load_state_dict(model.bert.encoder.layer[num_shared_layers:].state_dict())
+            member.feature_layer.load_state_dict(model.feature_layer.state_dict())
+            member.dimension_heads.load_state_dict(model.dimension_heads.state_dict())
+        return ensemble
+
+    def fuse_heads(self):
+        """把每个成员的维度分类头合并为批量计算（只用于推理）"""
+        for member in self.members:
+            member.dimension_heads = FusedDimensionHeads.from_heads(member.dimension_heads)
+        return self
+
+    def encode_shared(self, input_ids, attention_mask):
+        """计算共享底层，返回 (隐藏状态, 加性注意力掩码)；共享部分冻结，不保留计算图"""
+        with torch.no_grad():
+            hidden_states = self.embeddings(input_ids=input_ids)
+            extended_mask = extended_attention_mask(attention_mask, hidden_states.dtype)
+            for encoder_layer in self.shared_layers:
+                hidden_states = run_encoder_layer(encoder_layer, hidden_states, extended_mask)
+        return hidden_states, extended_mask
+
+    def member_outputs(self, hidden_states, extended_mask):
+        """各成员的 log_softmax 输出列表"""
+        if not self.parallel or len(self.members) == 1:
+            return [member(hidden_states, extended_mask) for member in self.members]
+
+        # 梯度开关是线程局部状态，需要带到工作线程里
+        grad_enabled = torch.is_grad_enabled()
+
+        def run(member):
+            with torch.set_grad_enabled(grad_enabled):
+                return member(hidden_states, extended_mask)
+
+        executor = _get_member_executor(len(self.members))
+        return list(executor.map(run, self.members))
+
+    def forward(self, input_ids, attention_mask):
+        hidden_states, extended_mask = self.encode_shared(input_ids, attention_mask)
+        outputs = torch.stack(self.member_outputs(hidden_states, extended_mask))  # [num_members, batch_size, num_dimensions]
+        # 各成员预测概率取平均后再取 log，输出仍是 log_softmax 形式，可直接替换单个模型使用
+        return torch.logsumexp(outputs, dim=0) - math.log(len(self.members))
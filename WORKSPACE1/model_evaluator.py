@@ -6,6 +6,7 @@ import seaborn as sns
 import pandas as pd
 import os
 from config import Config
+from predict import forward_in_buckets
 
 class ModelEvaluator:
     def __init__(self, model, tokenizer, device):
@@ -135,28 +136,9 @@ class ModelEvaluator:
         return errors
     
     def predict_text(self, text):
-        self.model.eval()
-        
-        encoding = self.tokenizer(
-            text,
-            add_special_tokens=True,
-            max_length=512,
-            padding='max_length',
-            truncation=True,
-            return_tensors='pt'
-        )
+        outputs = forward_in_buckets([text], self.model, self.tokenizer, self.device)
+        scores = torch.sigmoid(outputs).cpu().numpy()[0]
         
-        input_ids = encoding['input_ids'].to(self.device)
-        attention_mask = encoding['attention_mask'].to(self.device)
-        
-        with torch.no_grad():
-            outputs = self.model(
-                input_ids=input_ids,
-                attention_mask=attention_mask
-            )
-            
-            scores = torch.sigmoid(outputs).cpu().numpy()[0]
-            
         return {
             'dimension_scores': scores,
             'predicted_class': np.argmax(scores)
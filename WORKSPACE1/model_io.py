@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+import torch
+import torch.nn as nn
+from transformers import BertConfig
+from model import MultiDimensionalSentimentModel, SharedBackboneEnsemble
+
+DEFAULT_PRETRAINED_MODEL = 'hfl/chinese-roberta-wwm-ext-large'
+
+def model_config_path(model_path):
+    """检查点对应的结构配置文件：best_model.pt -> best_model_config.json"""
+    return os.path.splitext(model_path)[0] + '_config.json'
+
+def write_model_config(model_path, bert_config, num_dimensions, exit_layers=None, ensemble=None):
+    config = {
+        'num_dimensions': num_dimensions,
+        'exit_layers': list(exit_layers or []),
+        'ensemble': ensemble,
+        'bert_config': bert_config.to_dict(),
+    }
+    with open(model_config_path(model_path), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+def save_model_config(model, model_path):
+    """在检查点旁保存模型结构配置，加载时无需再读取预训练权重"""
+    if isinstance(model, SharedBackboneEnsemble):
+        ensemble = {'num_members': len(model.members), 'num_shared_layers': model.num_shared_layers}
+        write_model_config(model_path, model.config, len(model.members[0].dimension_heads), ensemble=ensemble)
+    else:
+        write_model_config(model_path, model.bert.config, len(model.dimension_heads), model.exit_layers)
+
+def save_checkpoint(model, model_path):
+    """保存 state_dict 以及结构配置"""
+    torch.save(model.state_dict(), model_path)
+    save_model_config(model, model_path)
+
+def load_model_config(model_path, state_dict):
+    """读取结构配置，返回包含 bert_config、num_dimensions、exit_layers、ensemble 的字典
+
+    没有配置文件时只下载预训练模型的 config.json，并从权重中推断维度数和提前退出层
+    """
+    path = model_config_path(model_path)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        return {
+            'bert_config': BertConfig.from_dict(config['bert_config']),
+            'num_dimensions': config['num_dimensions'],
+            'exit_layers': config.get('exit_layers', []),
+            'ensemble': config.get('ensemble'),
+        }
+
+    head_ids = {
+        int(match.group(1)) for match in
+        (re.match(r'dimension_heads\.(\d+)\.', key) for key in state_dict) if match
+    }
+    exit_layers = sorted({
+        int(match.group(1)) for match in
+        (re.match(r'exit_heads\.(\d+)\.', key) for key in state_dict) if match
+    })
+    return {
+        'bert_config': BertConfig.from_pretrained(DEFAULT_PRETRAINED_MODEL),
+        'num_dimensions': len(head_ids),
+        'exit_layers': exit_layers,
+        'ensemble': None,
+    }
+
+def build_model_from_config(config):
+    """按结构配置构建模型（不加载预训练权重）"""
+    if config['ensemble']:
+        return SharedBackboneEnsemble(
+            num_dimensions=config['num_dimensions'], bert_config=config['bert_config'], **config['ensemble']
+        )
+    return MultiDimensionalSentimentModel(
+        num_dimensions=config['num_dimensions'], bert_config=config['bert_config'],
+        exit_layers=config['exit_layers']
+    )
+
+def load_state_dict_file(model_path):
+    """以内存映射方式读取权重，张量按需从页缓存读入，不会整体拷贝到进程内存"""
+    if model_path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(model_path, device='cpu')
+    return torch.load(model_path, map_location=torch.device('cpu'), mmap=True, weights_only=True)
+
+@contextmanager
+def init_empty_weights():
+    """构建模型时把参数放到 meta 设备上：不分配内存也不做随机初始化，buffer 仍正常创建"""
+    original_register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        original_register_parameter(module, name, param)
+        if param is not None:
+            param = module._parameters[name]
+            module._parameters[name] = type(param)(param.to('meta'), requires_grad=param.requires_grad)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = original_register_parameter
+
+def to_dynamic_quantized_structure(module):
+    """把 nn.Linear 替换为动态量化 Linear 的空壳，结构与 quantize_dynamic 的结果一致"""
+    for name, child in module.named_children():
+        # 与 quantize_dynamic 相同，只替换类型恰好为 nn.Linear 的层
+        if type(child) is nn.Linear:
+            setattr(module, name, torch.ao.nn.quantized.dynamic.Linear(
+                child.in_features, child.out_features,
+                bias_=child.bias is not None, dtype=torch.qint8
+            ))
+        else:
+            to_dynamic_quantized_structure(child)
+    return module
+
+def build_model_fast(model_path, quantized=False, timings=None, fuse_heads=False):
+    """按配置构建模型结构并直接使用内存映射的权重，避免先加载预训练权重再覆盖
+
+    fuse_heads=True 时加载后把维度分类头转换为合并的批量计算结构（只支持 fp32）
+    """
+    if quantized and fuse_heads:
+        raise ValueError("合并分类头只支持 fp32 模型")
+    timings = timings if timings is not None else {}
+
+    start = time.perf_counter()
+    state_dict = load_state_dict_file(model_path)
+    timings['map_weights'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    config = load_model_config(model_path, state_dict)
+    with init_empty_weights():
+        model = build_model_from_config(config)
+    if quantized:
+        to_dynamic_quantized_structure(model)
+    timings['build_model'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # assign=True 直接使用映射出来的张量，不再额外拷贝一份
+    model.load_state_dict(state_dict, assign=True)
+    timings['load_state_dict'] = time.perf_counter() - start
+
+    if fuse_heads:
+        start = time.perf_counter()
+        model.fuse_heads()
+        timings['fuse_heads'] = time.perf_counter() - start
+    return model
+
+def main():
+    parser = argparse.ArgumentParser(description='为检查点生成结构配置，可选转换为 safetensors')
+    parser.add_argument('--model-path', type=str, default='WORKSPACE1/best_model.pt', help='fp32 检查点路径')
+    parser.add_argument('--safetensors', action='store_true', help='同时导出 .safetensors 权重文件')
+    args = parser.parse_args()
+
+    state_dict = load_state_dict_file(args.model_path)
+    config = load_model_config(args.model_path, state_dict)
+    output_paths = [args.model_path]
+    if args.safetensors:
+        from safetensors.torch import save_file
+        safetensors_path = os.path.splitext(args.model_path)[0] + '.safetensors'
+        save_file({k: v.contiguous() for k, v in state_dict.items()}, safetensors_path)
+        output_paths.append(safetensors_path)
+    for path in output_paths:
+        write_model_config(path, config['bert_config'], config['num_dimensions'], config['exit_layers'],
+                           config['ensemble'])
+        print(f"已生成: {path} ({model_config_path(path)})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import numpy as np
+import onnxruntime as ort
+import torch
+
+ONNX_INPUT_NAMES = ['input_ids', 'attention_mask']
+ONNX_OUTPUT_NAMES = ['log_probs']
+
+def export_onnx(model, onnx_path, opset_version=14):
+    """把 MultiDimensionalSentimentModel 导出为 batch 和序列长度都是动态维度的 ONNX 计算图"""
+    model.eval()
+    # 示例输入只用于追踪计算图，真实的 batch/序列长度由 dynamic_axes 决定
+    input_ids = torch.ones(2, 16, dtype=torch.long)
+    attention_mask = torch.ones(2, 16, dtype=torch.long)
+
+    # torch 2.9 起默认使用 dynamo 导出器（需要 onnxscript，动态维度用 dynamic_shapes 描述），
+    # 这里固定使用 TorchScript 导出器，dynamic_axes 和 opset 参数按它的语义编写
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (input_ids, attention_mask),
+            onnx_path,
+            input_names=ONNX_INPUT_NAMES,
+            output_names=ONNX_OUTPUT_NAMES,
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'log_probs': {0: 'batch'}
+            },
+            opset_version=opset_version,
+            do_constant_folding=True,
+            dynamo=False
+        )
+    print(f"ONNX 模型已导出至: {onnx_path}")
+
+class OnnxSentimentModel:
+    """用 ONNX Runtime 执行导出的计算图，调用方式与 MultiDimensionalSentimentModel 一致"""
+
+    def __init__(self, onnx_path, num_threads=None):
+        options = ort.SessionOptions()
+        # 启用全部图优化（常量折叠、算子融合、布局优化等）
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        # ONNX Runtime 只在 CPU 上执行
+        return self
+
+    def __call__(self, input_ids, attention_mask):
+        outputs = self.session.run(ONNX_OUTPUT_NAMES, {
+            'input_ids': input_ids.cpu().numpy().astype(np.int64),
+            'attention_mask': attention_mask.cpu().numpy().astype(np.int64)
+        })
+        return torch.from_numpy(outputs[0])
+
+def main():
+    from inference_only import load_model
+
+    parser = argparse.ArgumentParser(description='导出 ONNX 推理模型')
+    parser.add_argument('--model-path', type=str, default='WORKSPACE1/best_model.pt', help='PyTorch 检查点路径')
+    parser.add_argument('--output', type=str, default='WORKSPACE1/best_model.onnx', help='ONNX 模型保存路径')
+    parser.add_argument('--opset', type=int, default=14, help='ONNX opset 版本')
+    args = parser.parse_args()
+
+    model = load_model(args.model_path)
+    export_onnx(model, args.output, opset_version=args.opset)
+
+    # 导出后用随机输入做一次快速一致性检查
+    input_ids = torch.randint(1, model.bert.config.vocab_size, (3, 40))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 25:] = 0
+    with torch.no_grad():
+        expected = model(input_ids, attention_mask)
+    actual = OnnxSentimentModel(args.output)(input_ids, attention_mask)
+    print(f"与 PyTorch 输出的最大差异: {(expected - actual).abs().max().item():.2e}")
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,203 @@
+import time
 import torch
 import torch.nn.functional as F   # 导入函数库以计算softmax
+from tokenization import encode_batch, pad_batch
 
-def predict_sentiment(text, model, tokenizer, device):
-    """预测单个文本的情感"""
+SENTIMENT_MAP = {0: "负面", 1: "中性", 2: "正面"}
+POOLING_METHODS = ('mean', 'max_confidence', 'length_weighted')
+
+def predict_sentiment(text, model, tokenizer, device, pooling=None, stride=128, max_windows=None):
+    """预测单个文本的情感，pooling 见 predict_sentiment_batch"""
+    return predict_sentiment_batch([text], model, tokenizer, device, pooling=pooling, stride=stride,
+                                   max_windows=max_windows)[0]
+
+def supports_early_exit(model):
+    """模型是否带有提前退出头（ONNX 模型和未训练退出头的检查点不支持）"""
+    return bool(getattr(model, 'exit_layers', None))
+
+def _add_timing(timings, stage, seconds):
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+def forward_in_buckets(texts, model, tokenizer, device, batch_size=32, max_length=512, timings=None,
+                       exit_threshold=None, return_exit_layers=False):
+    """按token长度排序分桶后批量前向，每个桶只填充到桶内最长序列
+
+    返回与 texts 顺序一致的模型输出 [len(texts), num_classes]；
+    timings 传入字典时累加 tokenize/forward 两个阶段的耗时（秒）；
+    exit_threshold 不为 None 且模型带提前退出头时，置信度达到阈值的样本提前退出；
+    return_exit_layers=True 时返回 (输出, 每条文本实际计算的层数)，不支持提前退出的模型层数为 -1
+    """
+    start = time.perf_counter()
+    all_input_ids = encode_batch(tokenizer, texts, max_length)
+    _add_timing(timings, 'tokenize', time.perf_counter() - start)
+    return forward_token_ids(all_input_ids, model, tokenizer, device, batch_size, timings,
+                             exit_threshold, return_exit_layers)
+
+def forward_token_ids(all_input_ids, model, tokenizer, device, batch_size=32, timings=None,
+                      exit_threshold=None, return_exit_layers=False):
+    """对已分词（含特殊 token）的序列按长度分桶批量前向，参数与返回值同 forward_in_buckets"""
+    early_exit = exit_threshold is not None and supports_early_exit(model)
     model.eval()
-    encoding = tokenizer(
-        text,
-        add_special_tokens=True,
-        max_length=512,
-        padding='max_length',
-        truncation=True,
-        return_tensors='pt'
-    )
-    
-    input_ids = encoding['input_ids'].to(device)
-    attention_mask = encoding['attention_mask'].to(device)
-    
+    start = time.perf_counter()
+    # 按长度排序，长度相近的文本放进同一个桶
+    order = sorted(range(len(all_input_ids)), key=lambda i: len(all_input_ids[i]))
+    _add_timing(timings, 'tokenize', time.perf_counter() - start)
+
+    bucket_outputs = []
+    bucket_exit_layers = []
     with torch.no_grad():
-        outputs = model(input_ids, attention_mask)
-        probabilities = F.softmax(outputs, dim=1)  # 用于计算每个类的概率
-        predictions = torch.argmax(probabilities, dim=1)
-        confidence = torch.max(probabilities, dim=1)[0]  # 获取最大概率作为置信度
-    
-    sentiment_map = {0: "负面", 1: "中性", 2: "正面"}
-    return sentiment_map[predictions.item()], probabilities, confidence.item()
+        for bucket_start in range(0, len(order), batch_size):
+            start = time.perf_counter()
+            bucket = order[bucket_start:bucket_start + batch_size]
+            input_ids, attention_mask = pad_batch(tokenizer, [all_input_ids[i] for i in bucket])
+            input_ids = input_ids.to(device)
+            attention_mask = attention_mask.to(device)
+            _add_timing(timings, 'tokenize', time.perf_counter() - start)
+
+            start = time.perf_counter()
+            if early_exit:
+                bucket_output, exit_layers = model.forward_early_exit(input_ids, attention_mask, exit_threshold)
+                bucket_exit_layers.append(exit_layers)
+            else:
+                bucket_output = model(input_ids, attention_mask)
+            bucket_outputs.append(bucket_output)
+            _add_timing(timings, 'forward', time.perf_counter() - start)
+
+    # 还原为输入顺序
+    sorted_outputs = torch.cat(bucket_outputs, dim=0)
+    order_index = torch.tensor(order, device=sorted_outputs.device)
+    outputs = torch.empty_like(sorted_outputs)
+    outputs[order_index] = sorted_outputs
+    if not return_exit_layers:
+        return outputs
+
+    exit_layers = torch.full((len(order),), -1, dtype=torch.long, device=sorted_outputs.device)
+    if early_exit:
+        exit_layers[order_index] = torch.cat(bucket_exit_layers)
+    elif hasattr(model, 'bert') or hasattr(model, 'config'):
+        # 共享底层的集成模型直接持有 config
+        config = model.bert.config if hasattr(model, 'bert') else model.config
+        exit_layers.fill_(config.num_hidden_layers)
+    return outputs, exit_layers
+
+def split_into_windows(token_ids, window_size, stride, max_windows=None):
+    """把不含特殊 token 的序列切成长度不超过 window_size 的窗口，相邻窗口重叠 stride 个 token
+
+    窗口数约为 len / (window_size - stride)，计算量随文本长度线性增长；
+    最后一个窗口与序列末尾对齐，不会出现只有几个 token 的尾窗口。
+    max_windows 不为 None 时先截断到 max_windows 个窗口能覆盖的长度，超出部分丢弃
+    """
+    if stride < 0 or stride >= window_size:
+        raise ValueError(f"stride 必须在 [0, {window_size}) 之间: {stride}")
+    step = window_size - stride
+    if max_windows is not None:
+        if max_windows < 1:
+            raise ValueError(f"max_windows 必须为正数: {max_windows}")
+        token_ids = token_ids[:window_size + (max_windows - 1) * step]
+    if len(token_ids) <= window_size:
+        return [token_ids]
+    starts = list(range(0, len(token_ids) - window_size, step))
+    starts.append(len(token_ids) - window_size)
+    return [token_ids[start:start + window_size] for start in starts]
+
+def pool_windows(window_outputs, doc_index, num_docs, pooling='mean', window_lengths=None):
+    """把各窗口的输出按文档聚合，返回 [num_docs, num_classes] 的 log 概率
+
+    mean: 各窗口概率取平均；length_weighted: 按窗口 token 数加权平均；
+    max_confidence: 取最大概率最高的窗口
+    """
+    probabilities = F.softmax(window_outputs, dim=1)
+    if pooling == 'max_confidence':
+        confidence = probabilities.max(dim=1).values
+        best = torch.full((num_docs,), -1.0, device=probabilities.device)
+        best = best.scatter_reduce(0, doc_index, confidence, reduce='amax')
+        # 同一文档有多个窗口置信度相同时取第一个
+        candidates = torch.nonzero(confidence == best[doc_index]).squeeze(1)
+        chosen = torch.full((num_docs,), len(confidence), dtype=torch.long, device=probabilities.device)
+        chosen = chosen.scatter_reduce(0, doc_index[candidates], candidates, reduce='amin')
+        return torch.log(probabilities[chosen])
+    if pooling == 'mean':
+        weights = torch.ones(len(doc_index), device=probabilities.device)
+    elif pooling == 'length_weighted':
+        weights = window_lengths.to(device=probabilities.device, dtype=probabilities.dtype)
+    else:
+        raise ValueError(f"未知的聚合方式: {pooling}，可选 {POOLING_METHODS}")
+    pooled = torch.zeros(num_docs, probabilities.size(1), device=probabilities.device)
+    pooled.index_add_(0, doc_index, probabilities * weights.unsqueeze(1))
+    total = torch.zeros(num_docs, device=probabilities.device).index_add_(0, doc_index, weights)
+    return torch.log(pooled / total.unsqueeze(1))
+
+def forward_long_texts(texts, model, tokenizer, device, batch_size=32, max_length=512, stride=128,
+                       pooling='mean', timings=None, exit_threshold=None, max_windows=None):
+    """长文本滑动窗口推理：超过 max_length 的文本切成重叠窗口，不再截断
+
+    所有文本的全部窗口放在一起按长度分桶批量前向，再按 pooling 聚合回每条文本；
+    不超过 max_length 的文本只有一个窗口，结果与 forward_in_buckets 相同。
+    max_windows 限制每条文本的窗口数，超出部分截断，避免单条超长文本占满整个批次的计算。
+    返回 (输出, 每条文本实际计算的层数, 每条文本的窗口数)，多个窗口时层数取各窗口最大值
+    """
+    start = time.perf_counter()
+    all_token_ids = encode_batch(tokenizer, texts, add_special_tokens=False)
+    # 每个窗口加上 [CLS] 和 [SEP]
+    window_size = max_length - 2
+    window_ids = []
+    window_lengths = []
+    doc_index = []
+    for i, token_ids in enumerate(all_token_ids):
+        for window in split_into_windows(token_ids, window_size, stride, max_windows):
+            window_ids.append([tokenizer.cls_token_id] + window + [tokenizer.sep_token_id])
+            window_lengths.append(len(window))
+            doc_index.append(i)
+    _add_timing(timings, 'tokenize', time.perf_counter() - start)
+
+    window_outputs, window_exit_layers = forward_token_ids(
+        window_ids, model, tokenizer, device, batch_size, timings,
+        exit_threshold=exit_threshold, return_exit_layers=True
+    )
+
+    start = time.perf_counter()
+    doc_index = torch.tensor(doc_index, device=window_outputs.device)
+    outputs = pool_windows(window_outputs, doc_index, len(texts), pooling, torch.tensor(window_lengths))
+    exit_layers = torch.full((len(texts),), -1, dtype=torch.long, device=window_outputs.device)
+    exit_layers = exit_layers.scatter_reduce(0, doc_index, window_exit_layers, reduce='amax')
+    num_windows = torch.bincount(doc_index, minlength=len(texts))
+    _add_timing(timings, 'postprocess', time.perf_counter() - start)
+    return outputs, exit_layers, num_windows
+
+def predict_sentiment_batch(texts, model, tokenizer, device, batch_size=32, max_length=512, timings=None,
+                            exit_threshold=None, pooling=None, stride=128, max_windows=None):
+    """批量预测文本情感
+
+    返回与 texts 顺序一致的 (情感, 概率列表, 置信度, 退出层) 列表，退出层为实际计算的编码层数
+    （无法得知时为 None）；
+    timings 传入字典时累加 tokenize/forward/postprocess 各阶段耗时（秒）；
+    exit_threshold 为提前退出的置信度阈值，None 表示计算全部层；
+    pooling 为 POOLING_METHODS 之一时启用长文本滑动窗口（相邻窗口重叠 stride 个 token，
+    每条文本最多 max_windows 个窗口，None 表示不限），None 表示超过 max_length 的部分截断
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    if pooling:
+        outputs, exit_layers, _ = forward_long_texts(
+            texts, model, tokenizer, device, batch_size, max_length, stride, pooling, timings,
+            exit_threshold=exit_threshold, max_windows=max_windows
+        )
+    else:
+        outputs, exit_layers = forward_in_buckets(
+            texts, model, tokenizer, device, batch_size, max_length, timings,
+            exit_threshold=exit_threshold, return_exit_layers=True
+        )
+
+    start = time.perf_counter()
+    probabilities = F.softmax(outputs, dim=1)  # 用于计算每个类的概率
+    confidence, predictions = torch.max(probabilities, dim=1)  # 最大概率作为置信度
+    results = [
+        (SENTIMENT_MAP[pred], probs, conf, layer if layer >= 0 else None)
+        for pred, probs, conf, layer in zip(
+            predictions.tolist(), probabilities.tolist(), confidence.tolist(), exit_layers.tolist()
+        )
+    ]
+    _add_timing(timings, 'postprocess', time.perf_counter() - start)
+    return results
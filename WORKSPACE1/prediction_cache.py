@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from text_cleaning import clean_text
+
+def model_fingerprint(model_path):
+    """模型版本指纹：由检查点路径、大小和修改时间计算，替换 best_model.pt 后缓存自动失效"""
+    stat = os.stat(model_path)
+    raw = f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+class PredictionCache:
+    """预测结果缓存：内存 LRU（条目数/字节数上限 + TTL），可选共享磁盘层供多个进程复用"""
+
+    def __init__(self, fingerprint, max_entries=10000, max_bytes=64 * 1024 * 1024,
+                 ttl=3600, disk_dir=None):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        # 与训练数据使用相同的文本清洗规则
+        self._normalize = clean_text
+        self._entries = OrderedDict()  # key -> (value, nbytes, expires_at)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+
+        # 统计信息
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def make_key(self, text):
+        """缓存键：清洗后的文本 + 模型版本指纹；清洗后为空的文本不缓存"""
+        normalized = self._normalize(text)
+        if not normalized:
+            return None
+        return hashlib.sha1(f"{self.fingerprint}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        """查询缓存，未命中返回 None"""
+        key = self.make_key(text)
+        if key is None:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, nbytes, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+                self.expirations += 1
+
+        value, created = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, value, created)
+        return value
+
+    def put(self, text, value):
+        """写入缓存，value 需可 JSON 序列化"""
+        key = self.make_key(text)
+        if key is None:
+            return
+        with self._lock:
+            self._insert(key, value, time.time())
+        self._disk_put(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _insert(self, key, value, created):
+        nbytes = len(key) + len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, nbytes, created + self.ttl)
+        self.current_bytes += nbytes
+
+        # 超出条目数或字节数上限时按 LRU 淘汰
+        while len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self.current_bytes -= nbytes
+
+    def _disk_path(self, key):
+        # 按键前缀分目录，避免单个目录下文件过多
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _disk_get(self, key, now):
+        """读取磁盘层，返回 (value, 写入时间)"""
+        if not self.disk_dir:
+            return None, None
+        path = self._disk_path(key)
+        try:
+            created = os.path.getmtime(path)
+            if created + self.ttl <= now:
+                os.remove(path)
+                return None, None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f), created
+        except (OSError, json.JSONDecodeError):
+            return None, None
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再原子替换，其他进程不会读到写了一半的文件
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(value, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'disk_dir': self.disk_dir,
+                'model_fingerprint': self.fingerprint,
+            }
@@ -0,0 +1,164 @@
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from config import Config
+from feature_cache import dataset_hash, tokenizer_fingerprint
+from tokenization import encode_batch, load_tokenizer
+
+def token_shards_key(tokenizer, max_length, texts, labels):
+    """分片目录名：分词器、max_length 或数据（文本和标签）任一变化都会重新生成"""
+    raw = json.dumps({
+        'tokenizer': tokenizer_fingerprint(tokenizer),
+        'max_length': max_length,
+        'dataset': dataset_hash(list(texts) + [str(label) for label in labels]),
+    }, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]
+
+def build_token_shards(tokenizer, texts, labels, path, max_length=512, shard_size=50000, encode_batch_size=10000):
+    """把数据集分词后写成不填充的 NumPy 分片
+
+    每个分片包含 ids.npy（所有样本 token id 首尾相接）和 offsets.npy（每条样本的起止位置）；
+    目录下另有 labels.npy、lengths.npy 和 meta.json。词表不超过 int16 范围时用 int16 存储
+    """
+    texts = list(texts)
+    labels = np.asarray(labels, dtype=np.int64)
+    if len(texts) != len(labels):
+        raise ValueError(f"文本数 {len(texts)} 与标签数 {len(labels)} 不一致")
+    dtype = np.int16 if len(tokenizer) <= np.iinfo(np.int16).max else np.int32
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    # 先写到临时目录，完成后整体改名，中断时不会留下不完整的分片
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        lengths = np.empty(len(texts), dtype=np.int32)
+        shards = []
+        for shard_start in range(0, len(texts), shard_size):
+            shard_texts = texts[shard_start:shard_start + shard_size]
+            all_input_ids = []
+            for start in range(0, len(shard_texts), encode_batch_size):
+                all_input_ids.extend(encode_batch(tokenizer, shard_texts[start:start + encode_batch_size], max_length))
+            shard_lengths = np.array([len(input_ids) for input_ids in all_input_ids], dtype=np.int32)
+            lengths[shard_start:shard_start + len(shard_texts)] = shard_lengths
+
+            name = f'shard_{len(shards):05d}'
+            np.save(os.path.join(tmp_path, f'{name}.ids.npy'),
+                    np.fromiter((i for input_ids in all_input_ids for i in input_ids), dtype=dtype,
+                                count=int(shard_lengths.sum())))
+            np.save(os.path.join(tmp_path, f'{name}.offsets.npy'),
+                    np.concatenate([[0], np.cumsum(shard_lengths, dtype=np.int64)]))
+            shards.append({'name': name, 'num_samples': len(shard_texts)})
+
+        np.save(os.path.join(tmp_path, 'labels.npy'), labels)
+        np.save(os.path.join(tmp_path, 'lengths.npy'), lengths)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'num_samples': len(texts),
+                'num_tokens': int(lengths.sum()),
+                'max_length': max_length,
+                'dtype': np.dtype(dtype).name,
+                'pad_token_id': tokenizer.pad_token_id,
+                'tokenizer': tokenizer.name_or_path,
+                'shards': shards
+            }, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError:
+        # 其他进程已经生成了同一份分片
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            raise
+    finally:
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+def load_or_build_token_shards(tokenizer, texts, labels, shards_dir, max_length=Config.MAX_LENGTH,
+                               shard_size=50000):
+    """按分词器、max_length 和数据内容查找已生成的分片，不存在时生成，返回 PretokenizedDataset"""
+    path = os.path.join(shards_dir, token_shards_key(tokenizer, max_length, texts, labels))
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        print(f"使用已有的分词分片: {path}")
+    else:
+        print(f"生成分词分片: {path} ({len(texts)} 条)")
+        build_token_shards(tokenizer, texts, labels, path, max_length, shard_size)
+    return PretokenizedDataset(path)
+
+class PretokenizedDataset(Dataset):
+    """从分词分片读取样本，返回不填充的 input_ids，需配合 batching.DynamicPaddingCollator 使用
+
+    分片以写时复制方式内存映射，取样本只是对映射区域切片，不复制也不重新分词；
+    映射在每个进程第一次取样本时才打开，DataLoader 的各个 worker 共享同一份页缓存
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.labels = np.load(os.path.join(path, 'labels.npy'))
+        self.lengths = np.load(os.path.join(path, 'lengths.npy'))
+        self._shard_starts = np.cumsum([0] + [shard['num_samples'] for shard in self.meta['shards']])[:-1].tolist()
+        self._shards = None
+
+    def _open_shards(self):
+        self._shards = [
+            (
+                np.load(os.path.join(self.path, f"{shard['name']}.ids.npy"), mmap_mode='c'),
+                np.load(os.path.join(self.path, f"{shard['name']}.offsets.npy"))
+            )
+            for shard in self.meta['shards']
+        ]
+
+    def __getstate__(self):
+        # 传给 worker 时不带已打开的映射，由 worker 自己打开
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if self._shards is None:
+            self._open_shards()
+        shard = bisect.bisect_right(self._shard_starts, idx) - 1
+        ids, offsets = self._shards[shard]
+        local = idx - self._shard_starts[shard]
+        return {
+            'input_ids': torch.from_numpy(ids[offsets[local]:offsets[local + 1]]),
+            'labels': torch.tensor(self.labels[idx], dtype=torch.long)
+        }
+
+def main():
+    from data_processor import DataProcessor
+
+    parser = argparse.ArgumentParser(description='离线分词，把训练/测试集写成内存映射的 NumPy 分片')
+    parser.add_argument('--data-path', type=str, default='nCoV_100k_train.labled-utf8.csv', help='训练数据路径')
+    parser.add_argument('--label-column', type=str, default='情感倾向', help='标签列名')
+    parser.add_argument('--output-dir', type=str, default=Config.TOKEN_SHARDS_DIR, help='分片目录')
+    parser.add_argument('--tokenizer', type=str, default=Config.MODEL_NAME, help='分词器名称或路径')
+    parser.add_argument('--max-length', type=int, default=Config.MAX_LENGTH, help='最大序列长度')
+    parser.add_argument('--shard-size', type=int, default=50000, help='每个分片的样本数')
+    args = parser.parse_args()
+
+    tokenizer = load_tokenizer(args.tokenizer)
+    processor = DataProcessor(
+        sentiment_dict_path='sample_data/sentiment_dict.json',
+        stopwords_path='sample_data/stopwords.txt'
+    )
+    train_df, test_df = processor.process_data(args.data_path)
+    for name, df in (('训练集', train_df), ('测试集', test_df)):
+        dataset = load_or_build_token_shards(
+            tokenizer, df['cleaned_text'].tolist(), df[args.label_column].tolist(),
+            args.output_dir, args.max_length, args.shard_size
+        )
+        print(f"{name}: {len(dataset)} 条, {dataset.meta['num_tokens']} 个 token, "
+              f"平均长度 {dataset.lengths.mean():.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+import torch
+from data_processor import DataProcessor
+from inference_only import load_model
+from model import SentimentTrainer
+from model_io import save_model_config
+from predict import forward_in_buckets
+from tokenization import load_tokenizer
+from utils import get_peak_rss_mb, get_rss_mb
+
+def quantize_checkpoint(model_path, output_path):
+    """把 fp32 检查点转换为动态 INT8 量化检查点"""
+    model = load_model(model_path)
+    model.eval()
+    quantized_model = SentimentTrainer.quantize_model(model)
+    torch.save(quantized_model.state_dict(), output_path)
+    save_model_config(model, output_path)
+    print(f"量化模型已保存至: {output_path}")
+    return quantized_model
+
+def evaluate_variant(model_path, quantized, texts, batch_size, latency_samples, num_threads, result_queue):
+    """在独立进程中加载并评估一个模型，内存统计互不干扰"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    device = torch.device('cpu')
+    tokenizer = load_tokenizer('bert-base-chinese')
+
+    rss_before = get_rss_mb()
+    model = load_model(model_path, quantized=quantized)
+    model.eval()
+    rss_loaded = get_rss_mb()
+
+    start = time.perf_counter()
+    outputs = forward_in_buckets(texts, model, tokenizer, device, batch_size)
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for text in texts[:latency_samples]:
+        start = time.perf_counter()
+        forward_in_buckets([text], model, tokenizer, device)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    result_queue.put({
+        'predictions': outputs.argmax(dim=1).tolist(),
+        'model_rss_mb': rss_loaded - rss_before,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'throughput_texts_per_sec': len(texts) / elapsed,
+        'latency_ms_mean': 1000 * sum(latencies) / len(latencies),
+        'latency_ms_p95': 1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+    })
+
+def load_test_split(data_path, num_samples=None):
+    """ChnSentiCorp 测试集的文本和标签"""
+    processor = DataProcessor()
+    _, test_df = processor.process_data(data_path, balance_data=False)
+    if num_samples and num_samples < len(test_df):
+        test_df = test_df.sample(n=num_samples, random_state=42)
+    return test_df['cleaned_text'].tolist(), test_df['label'].astype(int).tolist()
+
+def compare_variants(variants, texts, labels, batch_size=32, latency_samples=100, num_threads=None):
+    """逐个评估 [(名称, 检查点路径, 是否量化)]，返回对比报告（含两两预测一致率）"""
+    # 用 spawn 启动子进程，每个模型在干净的进程里测内存
+    ctx = mp.get_context('spawn')
+    results = {}
+    predictions = {}
+    for name, model_path, quantized in variants:
+        result_queue = ctx.Queue()
+        process = ctx.Process(
+            target=evaluate_variant,
+            args=(model_path, quantized, texts, batch_size, latency_samples, num_threads, result_queue)
+        )
+        process.start()
+        result = result_queue.get()
+        process.join()
+
+        predictions[name] = result.pop('predictions')
+        result['accuracy'] = sum(p == l for p, l in zip(predictions[name], labels)) / len(labels)
+        result['checkpoint_size_mb'] = os.path.getsize(model_path) / 1024 / 1024
+        results[name] = result
+
+    baseline, candidate = variants[0][0], variants[1][0]
+    report = {
+        'num_samples': len(texts),
+        'agreement_rate': sum(a == b for a, b in zip(predictions[baseline], predictions[candidate])) / len(texts),
+    }
+    report.update(results)
+    return report
+
+def print_comparison(report, baseline, candidate):
+    print(f"\n测试样本数: {report['num_samples']}  预测一致率: {report['agreement_rate']:.2%}")
+    ratio_name = f"{candidate}/{baseline}"
+    print(f"{'指标':<28}{baseline:>12}{candidate:>12}{ratio_name:>16}")
+    for key in ['accuracy', 'checkpoint_size_mb', 'model_rss_mb', 'peak_rss_mb',
+                'latency_ms_mean', 'latency_ms_p95', 'throughput_texts_per_sec']:
+        baseline_value = report[baseline][key]
+        candidate_value = report[candidate][key]
+        ratio = candidate_value / baseline_value if baseline_value else float('nan')
+        print(f"{key:<28}{baseline_value:>12.4f}{candidate_value:>12.4f}{ratio:>16.2f}")
+
+def build_report(args):
+    """在 ChnSentiCorp 测试集上对比 fp32 与 INT8 模型"""
+    texts, labels = load_test_split(args.data_path, args.num_samples)
+    report = compare_variants(
+        [('fp32', args.model_path, False), ('int8', args.output, True)], texts, labels,
+        args.batch_size, args.latency_samples, args.num_threads
+    )
+    print_comparison(report, 'fp32', 'int8')
+
+    with open(args.report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n量化报告已保存至: {args.report_path}")
+    return report
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='生成 INT8 动态量化模型并与 fp32 对比')
+    parser.add_argument('--model-path', type=str, default='WORKSPACE1/best_model.pt', help='fp32 检查点路径')
+    parser.add_argument('--output', type=str, default='WORKSPACE1/best_model_int8.pt', help='量化检查点保存路径')
+    parser.add_argument('--report', action='store_true', help='量化后生成精度/大小/内存/延迟对比报告')
+    parser.add_argument('--report-path', type=str, default='WORKSPACE1/quantization_report.json', help='报告保存路径')
+    parser.add_argument('--data-path', type=str, default='ChnSentiCorp_htl_all.csv', help='ChnSentiCorp 数据路径')
+    parser.add_argument('--num-samples', type=int, default=None, help='只取测试集的部分样本')
+    parser.add_argument('--batch-size', type=int, default=32, help='吞吐测试的批次大小')
+    parser.add_argument('--latency-samples', type=int, default=100, help='单条延迟测试的样本数')
+    parser.add_argument('--num-threads', type=int, default=None, help='torch 线程数')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    quantize_checkpoint(args.model_path, args.output)
+    if args.report:
+        build_report(args)
+
+if __name__ == '__main__':
+    main()
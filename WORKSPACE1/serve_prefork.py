@@ -0,0 +1,114 @@
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import torch
+from werkzeug.serving import make_server
+import api
+from config import Config
+from predict import POOLING_METHODS
+
+def _run_worker(sock, args):
+    """工作进程：设置线程数后在继承的监听 socket 上提供服务"""
+    # 子进程恢复默认信号处理，由主进程统一管理退出
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch.set_num_threads(args.threads_per_worker)
+
+    server = make_server(args.host, args.port, api.app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+def _spawn_worker(sock, args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _run_worker(sock, args)
+        finally:
+            os._exit(0)
+    return pid
+
+def serve(args):
+    """主进程加载一次模型，然后 fork 出多个共享权重的工作进程"""
+    # 主进程只加载模型不做推理（不预热），单线程可避免 fork 前初始化 OpenMP 线程池；
+    # 权重以内存映射方式加载，工作进程之间还会通过页缓存共享同一份文件页
+    torch.set_num_threads(1)
+    # ONNX Runtime 会话在创建时就启动线程池，fork 后不可用，因此这里固定使用 torch 后端
+    api.init_model(backend='torch', quantized=args.quantized, warmup=False,
+                   exit_threshold=args.exit_threshold, model_path=args.model_path,
+                   long_text_pooling=args.long_text_pooling)
+
+    # 冻结当前所有对象，避免子进程里的 GC 扫描写入对象头触发写时复制
+    gc.collect()
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(Config.PREFORK_BACKLOG)
+    sock.set_inheritable(True)
+
+    workers = set()
+    for _ in range(args.workers):
+        workers.add(_spawn_worker(sock, args))
+    print(f"主进程 {os.getpid()} 已启动 {args.workers} 个工作进程, "
+          f"每个进程 {args.threads_per_worker} 个线程, 监听 {args.host}:{args.port}")
+
+    running = True
+
+    def shutdown(signum, frame):
+        nonlocal running
+        running = False
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if running:
+            # 工作进程异常退出时补充一个新的
+            print(f"工作进程 {pid} 退出 (status={status})，重新启动")
+            workers.add(_spawn_worker(sock, args))
+
+    sock.close()
+
+def parse_args():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='多进程预派生情感分析服务（工作进程共享只读模型权重）')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='监听地址')
+    parser.add_argument('--port', type=int, default=5000, help='监听端口')
+    parser.add_argument('--workers', type=int, default=Config.PREFORK_WORKERS, help='工作进程数')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='每个工作进程的 torch 线程数，默认按 CPU 核数平分')
+    parser.add_argument('--quantized', action='store_true', default=Config.INFERENCE_QUANTIZED,
+                        help='使用 INT8 量化模型')
+    parser.add_argument('--exit-threshold', type=float, default=Config.EARLY_EXIT_THRESHOLD,
+                        help='提前退出的置信度阈值；未指定 --model-path 时使用 early_exit.py 生成的带退出头检查点')
+    parser.add_argument('--model-path', type=str, default=None,
+                        help='模型检查点路径（如蒸馏得到的学生模型），默认按是否量化选择')
+    parser.add_argument('--long-text-pooling', type=str, default=Config.LONG_TEXT_POOLING or 'none',
+                        choices=POOLING_METHODS + ('none',), help='长文本滑动窗口的聚合方式，none 表示截断')
+    args = parser.parse_args()
+    if args.threads_per_worker is None:
+        args.threads_per_worker = max(1, cpu_count // args.workers)
+    return args
+
+def main():
+    if not hasattr(os, 'fork'):
+        sys.exit('预派生模式依赖 os.fork，只支持 Linux/macOS')
+    serve(parse_args())
+
+if __name__ == '__main__':
+    main()
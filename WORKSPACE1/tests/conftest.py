@@ -0,0 +1,5 @@
+import os
+import sys
+
+# WORKSPACE1 下的模块互相以顶层模块名导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
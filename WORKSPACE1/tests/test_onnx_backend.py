@@ -0,0 +1,35 @@
+import pytest
+import torch
+from transformers import BertConfig
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from model import MultiDimensionalSentimentModel
+from onnx_backend import OnnxSentimentModel, export_onnx
+
+
+@pytest.fixture(scope='module')
+def exported(tmp_path_factory):
+    """随机初始化的小模型（隐藏层维度需能被 16 整除）及其导出的 ONNX 模型"""
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=1000, hidden_size=64, num_hidden_layers=2, num_attention_heads=4,
+                        intermediate_size=128, max_position_embeddings=128)
+    model = MultiDimensionalSentimentModel(num_dimensions=3, bert_config=config).eval()
+    onnx_path = str(tmp_path_factory.mktemp('onnx') / 'model.onnx')
+    export_onnx(model, onnx_path)
+    return model, OnnxSentimentModel(onnx_path)
+
+
+# 导出时的示例输入为 2x16，覆盖不同的 batch 和序列长度以检查动态维度
+@pytest.mark.parametrize('batch_size,seq_len', [(1, 8), (2, 16), (5, 57)])
+def test_onnx_matches_torch(exported, batch_size, seq_len):
+    model, onnx_model = exported
+    input_ids = torch.randint(1, 1000, (batch_size, seq_len))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[-1, seq_len // 2:] = 0
+    with torch.no_grad():
+        expected = model(input_ids, attention_mask)
+    actual = onnx_model(input_ids, attention_mask)
+    assert actual.shape == expected.shape
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
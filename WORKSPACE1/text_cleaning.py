@@ -0,0 +1,14 @@
+import math
+import re
+
+def clean_text(text):
+    """与训练数据相同的文本清洗：只保留中文、英文字母和数字，其余字符替换为空格并合并空白
+
+    只依赖标准库，服务进程（预测缓存等）可以直接使用，不必加载 DataProcessor 的 pandas / jieba / imblearn
+    """
+    if text is None or (isinstance(text, float) and math.isnan(text)):
+        return ""
+    text = str(text)
+    text = re.sub(r'[^\u4e00-\u9fa5a-zA-Z0-9]', ' ', text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
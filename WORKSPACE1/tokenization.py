@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+import torch
+from transformers import BertTokenizerFast
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+# 快速分词器在 Rust 侧保存截断/填充设置，多个线程以不同设置同时调用会报 "Already borrowed"，
+# 异步服务有多个模型线程时分词需要串行（前向仍可并行）
+_encode_lock = threading.Lock()
+
+class TokenIdCache:
+    """文本 -> token id（不含特殊 token、未截断）的 LRU 缓存，供重复出现的热点输入复用分词结果"""
+
+    def __init__(self, max_entries=10000, max_tokens=512):
+        self.max_entries = max_entries
+        # 超过该长度的文本不缓存，避免少数长文本占满缓存
+        self.max_tokens = max_tokens
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, text):
+        with self._lock:
+            token_ids = self._entries.get(text)
+            if token_ids is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(text)
+            self.hits += 1
+            return token_ids
+
+    def put(self, text, token_ids):
+        if len(token_ids) > self.max_tokens:
+            return
+        with self._lock:
+            self._entries[text] = token_ids
+            self._entries.move_to_end(text)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+def load_tokenizer(name='bert-base-chinese', cache_size=0):
+    """加载 Rust 实现的快速分词器（同一进程内按名称复用）
+
+    分词结果与 BertTokenizer 逐 token 一致；cache_size > 0 时附带 TokenIdCache，
+    encode_batch 会优先从缓存读取
+    """
+    with _tokenizers_lock:
+        tokenizer = _tokenizers.get(name)
+        if tokenizer is None:
+            tokenizer = BertTokenizerFast.from_pretrained(name)
+            _tokenizers[name] = tokenizer
+    if cache_size and getattr(tokenizer, 'token_id_cache', None) is None:
+        tokenizer.token_id_cache = TokenIdCache(cache_size)
+    return tokenizer
+
+def get_token_id_cache(tokenizer):
+    return getattr(tokenizer, 'token_id_cache', None)
+
+def encode_batch(tokenizer, texts, max_length=None, add_special_tokens=True):
+    """批量分词，返回每条文本的 token id 列表（不填充）
+
+    add_special_tokens=True 时加 [CLS]/[SEP] 并截断到 max_length，与
+    tokenizer(text, add_special_tokens=True, max_length=max_length, truncation=True) 结果一致；
+    add_special_tokens=False 时不截断，用于长文本切窗口
+    """
+    texts = [str(text) for text in texts]
+    cache = get_token_id_cache(tokenizer)
+    if cache is None:
+        with _encode_lock:
+            if add_special_tokens:
+                return tokenizer(texts, add_special_tokens=True, max_length=max_length, truncation=True)['input_ids']
+            return tokenizer(texts, add_special_tokens=False, verbose=False)['input_ids']
+
+    all_token_ids = [cache.get(text) for text in texts]
+    missing = [i for i, token_ids in enumerate(all_token_ids) if token_ids is None]
+    if missing:
+        # 未命中的文本一次批量分词
+        with _encode_lock:
+            encoded = tokenizer([texts[i] for i in missing], add_special_tokens=False, verbose=False)['input_ids']
+        for i, token_ids in zip(missing, encoded):
+            all_token_ids[i] = token_ids
+            cache.put(texts[i], token_ids)
+    if not add_special_tokens:
+        return [list(token_ids) for token_ids in all_token_ids]
+    # 单条序列的截断只去掉末尾的 token，先截断再加特殊 token 与直接调用分词器等价
+    limit = None if max_length is None else max_length - 2
+    return [
+        [tokenizer.cls_token_id] + token_ids[:limit] + [tokenizer.sep_token_id]
+        for token_ids in all_token_ids
+    ]
+
+def pad_batch(tokenizer, all_input_ids, length=None):
+    """把 token id 列表右侧填充为张量，length 为 None 时填充到最长序列
+
+    返回 (input_ids, attention_mask)，与 tokenizer.pad 的结果一致
+    """
+    length = length or max(len(input_ids) for input_ids in all_input_ids)
+    input_ids = torch.full((len(all_input_ids), length), tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(all_input_ids), length), dtype=torch.long)
+    for row, ids in enumerate(all_input_ids):
+        input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, :len(ids)] = 1
+    return input_ids, attention_mask
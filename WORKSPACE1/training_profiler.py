@@ -0,0 +1,113 @@
+import contextlib
+import os
+import time
+import torch
+from distributed import all_reduce_sum, is_main_process
+from utils import get_peak_rss_mb
+
+PHASES = ('data', 'h2d', 'forward', 'backward', 'optimizer')
+PHASE_NAMES = {
+    'data': '数据加载等待',
+    'h2d': '拷贝到设备',
+    'forward': '前向',
+    'backward': '反向',
+    'optimizer': '优化器',
+}
+
+class TrainingProfiler:
+    """训练步耗时分解：数据加载等待、拷贝到设备、前向、反向、优化器，以及 samples/s、tokens/s 和峰值内存
+
+    传给 SentimentTrainer（或 train_model）后启用，每个 epoch 结束时打印汇总表；不传时训练循环不做任何计时。
+    CUDA 上每个阶段前后同步一次，计时才准确，因此只在需要分析时打开。
+    trace_dir 不为空时用 torch.profiler 记录从第 trace_start 步开始的 trace_steps 步，
+    导出的 trace 可以用 TensorBoard 或 chrome://tracing 查看
+    """
+
+    def __init__(self, device, trace_dir=None, trace_start=10, trace_steps=5):
+        self.device = device
+        self._sync = device.type == 'cuda'
+        self._torch_profiler = None
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self._sync:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(
+                    wait=max(trace_start - 1, 0), warmup=min(trace_start, 1), active=trace_steps, repeat=1
+                ),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True,
+                profile_memory=True
+            )
+            self._torch_profiler.start()
+        self._reset()
+
+    def _reset(self):
+        self.totals = dict.fromkeys(PHASES, 0.0)
+        self.steps = 0
+        self.samples = 0
+        self.tokens = 0
+        if self._sync:
+            torch.cuda.reset_peak_memory_stats()
+        self._epoch_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """把代码块的耗时计入 name 阶段，导出 trace 时同时标注为 train/name"""
+        if self._sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            if self._torch_profiler is not None:
+                with torch.profiler.record_function(f'train/{name}'):
+                    yield
+            else:
+                yield
+        finally:
+            if self._sync:
+                torch.cuda.synchronize()
+            self.totals[name] += time.perf_counter() - start
+
+    def iterate(self, data_loader):
+        """逐个取出批次，等待 DataLoader 的时间计入 data 阶段"""
+        iterator = iter(data_loader)
+        while True:
+            with self.phase('data'):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            yield batch
+
+    def step_end(self, num_samples, num_tokens):
+        self.steps += 1
+        self.samples += num_samples
+        self.tokens += num_tokens
+        if self._torch_profiler is not None:
+            self._torch_profiler.step()
+
+    def peak_memory_mb(self):
+        if self._sync:
+            return torch.cuda.max_memory_allocated() / 1024 / 1024
+        return get_peak_rss_mb()
+
+    def epoch_end(self, epoch):
+        """打印本 epoch 的汇总表并清零；数据并行时吞吐为所有进程之和"""
+        elapsed = time.perf_counter() - self._epoch_start
+        samples, tokens = all_reduce_sum([self.samples, self.tokens])
+        if is_main_process() and self.steps:
+            print(f"\nEpoch {epoch} 训练步耗时分解（{self.steps} 步，{elapsed:.1f}s）")
+            print(f"{'阶段':<16}{'总耗时(s)':>12}{'每步(ms)':>12}{'占比':>8}")
+            rows = [(PHASE_NAMES[name], self.totals[name]) for name in PHASES]
+            rows.append(('其他（日志、检查点等）', max(elapsed - sum(self.totals.values()), 0.0)))
+            for name, seconds in rows:
+                print(f"{name:<16}{seconds:>12.2f}{seconds / self.steps * 1000:>12.1f}{seconds / elapsed:>8.1%}")
+            print(f"吞吐: {samples / elapsed:.1f} samples/s, {tokens / elapsed:.0f} tokens/s  "
+                  f"峰值内存: {self.peak_memory_mb():.0f} MB")
+        self._reset()
+
+    def close(self):
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self._torch_profiler = None
@@ -1,5 +1,7 @@
 import logging
 import os
+import resource
+from config import Config
 
 def setup_logging(log_dir=Config.LOG_DIR):
     if not os.path.exists(log_dir):
@@ -13,4 +15,31 @@ def setup_logging(log_dir=Config.LOG_DIR):
             logging.FileHandler(log_file),
             logging.StreamHandler()
         ]
-    ) 
\ No newline at end of file
+    )
+
+def get_rss_mb():
+    """当前进程的常驻内存（MB）"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return get_peak_rss_mb()
+
+def get_peak_rss_mb():
+    """当前进程的峰值常驻内存（MB）"""
+    # Linux 下 ru_maxrss 单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def get_available_memory_mb():
+    """系统当前可用内存（MB），无法读取 /proc/meminfo 时返回 None"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
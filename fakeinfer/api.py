@@ -1,12 +1,23 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
 import aiohttp
 import asyncio
 import json
 import os
+import time
 from functools import wraps
 
 app = Flask(__name__)
 
+# 监控指标：upstream 为调用大模型接口（含读取响应），parse 为解析模型返回的 JSON
+STAGE_LATENCY = Histogram(
+    'emotion_stage_latency_seconds',
+    '情感分析各阶段耗时（秒）',
+    ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+IN_FLIGHT = Gauge('emotion_in_flight_requests', '正在处理中的 HTTP 请求数')
+
 # 修改HTML模板以反映新的多维度情感分析功能
 API_DOC = """
 <!DOCTYPE html>
@@ -94,6 +105,13 @@ curl -X POST -H "Content-Type: application/json" \\
 }
         </pre>
     </div>
+
+    <div class="endpoint">
+        <h2>监控指标接口</h2>
+        <p><strong>端点：</strong> /metrics</p>
+        <p><strong>方法：</strong> GET</p>
+        <p><strong>描述：</strong> Prometheus 文本格式指标：upstream/parse 各阶段耗时直方图以及在途请求数</p>
+    </div>
 </body>
 </html>
 """
@@ -148,6 +166,7 @@ class EmotionAnalyzer:
             "max_tokens": 8096
         }
 
+        start = time.perf_counter()
         async with aiohttp.ClientSession() as session:
             async with session.post(
                 f"{self.api_base}/v1/chat/completions",
@@ -159,7 +178,10 @@ class EmotionAnalyzer:
                     raise Exception(f"API调用失败: {await response.text()}")
                     
                 result = await response.json()
-                return self._process_response(result)
+        STAGE_LATENCY.labels('upstream').observe(time.perf_counter() - start)
+
+        with STAGE_LATENCY.labels('parse').time():
+            return self._process_response(result)
 
     def _process_response(self, response: dict) -> dict:
         """处理API响应"""
@@ -183,6 +205,7 @@ def home():
     return render_template_string(API_DOC)
 
 @app.route('/predict', methods=['POST'])
+@IN_FLIGHT.track_inprogress()
 @async_route
 async def predict():
     """情感分析接口"""
@@ -199,6 +222,11 @@ async def predict():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文本格式的指标"""
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
 if __name__ == '__main__':
     if not os.getenv("EMOTION_API_KEY"):
         raise ValueError("请设置环境变量 EMOTION_API_KEY")
@@ -0,0 +1,148 @@
+import resource
+import time
+from collections import defaultdict
+import torch
+from transformers import Trainer, TrainerCallback
+
+
+class StepTimer:
+    """累计一个 epoch 内各阶段的耗时、样本数和 token 数"""
+
+    def __init__(self, device):
+        self.sync = device.type == "cuda"
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+        self.samples = 0
+        self.tokens = 0
+        if self.sync:
+            torch.cuda.reset_peak_memory_stats()
+        self.epoch_start = self.clock()
+
+    def clock(self):
+        # CUDA 上先等已提交的计算完成，计时才对应到正确的阶段
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def peak_memory_mb(self):
+        if self.sync:
+            return torch.cuda.max_memory_allocated() / 1024 / 1024
+        # Linux 上 ru_maxrss 的单位是 KB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def summary(self, epoch):
+        elapsed = self.clock() - self.epoch_start
+        phases = [("数据加载等待", "data"), ("拷贝到设备", "h2d"), ("前向", "forward"),
+                  ("反向", "backward"), ("优化器", "optimizer")]
+        parts = [f"{name} {self.totals[key]:.2f}s ({self.totals[key] / elapsed:.0%})" for name, key in phases]
+        print(f"\nEpoch {epoch:.0f} 训练耗时 {elapsed:.1f}s: " + ", ".join(parts))
+        print(f"吞吐: {self.samples / elapsed:.1f} samples/s, {self.tokens / elapsed:.0f} tokens/s  "
+              f"峰值内存: {self.peak_memory_mb():.0f} MB")
+
+
+class StepTimerCallback(TrainerCallback):
+    """按 epoch 清零和打印计时，并记录优化器耗时（Trainer 只通过回调暴露优化器前后的时刻）
+
+    trace_dir 不为空时用 torch.profiler 记录从第 trace_start 个优化步开始的 trace_steps 步，
+    导出的 trace 可以用 TensorBoard 或 chrome://tracing 查看
+    """
+
+    def __init__(self, timer, trace_dir=None, trace_start=10, trace_steps=5):
+        self.timer = timer
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.torch_profiler = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        if not self.trace_dir or not state.is_world_process_zero:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.timer.sync:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        # 前 trace_start - 1 步不记录，再预热 1 步
+        schedule = torch.profiler.schedule(wait=max(self.trace_start - 1, 0), warmup=min(self.trace_start, 1),
+                                           active=self.trace_steps, repeat=1)
+        self.torch_profiler = torch.profiler.profile(
+            activities=activities, schedule=schedule, record_shapes=True, profile_memory=True,
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+        )
+        self.torch_profiler.start()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.timer.reset()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self.optimizer_start = self.timer.clock()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self.timer.totals["optimizer"] += self.timer.clock() - self.optimizer_start
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            self.timer.summary(state.epoch)
+
+
+class ProfilingTrainer(Trainer):
+    """每个 epoch 结束时打印数据加载、拷贝、前向、反向、优化器耗时和吞吐的 Trainer
+
+    只在需要分析时使用，正常训练仍用 Trainer，不做任何计时。trace_dir 等参数见 StepTimerCallback。
+    需要 transformers >= 4.46（数据加载等待在 get_batch_samples 中计时）
+    """
+
+    def __init__(self, *args, trace_dir=None, trace_start=10, trace_steps=5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.step_timer = StepTimer(self.args.device)
+        self.add_callback(StepTimerCallback(self.step_timer, trace_dir, trace_start, trace_steps))
+
+    def get_batch_samples(self, *args, **kwargs):
+        # 梯度累积时一个优化器步的全部微批次都在这里取出，等待 DataLoader 的时间全部计入数据加载
+        timer = self.step_timer
+        start = timer.clock()
+        result = super().get_batch_samples(*args, **kwargs)
+        timer.totals["data"] += timer.clock() - start
+        return result
+
+    def _prepare_inputs(self, inputs):
+        if not self.model.training:
+            return super()._prepare_inputs(inputs)
+        timer = self.step_timer
+        start = timer.clock()
+        inputs = super()._prepare_inputs(inputs)
+        timer.totals["h2d"] += timer.clock() - start
+        timer.samples += inputs["input_ids"].size(0)
+        if "attention_mask" in inputs:
+            timer.tokens += int(inputs["attention_mask"].sum())
+        else:
+            timer.tokens += inputs["input_ids"].numel()
+        return inputs
+
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        if not model.training:
+            return super().compute_loss(model, inputs, *args, **kwargs)
+        timer = self.step_timer
+        start = timer.clock()
+        result = super().compute_loss(model, inputs, *args, **kwargs)
+        timer.totals["forward"] += timer.clock() - start
+        return result
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        # training_step 包含拷贝、前向和反向，减去前两者即为反向耗时
+        timer = self.step_timer
+        measured = timer.totals["h2d"] + timer.totals["forward"]
+        start = timer.clock()
+        loss = super().training_step(model, inputs, *args, **kwargs)
+        elapsed = timer.clock() - start
+        timer.totals["backward"] += elapsed - (timer.totals["h2d"] + timer.totals["forward"] - measured)
+        return loss
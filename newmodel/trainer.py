@@ -5,6 +5,7 @@ from transformers import (
     TrainingArguments,
     Trainer
 )
+from train_profiler import ProfilingTrainer
 
 class EmotionModelTrainer:
     def __init__(self, model_name="hfl/chinese-roberta-wwm-ext", model_path="emotion_model"):
@@ -38,8 +39,12 @@ class EmotionModelTrainer:
             )
             self.model.eval()
 
-    def train(self, train_dataset, eval_dataset=None):
-        """训练模型"""
+    def train(self, train_dataset, eval_dataset=None, profile=False, trace_dir=None, trace_start=10, trace_steps=5):
+        """训练模型
+
+        profile=True 时每个 epoch 结束打印训练步耗时分解，trace_dir 不为空时同时导出
+        从第 trace_start 步开始 trace_steps 步的 torch.profiler trace
+        """
         training_args = TrainingArguments(
             output_dir="emotion_model",
             learning_rate=1e-5,
@@ -59,12 +64,18 @@ class EmotionModelTrainer:
             max_grad_norm=1.0,
         )
 
-        trainer = Trainer(
+        trainer_kwargs = dict(
             model=self.model,
             args=training_args,
             train_dataset=train_dataset,
             eval_dataset=eval_dataset,
         )
+        if profile:
+            trainer = ProfilingTrainer(
+                trace_dir=trace_dir, trace_start=trace_start, trace_steps=trace_steps, **trainer_kwargs
+            )
+        else:
+            trainer = Trainer(**trainer_kwargs)
         
         trainer.train()
         
@@ -98,8 +109,15 @@ if __name__ == "__main__":
         dataset = processor.prepare_training_data(texts, labels, trainer.tokenizer)
         train_test_split = processor.split_dataset(dataset)
         
-        # 训练模型
-        trainer.train(train_test_split['train'], train_test_split['test'])
+        # 训练模型，EMOTION_PROFILE=1 时打印训练步耗时分解，
+        # 同时设置 EMOTION_PROFILE_TRACE_DIR 时导出 torch.profiler trace（步数窗口见 EMOTION_PROFILE_TRACE_START/STEPS）
+        profile = os.getenv("EMOTION_PROFILE") == "1"
+        trainer.train(
+            train_test_split['train'], train_test_split['test'], profile=profile,
+            trace_dir=os.getenv("EMOTION_PROFILE_TRACE_DIR"),
+            trace_start=int(os.getenv("EMOTION_PROFILE_TRACE_START", "10")),
+            trace_steps=int(os.getenv("EMOTION_PROFILE_TRACE_STEPS", "5")),
+        )
         print("模型训练完成！")
     else:
         print("没有找到训练数据！")
\ No newline at end of file